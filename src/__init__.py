@@ -1,5 +1,16 @@
-from wrappers import AddTrueGoalToObsFlat, ColorBlindWrapper, OneHotColorBlindWrapper, AddSwitch, WeightedChannelWrapper, FunctionRewardWrapper, wrap
-from environments import GridEnv, ThreeGoalsEnv, RandomGoalEnv, Cell
+from wrappers import AddTrueGoalToObsFlat, ColorBlindWrapper, OneHotColorBlindWrapper, TokenColorBlindWrapper, AddSwitch, WeightedChannelWrapper, FunctionRewardWrapper, wrap, observe_batch, observe_states
+from environments import GridEnv, ThreeGoalsEnv, RandomGoalEnv, Cell, ThreeGoalsStates
 from architectures import *
 from utils import *
-from baselines import *
\ No newline at end of file
+from baselines import *
+from episode_log import *
+from probing import *
+from export import *
+from pruning import *
+from quantization import *
+from distillation import *
+from evaluation import *
+from batched_envs import *
+from metrics import *
+from search import *
+from autotune import *
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import copy
 from pprint import pprint
-from typing import Callable, Iterable
+from typing import Callable, Iterable, Sequence
 
 import gymnasium as gym
 import torch
@@ -18,6 +18,8 @@ __all__ = [
     "MLP",
     "Split",
     "Rearrange",
+    "IndexSelect",
+    "TokenEncoder",
     "WeightDecay",
     "L1WeightDecay",
     "PerChannelL1WeightDecay",
@@ -29,6 +31,7 @@ __all__ = [
     "CustomActorCriticPolicy",
     "CustomPolicyValueNetwork",
     "NOPFeaturesExtractor",
+    "materialize",
 ]
 
 from torch.nn.modules.lazy import LazyModuleMixin
@@ -102,6 +105,47 @@ class Rearrange(nn.Module):
         return f"'{self.pattern}'{lengths}"
 
 
+class IndexSelect(nn.Module):
+    """Keeps only the given indices of the input, along one dimension. Used by pruning to drop inputs."""
+
+    def __init__(self, dim: int, index: Sequence[int] | Tensor):
+        super().__init__()
+        self.dim = dim
+        self.register_buffer("index", torch.as_tensor(index, dtype=torch.long))
+
+    def forward(self, x: Tensor) -> Tensor:
+        return x.index_select(self.dim, self.index)
+
+    def extra_repr(self) -> str:
+        return f"dim={self.dim}, n_kept={len(self.index)}"
+
+
+class TokenEncoder(nn.Module):
+    """
+    Embeds the (cell type, x, y) tokens of an env in tokens mode, flattened to (..., n_tokens * 3).
+
+    The embedding of a token is the sum of the embeddings of its type, x and y. Padding tokens
+    (type 0) are embedded as zeros. Returns the embeddings of all the tokens, flattened.
+    """
+
+    def __init__(self, n_types: int, width: int, height: int, n_tokens: int, embed_dim: int = 16):
+        super().__init__()
+        self.n_tokens = n_tokens
+        self.type_embed = nn.Embedding(n_types, embed_dim, padding_idx=0)
+        self.x_embed = nn.Embedding(width, embed_dim)
+        self.y_embed = nn.Embedding(height, embed_dim)
+
+    def forward(self, x: Float[Tensor, "... token_dims"]) -> Float[Tensor, "... embeddings"]:
+        tokens = x.unflatten(-1, (self.n_tokens, 3)).long()
+        types = tokens[..., 0]
+        embed = self.type_embed(types) + self.x_embed(tokens[..., 1]) + self.y_embed(tokens[..., 2])
+        embed = embed * (types != 0).unsqueeze(-1)
+        return embed.flatten(-2)
+
+    def extra_repr(self) -> str:
+        return f"n_tokens={self.n_tokens}"
+
+
 class WeightDecay(torch.nn.Module):
     # Adapted from https://github.com/szymonmaszke/torchlayers/blob/master/torchlayers/regularization.py#L150
     def __init__(self, module, weight_decay: float, name_filter: str = None, print_names: bool = False):
@@ -227,10 +271,47 @@ class LazyMask(LazyModuleMixin, Mask):
 
 
 class SwitchedLayer(nn.ModuleList):
-    def __init__(self, layer: nn.Module, n_switches: int):
+    """
+    n_switches copies of a layer, each sample going through the copy selected by its switch.
+
+    Modes:
+        - dense: every copy runs on the whole batch, and the right output is then selected.
+        - grouped: samples are grouped by switch, and each copy runs only on its group.
+            The groups depend on the data, so it cannot be used with torch.func.vmap or
+            torch.compile, and lazy copies are only initialized by the switches they see.
+        - batched: the weights of the copies are stacked and gathered per sample, so that each
+            sample is computed with one batched matmul/conv. Only for Linear and Conv2d layers.
+            It is the fastest when weights are small compared to activations, as with convolutions.
+
+    All modes give the same outputs and gradients. The default is dense.
+    """
+
+    MODES = ("dense", "grouped", "batched")
+
+    def __init__(self, layer: nn.Module, n_switches: int, mode: str = "dense"):
         super().__init__([copy.deepcopy(layer) for _ in range(n_switches)])
+        assert mode in self.MODES, f"Unknown mode {mode}, expected one of {self.MODES}"
+        if mode == "batched":
+            assert isinstance(layer, (nn.Linear, nn.Conv2d)), f"Cannot use batched mode with {layer}"
+        self.mode = mode
+
+    def extra_repr(self) -> str:
+        return f"mode={self.mode}"
 
     def forward(self, x: Float[Tensor, "batch *dims"], switch: Int[Tensor, "batch"]) -> Tensor:
+        switch = switch.long()
+        # Layers saved before modes existed are dense.
+        mode = getattr(self, "mode", "dense")
+        if mode == "dense" or len(x) == 0:
+            return self._forward_dense(x, switch)
+        elif mode == "grouped":
+            return self._forward_grouped(x, switch)
+        elif isinstance(self[0], nn.Linear):
+            return self._forward_batched_linear(x, switch)
+        else:
+            return self._forward_batched_conv(x, switch)
+
+    def _forward_dense(self, x: Tensor, switch: Tensor) -> Tensor:
         # To do the forward pass, through the switch, we need to take into
         # account the batch dimension. We run a forward pass for each switch
         all_x = torch.stack([layer(x) for layer in self], dim=1)
@@ -238,9 +319,45 @@ class SwitchedLayer(nn.ModuleList):
         x = all_x[torch.arange(len(x)), switch]
         return x
 
+    def _forward_grouped(self, x: Tensor, switch: Tensor) -> Tensor:
+        out = None
+        for s in torch.unique(switch).tolist():
+            idx = torch.nonzero(switch == s).squeeze(1)
+            y = self[s](x[idx])
+            if out is None:
+                out = y.new_zeros((len(x), *y.shape[1:]))
+            out = out.index_copy(0, idx, y)
+        return out
+
+    def _forward_batched_linear(self, x: Tensor, switch: Tensor) -> Tensor:
+        weight = torch.stack([layer.weight for layer in self])[switch]  # (batch, out, in)
+        out = torch.bmm(x.reshape(len(x), -1, x.shape[-1]), weight.transpose(1, 2))
+        if self[0].bias is not None:
+            bias = torch.stack([layer.bias for layer in self])[switch]  # (batch, out)
+            out = out + bias[:, None]
+        return out.view(*x.shape[:-1], -1)
+
+    def _forward_batched_conv(self, x: Tensor, switch: Tensor) -> Tensor:
+        # Each sample is its own group in a grouped convolution
+        conv: nn.Conv2d = self[0]
+        assert conv.groups == 1 and conv.padding_mode == "zeros", "Only simple convolutions are supported"
+        batch = len(x)
+        weight = torch.stack([layer.weight for layer in self])[switch]  # (batch, out, in, kh, kw)
+        bias = torch.stack([layer.bias for layer in self])[switch].flatten() if conv.bias is not None else None
+        out = torch.nn.functional.conv2d(
+            x.reshape(1, -1, *x.shape[2:]),
+            weight.flatten(0, 1),
+            bias,
+            conv.stride,
+            conv.padding,
+            conv.dilation,
+            groups=batch,
+        )
+        return out.view(batch, -1, *out.shape[2:])
+
 
 class SwitchNetwork(nn.ModuleList):
-    def __init__(self, *layers, switched: int | Iterable[int], n_switches: int):
+    def __init__(self, *layers, switched: int | Iterable[int], n_switches: int, mode: str = "dense"):
         super().__init__(layers)
         self.n_switches = n_switches
 
@@ -248,7 +365,7 @@ class SwitchNetwork(nn.ModuleList):
             switched = [switched]
 
         for switched_layer in switched:
-            self[switched_layer] = SwitchedLayer(self[switched_layer], n_switches)
+            self[switched_layer] = SwitchedLayer(self[switched_layer], n_switches, mode)
 
     def forward(self, x: Tensor | dict, switch: Int[Tensor, "batch"] = None) -> Tensor:
         if switch is None:
@@ -280,6 +397,30 @@ class SwitchNetwork(nn.ModuleList):
 # Policy related classes
 
 
+def materialize(module: nn.Module, observation_space: gym.Space) -> Tensor:
+    """
+    Resolve all the lazy modules of a network, by running it on one dummy observation.
+
+    Lazy modules (LazyLinear, LazyConv2d, LazyMask...) become their concrete class, with
+    initialized parameters, so that the network can be compiled, scripted, and have its
+    state dict loaded. Returns the output of the network on the dummy batch of size 1.
+    """
+    device = next((p.device for p in module.parameters() if not isinstance(p, nn.UninitializedParameter)),
+                  torch.device("cpu"))
+    obs = obs_as_tensor(observation_space.sample(), device)
+    if isinstance(obs, dict):
+        obs = {key: value[None].float() for key, value in obs.items()}
+    else:
+        obs = obs[None].float()
+
+    with torch.no_grad():
+        out = module(obs)
+
+    lazy = [name for name, m in module.named_modules() if isinstance(m, LazyModuleMixin)]
+    assert not lazy, f"Some lazy modules were not used in the forward pass: {lazy}"
+    return out
+
+
 class NOPFeaturesExtractor(BaseFeaturesExtractor):
     """A feature extractor that does nothing"""
 
@@ -301,6 +442,8 @@ class CustomPolicyValueNetwork(nn.Module):
     A pair of networks, one for the policy and one for the value function (which might be the same)
     """
 
+    compiled = False
+
     def __init__(
             self,
             observation_space: gym.Space,
@@ -314,13 +457,12 @@ class CustomPolicyValueNetwork(nn.Module):
 
         # IMPORTANT:
         # We need to save output dimensions, it's used by SB3 to create the distributions
-        # For this, we compute the output of the network with dummy values
-        # and extract the dimension from the result
-        device = next(policy_net.parameters()).device
-        obs = obs_as_tensor(observation_space.sample(), device).float()
-        policy_out, value_out = self.forward(obs)
-        self.latent_dim_pi = policy_out.shape[-1]
-        self.latent_dim_vf = value_out.shape[-1]
+        # They are found when resolving the lazy modules, before SB3 creates the optimizer.
+        self.latent_dim_pi = materialize(policy_net, observation_space).shape[-1]
+        if value_net is None:
+            self.latent_dim_vf = self.latent_dim_pi
+        else:
+            self.latent_dim_vf = materialize(value_net, observation_space).shape[-1]
 
     def forward(self, features) -> tuple[Tensor, Tensor]:
         """
@@ -334,18 +476,48 @@ class CustomPolicyValueNetwork(nn.Module):
 
     def forward_actor(self, features: Tensor) -> Tensor:
         """Compute the latent policy"""
+        if self.compiled:
+            return self._compiled_nets[0](features)
         return self.policy_net(features)
 
     def forward_critic(self, features: Tensor) -> Tensor:
         """Compute the latent value"""
         if self.value_net is None:
             return self.forward_actor(features)
+        if self.compiled:
+            return self._compiled_nets[1](features)
         return self.value_net(features)
 
+    def compile_nets(self):
+        """Run the policy and value networks through torch.compile."""
+        self.compiled = True
+        self._build_compiled_nets()
+
+    def _build_compiled_nets(self):
+        # Kept out of the submodules, so that the keys of the state dict stay the same, and
+        # compiled models can load uncompiled weights and vice versa.
+        value_net = None if self.value_net is None else torch.compile(self.value_net)
+        self.__dict__["_compiled_nets"] = (torch.compile(self.policy_net), value_net)
+
+    def __getstate__(self):
+        # The compiled networks wrap the modules of this instance: copies and unpickled
+        # instances rebuild their own, instead of running the original modules.
+        state = self.__dict__.copy()
+        state.pop("_compiled_nets", None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if self.compiled:
+            self._build_compiled_nets()
+
 
 class CustomActorCriticPolicy(ActorCriticPolicy):
     """Actor critic policy network to which one can pass an arbitrary network
-    for the policy and value function, that takes raw observations as input."""
+    for the policy and value function, that takes raw observations as input.
+
+    With compile=True, the actor and critic are compiled with torch.compile.
+    """
 
     def __init__(
             self,
@@ -354,6 +526,7 @@ class CustomActorCriticPolicy(ActorCriticPolicy):
             lr_schedule: Callable[[float], float],
             arch: nn.Module | tuple[nn.Module, nn.Module],
             *args,
+            compile: bool = False,
             **kwargs,
     ):
         if isinstance(arch, nn.Module):
@@ -370,6 +543,10 @@ class CustomActorCriticPolicy(ActorCriticPolicy):
             **kwargs,
         )
 
+        self.compiled = compile
+        if compile:
+            self.mlp_extractor.compile_nets()
+
     def _build_mlp_extractor(self) -> None:
         self.mlp_extractor = CustomPolicyValueNetwork(
             self.observation_space,
@@ -0,0 +1,173 @@
+"""
+Throughput autotuning of the training setup.
+
+Short timed PPO runs measure how fast the environments are stepped and the policy is updated
+for candidate settings (number of envs, vec env backend, batch size, torch threads), and how
+many trainings can run concurrently. The best setting is stored per host, since it depends on
+the number of cores and on the architecture.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import socket
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable
+
+import torch
+from joblib import Parallel, delayed
+from stable_baselines3 import PPO
+from stable_baselines3.common.callbacks import BaseCallback
+
+__all__ = [
+    "Probe",
+    "measure",
+    "measure_concurrent",
+    "autotune",
+    "load_tuned",
+    "save_tuned",
+]
+
+
+@dataclass
+class Probe:
+    config: dict[str, object]
+    env_steps_per_s: float
+    updates_per_s: float
+    timesteps_per_s: float
+    jobs: int = 1
+
+
+class _ThroughputCallback(BaseCallback):
+    """Time the rollout collections and the policy updates in between."""
+
+    def __init__(self):
+        super().__init__()
+        self.collect_times: list[float] = []
+        self.update_times: list[float] = []
+        self._last = None
+
+    def _on_rollout_start(self) -> None:
+        now = time.perf_counter()
+        if self._last is not None:
+            self.update_times.append(now - self._last)
+        self._last = now
+
+    def _on_rollout_end(self) -> None:
+        now = time.perf_counter()
+        self.collect_times.append(now - self._last)
+        self._last = now
+
+    def _on_training_end(self) -> None:
+        # The last update happens after the last rollout
+        self._on_rollout_start()
+
+    def _on_step(self) -> bool:
+        return True
+
+
+def measure(make_model: Callable[[dict], PPO], config: dict[str, object], n_rollouts: int = 3) -> Probe:
+    """
+    Train a model built by make_model(config) for n_rollouts + 1 rollouts, and measure its throughput.
+
+    The first rollout and update are a warmup and are not counted.
+    If config has a "torch_threads" key, torch uses this many threads during the probe.
+    """
+    previous_threads = torch.get_num_threads()
+    if config.get("torch_threads"):
+        torch.set_num_threads(config["torch_threads"])
+    try:
+        model = make_model(config)
+        rollout_size = model.n_steps * model.n_envs
+        callback = _ThroughputCallback()
+        model.learn((n_rollouts + 1) * rollout_size, callback=callback)
+        model.env.close()
+    finally:
+        torch.set_num_threads(previous_threads)
+
+    collect = sum(callback.collect_times[1:])
+    update = sum(callback.update_times[1:])
+    gradient_steps = model.n_epochs * math.ceil(rollout_size / model.batch_size)
+    return Probe(
+        config=config,
+        env_steps_per_s=n_rollouts * rollout_size / collect,
+        updates_per_s=n_rollouts * gradient_steps / update,
+        timesteps_per_s=n_rollouts * rollout_size / (collect + update),
+    )
+
+
+def measure_concurrent(make_model: Callable[[dict], PPO], config: dict[str, object], jobs: int,
+                       n_rollouts: int = 3) -> Probe:
+    """Run the same probe in `jobs` processes at once. Throughputs are summed over the jobs."""
+    probes = Parallel(n_jobs=jobs)(delayed(measure)(make_model, config, n_rollouts) for _ in range(jobs))
+    return Probe(
+        config=config,
+        env_steps_per_s=sum(p.env_steps_per_s for p in probes),
+        updates_per_s=sum(p.updates_per_s for p in probes),
+        timesteps_per_s=sum(p.timesteps_per_s for p in probes),
+        jobs=jobs,
+    )
+
+
+def autotune(make_model: Callable[[dict], PPO], candidates: dict[str, list], n_rollouts: int = 3,
+             max_jobs: int | None = None, log: Callable[[Probe], None] = print) -> tuple[dict, list[Probe]]:
+    """
+    Find the setting with the highest training throughput, in timesteps per second.
+
+    Each key of candidates is tuned in turn, keeping the best value of the previous ones
+    and the first value of the next ones. Then the number of concurrent jobs is tuned, up to
+    max_jobs, which defaults to the number of cores divided by the number of torch threads.
+
+    Returns the best config, with a "jobs" key, and all the probes.
+    """
+    config = {key: values[0] for key, values in candidates.items()}
+    probes = []
+    for key, values in candidates.items():
+        results = []
+        for value in values:
+            probe = measure(make_model, config | {key: value}, n_rollouts)
+            log(probe)
+            results.append(probe)
+        probes += results
+        config = max(results, key=lambda p: p.timesteps_per_s).config
+
+    if max_jobs is None:
+        threads = config.get("torch_threads") or torch.get_num_threads()
+        max_jobs = max(1, os.cpu_count() // threads)
+    best = max(probes, key=lambda p: p.timesteps_per_s)
+    jobs = 2
+    while jobs <= max_jobs:
+        probe = measure_concurrent(make_model, config, jobs, n_rollouts)
+        log(probe)
+        probes.append(probe)
+        if probe.timesteps_per_s <= best.timesteps_per_s:
+            break
+        best = probe
+        jobs *= 2
+
+    return config | dict(jobs=best.jobs), probes
+
+
+def load_tuned(path: Path, host: str | None = None) -> dict[str, object] | None:
+    """Return the tuned config for this host stored in path, if any."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    return json.loads(path.read_text()).get(host or socket.gethostname(), {}).get("config")
+
+
+def save_tuned(path: Path, config: dict[str, object], probes: list[Probe], host: str | None = None):
+    """Store the tuned config and the probes for this host in path, next to the other hosts."""
+    path = Path(path)
+    data = json.loads(path.read_text()) if path.exists() else {}
+    data[host or socket.gethostname()] = dict(
+        config=config,
+        cpu_count=os.cpu_count(),
+        probes=[asdict(p) for p in probes],
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data, indent=2))
@@ -2,69 +2,180 @@
 from __future__ import annotations
 
 import abc
+from collections import OrderedDict
 from random import choice
 
+import gymnasium as gym
 import numpy as np
 from jaxtyping import Int, Bool
 
 
 import environments
+import wrappers
+
+__all__ = [
+    "PathEngine",
+    "Baseline",
+    "GoalBaseline",
+    "TrueGoalOracle",
+    "ColorBlindOptimal",
+    "NearestGoal",
+]
+
+
+class PathEngine:
+    """
+    Shortest path distances on grids with obstacles.
+
+    Distance fields are computed with BFS wavefronts, vectorized over the grid and over a batch.
+    The fields towards every cell of a given obstacle layout are computed at once and cached,
+    keyed by the obstacle bitmask, so that next action queries are array lookups. A table takes
+    (width * height)^2 * 4 bytes, 64 MiB for a 64x64 grid, so the cache is bounded in bytes.
+    """
+
+    UNREACHABLE = 2 ** 30
+    MOVES = np.array(environments.GridEnv.DIR_TO_VEC)
+
+    def __init__(self, cache_bytes: int = 2 ** 28):
+        self.cache_bytes = cache_bytes
+        self.cache: OrderedDict[tuple[int, int, bytes], Int[np.ndarray, "target_x target_y width height"]] = \
+            OrderedDict()
+
+    @classmethod
+    def distance_fields(cls,
+                        obstacles: Bool[np.ndarray, "batch width height"],
+                        targets: Int[np.ndarray, "batch 2"]) -> Int[np.ndarray, "batch width height"]:
+        """
+        Return the number of steps from each cell to the target, avoiding obstacles.
+
+        Targets are reachable even if they are on an obstacle.
+        Cells from which the target cannot be reached are UNREACHABLE.
+        """
+        batch = np.arange(len(targets))
+        free = ~obstacles
+        free[batch, targets[:, 0], targets[:, 1]] = True
+
+        distances = np.full(obstacles.shape, cls.UNREACHABLE, dtype=np.int32)
+        frontier = np.zeros(obstacles.shape, dtype=bool)
+        frontier[batch, targets[:, 0], targets[:, 1]] = True
+        distance = 0
+        while frontier.any():
+            distances[frontier] = distance
+            expanded = np.zeros_like(frontier)
+            expanded[:, 1:] |= frontier[:, :-1]
+            expanded[:, :-1] |= frontier[:, 1:]
+            expanded[:, :, 1:] |= frontier[:, :, :-1]
+            expanded[:, :, :-1] |= frontier[:, :, 1:]
+            frontier = expanded & free & (distances == cls.UNREACHABLE)
+            distance += 1
+        return distances
+
+    def table(self, obstacles: Bool[np.ndarray, "width height"]) -> Int[np.ndarray, "target_x target_y width height"]:
+        """Return the distance fields towards every cell, for one obstacle layout."""
+        key = obstacles.shape + (np.packbits(obstacles).tobytes(),)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        w, h = obstacles.shape
+        targets = np.stack(np.unravel_index(np.arange(w * h), (w, h)), axis=-1)
+        fields = self.distance_fields(np.broadcast_to(obstacles, (w * h, w, h)), targets)
+        fields = fields.reshape(w, h, w, h)
+
+        self.cache[key] = fields
+        # The newest table is kept even if it is larger than the cache
+        while len(self.cache) > 1 and sum(f.nbytes for f in self.cache.values()) > self.cache_bytes:
+            self.cache.popitem(last=False)
+        return fields
+
+    @classmethod
+    def descend(cls,
+                fields: Int[np.ndarray, "batch width height"],
+                positions: Int[np.ndarray, "batch 2"],
+                rng: np.random.Generator | None = None) -> Int[np.ndarray, "batch"]:
+        """
+        Return the action that gets closer to the target of each distance field.
+
+        Ties are broken by the order of the actions, or at random if a rng is given.
+        If the target is reached or unreachable, the action is random.
+        """
+        batch = np.arange(len(positions))
+        w, h = fields.shape[1:]
+        neighbors = positions[:, None] + cls.MOVES  # (batch, action, 2)
+        in_bounds = np.all((neighbors >= 0) & (neighbors < (w, h)), axis=-1)
+        neighbors = np.clip(neighbors, 0, (w - 1, h - 1))
+        distances = fields[batch[:, None], neighbors[..., 0], neighbors[..., 1]]
+        distances = np.where(in_bounds, distances, cls.UNREACHABLE)
+
+        if rng is None:
+            rng = np.random.default_rng()
+            noise = np.zeros(distances.shape)
+        else:
+            noise = rng.random(distances.shape)
+        actions = np.argmin(distances + noise, axis=-1)
+
+        current = fields[batch, positions[:, 0], positions[:, 1]]
+        stuck = (current == 0) | (current == cls.UNREACHABLE)
+        actions[stuck] = rng.integers(len(cls.MOVES), size=stuck.sum())
+        return actions
+
+    def next_actions(self,
+                     agents: Int[np.ndarray, "batch 2"],
+                     targets: Int[np.ndarray, "batch 2"],
+                     obstacles: Bool[np.ndarray, "width height"] | Bool[np.ndarray, "batch width height"],
+                     rng: np.random.Generator | None = None) -> Int[np.ndarray, "batch"]:
+        """
+        Return the first action of a shortest path from each agent to its target.
+
+        If obstacles is a single layout, the cached table of this layout is used.
+        If there is one layout per agent, the distance fields are computed for the whole batch.
+        """
+        agents = np.asarray(agents).reshape(-1, 2)
+        targets = np.asarray(targets).reshape(-1, 2)
+        if obstacles.ndim == 2:
+            fields = self.table(obstacles)[targets[:, 0], targets[:, 1]]
+        else:
+            fields = self.distance_fields(obstacles, targets)
+        return self.descend(fields, agents, rng)
 
 
 class Baseline(abc.ABC):
     """Baseline class."""
 
-    @staticmethod
-    def find_path(start: tuple[int, int],
+    paths = PathEngine()
+
+    @classmethod
+    def find_path(cls,
+                  start: tuple[int, int],
                   end: tuple[int, int],
                   obstacles: Bool[np.ndarray, "width height"]) -> list[tuple[int, int]]:
         """
         Find the shortest path from start to end while avoiding obstacles.
 
-        If no path is found, return an empty list.
+        The start can be on an obstacle. If no path is found, return an empty list.
         """
+        obstacles = np.asarray(obstacles, dtype=bool)
+        if obstacles[end]:
+            return []
+        if obstacles[start]:
+            # The distance fields never enter obstacles, the agent can still leave one
+            obstacles = obstacles.copy()
+            obstacles[start] = False
 
-        w, h = obstacles.shape
+        field = cls.paths.table(obstacles)[end]
+        if field[start] == PathEngine.UNREACHABLE:
+            return []
 
-        def get_neighbors(pos):
-            """Get neighbors of pos."""
-            x, y = pos
-            neighbors = []
-            if x > 0:
-                neighbors.append((x - 1, y))
-            if x < w - 1:
-                neighbors.append((x + 1, y))
-            if y > 0:
-                neighbors.append((x, y - 1))
-            if y < h - 1:
-                neighbors.append((x, y + 1))
-            return neighbors
-
-        def get_path(parents, pos):
-            """Get path from start to pos."""
-            path = [pos]
-            while path[-1] != start:
-                path.append(parents[path[-1]])
-            return path[::-1]
-
-        # Initialize
-        queue = [start]
-        visited = np.zeros_like(obstacles)
-        parents = {}
-
-        # Search
-        while queue:
-            pos = queue.pop(0)
-            if pos == end:
-                return get_path(parents, pos)
-            visited[pos] = 1
-            for neighbor in get_neighbors(pos):
-                if not visited[neighbor] and not obstacles[neighbor]:
-                    queue.append(neighbor)
-                    parents[neighbor] = pos
-
-        # No path found
-        return []
+        path = [tuple(start)]
+        w, h = obstacles.shape
+        while path[-1] != tuple(end):
+            x, y = path[-1]
+            for dx, dy in PathEngine.MOVES:
+                neighbor = x + dx, y + dy
+                if 0 <= neighbor[0] < w and 0 <= neighbor[1] < h and field[neighbor] == field[x, y] - 1:
+                    path.append(neighbor)
+                    break
+        return path
 
     @staticmethod
     def find(grid: Int[np.ndarray, "width height channels"], obj: list[int]) -> tuple[int, int]:
@@ -111,3 +222,173 @@ class Baseline(abc.ABC):
     def predict(self, obs, deterministic=False):
         return self._predict(obs), None
 
+
+class GoalBaseline(Baseline):
+    """
+    Base class for baselines on ThreeGoalsEnv that act on batches of observations.
+
+    Observations are decoded with array operations only, so predict takes either one
+    observation or a (batch, ...) array and returns one action or a (batch,) array.
+    The observations can be those of ColorBlindWrapper (optionally followed by
+    WeightedChannelWrapper), of OneHotColorBlindWrapper, or the raw grid, optionally
+    followed by AddTrueGoalToObsFlat.
+
+    Subclasses choose which goal to go to, with `choose_goal`. The agent then follows
+    a shortest path to it, that avoids the other goals.
+    """
+
+    def __init__(self, env: gym.Env, seed: int | None = None):
+        self.rng = np.random.default_rng(seed)
+        self.seed = seed if seed is not None else int(self.rng.integers(2 ** 31))
+
+        unwrapped = env.unwrapped
+        assert isinstance(unwrapped, environments.ThreeGoalsEnv), unwrapped
+        self.width, self.height = unwrapped.width, unwrapped.height
+        self.single_obs_ndim = len(env.observation_space.shape)
+
+        n_cells = len(unwrapped.ALL_CELLS)
+        self.goal_cells = [unwrapped.ALL_CELLS.index(goal) for goal in unwrapped.GOAL_CELLS]
+        self.n_goals = len(self.goal_cells)
+
+        # How each cell type is encoded in the observation, found by encoding each type
+        # with the same wrappers.
+        cell_types = np.arange(n_cells, dtype="int8")[:, None, None]  # n_cells grids of size 1x1
+        self.true_goal_in_obs = None
+        obs = cell_types
+        stack = []
+        while isinstance(env, gym.Wrapper):
+            stack.append(env)
+            env = env.env
+        for wrapper in reversed(stack):
+            if isinstance(wrapper, wrappers.AddTrueGoalToObsFlat):
+                self.true_goal_in_obs = "one_hot" if wrapper.goal_is_one_hot else "index"
+            elif hasattr(wrapper, "observation_batch"):
+                obs = wrapper.observation_batch(obs, np.zeros(n_cells, dtype=int))
+        self.codes = obs.reshape(n_cells, -1).astype(float)  # (n_cells, channels)
+
+    def decode(self, obs: np.ndarray) -> tuple[
+        Int[np.ndarray, "batch 2"],
+        Bool[np.ndarray, "batch width height cell"],
+        Int[np.ndarray, "batch"] | None,
+    ]:
+        """
+        Return the agent positions, which cell types each cell could contain, and the true goals.
+
+        A cell can contain several types when they are indistinguishable in the observation.
+        The true goal is None if it is not part of the observation.
+        """
+        batch = len(obs)
+        n_channels = self.codes.shape[1]
+        grid_size = self.width * self.height * n_channels
+        obs = obs.reshape(batch, -1)
+        grid = obs[:, :grid_size].reshape(batch, self.width, self.height, 1, n_channels)
+
+        if self.true_goal_in_obs == "one_hot":
+            true_goal = obs[:, grid_size:].argmax(-1)
+        elif self.true_goal_in_obs == "index":
+            true_goal = obs[:, grid_size].astype(int)
+        else:
+            true_goal = None
+
+        types = np.all(np.isclose(grid, self.codes), axis=-1)
+        agent_pos = np.stack(np.unravel_index(types[..., 1].reshape(batch, -1).argmax(-1),
+                                              (self.width, self.height)), axis=-1)
+        return agent_pos, types, true_goal
+
+    def choose_goal(self,
+                    distances: Int[np.ndarray, "batch slot"],
+                    goal_types: Bool[np.ndarray, "batch slot goal"],
+                    goal_cells: Int[np.ndarray, "batch slot"],
+                    true_goal: Int[np.ndarray, "batch"] | None) -> Int[np.ndarray, "batch"]:
+        """
+        Return the slot of the goal to go to.
+
+        Args:
+            distances: Length of the shortest path from the agent to each slot,
+                PathEngine.UNREACHABLE if there is no goal in the slot.
+            goal_types: Which goals (red, green, blue) each slot could contain.
+            goal_cells: Flat index of the cell of each slot.
+            true_goal: The true goal, if it is part of the observation.
+        """
+        raise NotImplementedError
+
+    def nearest(self, distances: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+        """Return the nearest candidate slot."""
+        return np.argmin(np.where(candidates, distances, PathEngine.UNREACHABLE + 1), axis=-1)
+
+    def _predict(self, obs):
+        obs = np.asarray(obs)
+        single = obs.ndim == self.single_obs_ndim
+        if single:
+            obs = obs[None]
+        batch = np.arange(len(obs))
+
+        agent_pos, types, true_goal = self.decode(obs)
+        goal_types = types[..., self.goal_cells]  # (batch, w, h, goal)
+        is_goal = goal_types.any(-1).reshape(len(obs), -1)
+
+        # Put the goals in n_goals slots. Missing goals (under the agent) are UNREACHABLE.
+        goal_cells = np.argsort(~is_goal, axis=-1, kind="stable")[:, :self.n_goals]
+        present = is_goal[batch[:, None], goal_cells]
+        slot_types = goal_types.reshape(len(obs), -1, self.n_goals)[batch[:, None], goal_cells] & present[..., None]
+        targets = np.stack(np.unravel_index(goal_cells, (self.width, self.height)), axis=-1)
+
+        # Distance fields towards each slot, where all other goals are obstacles
+        obstacles = is_goal.reshape(len(obs), self.width, self.height)
+        fields = np.stack([
+            PathEngine.distance_fields(obstacles, targets[:, slot])
+            for slot in range(self.n_goals)
+        ], axis=1)  # (batch, slot, w, h)
+        distances = fields[batch[:, None], np.arange(self.n_goals), agent_pos[:, None, 0], agent_pos[:, None, 1]]
+        distances = np.where(present, distances, PathEngine.UNREACHABLE)
+
+        slot = self.choose_goal(distances, slot_types, goal_cells, true_goal)
+        actions = PathEngine.descend(fields[batch, slot], agent_pos, self.rng)
+
+        if single:
+            return int(actions[0])
+        return actions
+
+
+class TrueGoalOracle(GoalBaseline):
+    """
+    Goes straight to the true goal.
+
+    It needs the true goal in the observation. With colour-blind observations,
+    it cannot tell the true goal from the goals that look the same, and goes to the nearest of them.
+    """
+
+    def choose_goal(self, distances, goal_types, goal_cells, true_goal):
+        assert true_goal is not None, "The true goal must be in the observation"
+        return self.nearest(distances, goal_types[np.arange(len(distances)), :, true_goal])
+
+
+class ColorBlindOptimal(GoalBaseline):
+    """
+    Goes to a goal that looks like the true goal, chosen uniformly among them.
+
+    The choice depends only on the layout of the goals (and the seed), so it stays
+    the same during the whole episode.
+    """
+
+    def choose_goal(self, distances, goal_types, goal_cells, true_goal):
+        assert true_goal is not None, "The true goal must be in the observation"
+        candidates = goal_types[np.arange(len(distances)), :, true_goal]
+        n_candidates = candidates.sum(-1)
+
+        # Hash the layout into a pseudo-random number, with Knuth's multiplicative hash.
+        layout = np.sort(goal_cells, axis=-1) @ (1 + np.arange(goal_cells.shape[1]) * 1_000_003)
+        hashed = ((layout + self.seed) * 2_654_435_761) % 2 ** 32
+        choice_idx = (hashed >> 8) % np.maximum(n_candidates, 1)
+
+        # Index of the choice_idx-th candidate
+        rank = np.cumsum(candidates, axis=-1) - 1
+        chosen = candidates & (rank == choice_idx[:, None])
+        return np.where(n_candidates > 0, chosen.argmax(-1), 0)
+
+
+class NearestGoal(GoalBaseline):
+    """Goes to the nearest goal, whatever its colour."""
+
+    def choose_goal(self, distances, goal_types, goal_cells, true_goal):
+        return self.nearest(distances, goal_types.any(-1))
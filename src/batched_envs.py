@@ -0,0 +1,280 @@
+"""
+Many copies of a GridEnv stepped and reset together, on arrays.
+
+BatchedGridEnv runs the episode logic of a GridEnv subclass (ThreeGoalsEnv, RandomGoalEnv...)
+for a batch of environments, from the tables the env precomputes: the neighbor table, the
+cell properties, the objects placed by make_grid (spawn_weights) and the per-episode rules
+(batch_rules). Grids are stored flat, indexed by x * height + y.
+
+When numba is installed, step and reset run as JIT-compiled loops, otherwise as vectorized
+NumPy. The NumPy reset places all the objects of all the resetting envs at once, with
+sample_distinct_cells. Both backends sample episodes from the same distribution as the env.
+"""
+
+from __future__ import annotations
+
+from typing import Literal
+
+import numpy as np
+from jaxtyping import Bool, Float, Int
+
+from environments import GridEnv
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+__all__ = [
+    "HAS_NUMBA",
+    "BatchedGridEnv",
+    "sample_distinct_cells",
+]
+
+HAS_NUMBA = numba is not None
+
+
+def _step_loop(grids, agent, steps, done, actions, neighbors, can_overlap, reward_table, terminates_table,
+               step_reward, max_steps, reward, terminated, truncated):
+    for b in range(grids.shape[0]):
+        if done[b]:
+            reward[b] = 0.0
+            terminated[b] = False
+            truncated[b] = False
+            continue
+
+        idx = agent[b]
+        new_idx = neighbors[idx, actions[b]]
+        r = step_reward
+        term = False
+        # Out of bounds moves lead to the same cell, and do nothing
+        if new_idx != idx:
+            obj = grids[b, new_idx]
+            can_move = True
+            if obj != 0:
+                can_move = can_overlap[obj]
+                r = reward_table[b, obj]
+                term = terminates_table[b, obj]
+            if can_move:
+                grids[b, idx] = 0
+                grids[b, new_idx] = 1
+                agent[b] = new_idx
+
+        steps[b] += 1
+        reward[b] = r
+        terminated[b] = term
+        truncated[b] = steps[b] >= max_steps
+        done[b] = term or truncated[b]
+
+
+def _reset_loop(grids, agent, steps, done, objects, mask, spawn_types, spawn_weights, uniforms):
+    n_cells = grids.shape[1]
+    i = 0  # Row of the resetting envs in uniforms
+    for b in range(grids.shape[0]):
+        if not mask[b]:
+            continue
+        grids[b, :] = 0
+        for k in range(spawn_types.shape[0]):
+            # Sample an empty cell proportionally to the weights, by inverting the cumulative sum
+            total = 0.0
+            for c in range(n_cells):
+                if grids[b, c] == 0:
+                    total += spawn_weights[k, c]
+            if total <= 0.0:
+                raise ValueError("No empty cell with a positive weight to place an object")
+            target = uniforms[i, k] * total
+            cumulative = 0.0
+            chosen = n_cells - 1
+            for c in range(n_cells):
+                if grids[b, c] == 0:
+                    cumulative += spawn_weights[k, c]
+                    if cumulative > target:
+                        chosen = c
+                        break
+            grids[b, chosen] = spawn_types[k]
+            objects[b, k] = chosen
+        agent[b] = objects[b, 0]
+        steps[b] = 0
+        done[b] = False
+        i += 1
+
+
+if HAS_NUMBA:
+    _step_loop = numba.njit(cache=True)(_step_loop)
+    _reset_loop = numba.njit(cache=True)(_reset_loop)
+
+
+def _step_numpy(grids, agent, steps, done, actions, neighbors, can_overlap, reward_table, terminates_table,
+                step_reward, max_steps, reward, terminated, truncated):
+    batch = np.arange(len(grids))
+    active = ~done
+    new_idx = neighbors[agent, actions]
+    obj = grids[batch, new_idx]
+    on_object = active & (new_idx != agent) & (obj != 0)
+    can_move = active & (new_idx != agent) & ((obj == 0) | can_overlap[obj])
+
+    reward[:] = np.where(on_object, reward_table[batch, obj], step_reward) * active
+    terminated[:] = on_object & terminates_table[batch, obj]
+
+    grids[batch[can_move], agent[can_move]] = 0
+    grids[batch[can_move], new_idx[can_move]] = 1
+    agent[can_move] = new_idx[can_move]
+
+    steps += active
+    truncated[:] = active & (steps >= max_steps)
+    done |= terminated | truncated
+
+
+def sample_distinct_cells(weights: Float[np.ndarray, "object cells"], n: int, rng: np.random.Generator,
+                          occupied: Bool[np.ndarray, "n cells"] | None = None) -> Int[np.ndarray, "n object"]:
+    """
+    Sample n placements of objects on distinct cells, as successive GridEnv.place_obj calls do:
+    object k is on a free cell, with probability proportional to weights[k] among the free cells.
+
+    Runs of consecutive objects with the same weights are placed together with Gumbel-top-k:
+    the m cells with the largest log(weight) + Gumbel noise are a sample without replacement,
+    in order. For uniform weights, this is a random-key argsort, with uniform keys.
+    Raises ValueError if an object has no free cell with a positive weight.
+    """
+    n_objects, n_cells = weights.shape
+    cells = np.empty((n, n_objects), dtype=np.int64)
+    occupied = np.zeros((n, n_cells), dtype=bool) if occupied is None else occupied.copy()
+    rows = np.arange(n)[:, None]
+
+    start = 0
+    while start < n_objects:
+        end = start + 1
+        while end < n_objects and np.array_equal(weights[end], weights[start]):
+            end += 1
+
+        run_weights = weights[start]
+        if np.all(run_weights == run_weights[0]):
+            keys = rng.random((n, n_cells))
+        else:
+            with np.errstate(divide="ignore"):
+                keys = np.log(run_weights) + rng.gumbel(size=(n, n_cells))
+        keys[occupied] = -np.inf
+
+        # The top m keys, sorted
+        m = end - start
+        top = np.argpartition(-keys, m - 1, axis=1)[:, :m]
+        top_keys = np.take_along_axis(keys, top, axis=1)
+        if np.isneginf(top_keys).any():
+            raise ValueError("No empty cell with a positive weight to place an object")
+        top = np.take_along_axis(top, np.argsort(-top_keys, axis=1), axis=1)
+
+        cells[:, start:end] = top
+        occupied[rows, top] = True
+        start = end
+    return cells
+
+
+class BatchedGridEnv:
+    """
+    n_envs episodes of a GridEnv, as arrays.
+
+    Observations are the grids, shaped (n_envs, width, height) like GridEnv.grid. The position of
+    the k-th object of spawn_weights() is in objects[:, k], as a flat cell index, and per-episode
+    variables of batch_rules (e.g. true_goal) are in info.
+
+    Args:
+        env: The environment to copy. Wrappers are ignored.
+        n_envs: Number of environments.
+        backend: "numba", "numpy", or "auto" to use numba when it is installed.
+        auto_reset: Reset the environments that end in step, as SB3's VecEnvs do.
+    """
+
+    def __init__(self, env: GridEnv, n_envs: int, seed: int | None = None,
+                 backend: Literal["auto", "numba", "numpy"] = "auto", auto_reset: bool = True):
+        env: GridEnv = env.unwrapped
+        if backend == "auto":
+            backend = "numba" if HAS_NUMBA else "numpy"
+        assert backend != "numba" or HAS_NUMBA, "numba is not installed"
+        self.backend = backend
+        self._step = _step_loop if backend == "numba" else _step_numpy
+
+        self.env = env
+        self.n_envs = n_envs
+        self.auto_reset = auto_reset
+        self.rng = np.random.default_rng(seed)
+        self.width, self.height = env.width, env.height
+        self.step_reward = float(env.step_reward)
+        self.max_steps = env.max_steps
+
+        self.neighbors = env.neighbors.astype(np.int64)
+        self.can_overlap = np.array(env.cell_can_overlap)
+        spawns = env.spawn_weights()
+        self.spawn_types = np.array([cell_type for cell_type, _ in spawns], dtype=np.int8)
+        self.spawn_weights = np.stack([weights for _, weights in spawns]).astype(np.float64)
+
+        n_cells = self.width * self.height
+        n_types = len(env.ALL_CELLS)
+        self.grids = np.zeros((n_envs, n_cells), dtype=np.int8)
+        self.agent = np.zeros(n_envs, dtype=np.int64)
+        self.steps = np.zeros(n_envs, dtype=np.int64)
+        self.done = np.ones(n_envs, dtype=bool)
+        self.objects = np.zeros((n_envs, len(spawns)), dtype=np.int64)
+        self.reward_table = np.zeros((n_envs, n_types), dtype=np.float32)
+        self.terminates_table = np.zeros((n_envs, n_types), dtype=bool)
+        self.info: dict[str, np.ndarray] = {}
+
+        self._reward = np.zeros(n_envs, dtype=np.float32)
+        self._terminated = np.zeros(n_envs, dtype=bool)
+        self._truncated = np.zeros(n_envs, dtype=bool)
+
+    @property
+    def obs(self) -> Int[np.ndarray, "n_envs width height"]:
+        return self.grids.reshape(self.n_envs, self.width, self.height)
+
+    @property
+    def agent_pos(self) -> Int[np.ndarray, "n_envs 2"]:
+        return np.stack(np.divmod(self.agent, self.height), axis=-1)
+
+    def reset(self, mask: Bool[np.ndarray, "n_envs"] | None = None) -> Int[np.ndarray, "n_envs width height"]:
+        """Start new episodes in all the environments, or only where mask is True."""
+        mask = np.ones(self.n_envs, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+        n = int(mask.sum())
+        if n == 0:
+            return self.obs
+
+        reward, terminates, info = self.env.batch_rules(n, self.rng)
+        self.reward_table[mask] = reward
+        self.terminates_table[mask] = terminates
+        for name, values in info.items():
+            if name not in self.info:
+                self.info[name] = np.zeros((self.n_envs, *values.shape[1:]), dtype=values.dtype)
+            self.info[name][mask] = values
+
+        if self.backend == "numba":
+            uniforms = self.rng.random((n, len(self.spawn_types)))
+            _reset_loop(self.grids, self.agent, self.steps, self.done, self.objects, mask,
+                        self.spawn_types, self.spawn_weights, uniforms)
+        else:
+            envs = np.flatnonzero(mask)
+            cells = sample_distinct_cells(self.spawn_weights, n, self.rng)
+            self.grids[envs] = 0
+            self.grids[envs[:, None], cells] = self.spawn_types
+            self.objects[envs] = cells
+            self.agent[envs] = cells[:, 0]
+            self.steps[envs] = 0
+            self.done[envs] = False
+        return self.obs
+
+    def step(self, actions: Int[np.ndarray, "n_envs"]) -> tuple[
+        Int[np.ndarray, "n_envs width height"],
+        Float[np.ndarray, "n_envs"],
+        Bool[np.ndarray, "n_envs"],
+        Bool[np.ndarray, "n_envs"],
+    ]:
+        """
+        Step every environment that is not done. Returns (obs, reward, terminated, truncated).
+
+        With auto_reset, the environments that end are reset, and obs is their new first grid.
+        The arrays returned are reused by the next call.
+        """
+        self._step(self.grids, self.agent, self.steps, self.done, np.asarray(actions, dtype=np.int64),
+                   self.neighbors, self.can_overlap, self.reward_table, self.terminates_table,
+                   self.step_reward, self.max_steps, self._reward, self._terminated, self._truncated)
+        if self.auto_reset:
+            self.reset(self.done)
+        return self.obs, self._reward, self._terminated, self._truncated
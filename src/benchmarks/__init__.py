@@ -0,0 +1,6 @@
+"""
+Performance benchmarks.
+
+The suite of the environments, policy and training runs with: python train.py bench
+Other benchmarks run from the src directory, for instance: python -m benchmarks.switched_layer
+"""
@@ -0,0 +1,212 @@
+"""
+Timing, memory measurement and regression checks for the benchmark suite.
+
+A benchmark is a setup function decorated with @benchmark, that takes the parameters of
+one case (for instance size=8, batch_size=256) and returns the function to time, and the
+number of items (steps, observations...) it processes per call.
+"""
+
+from __future__ import annotations
+
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Callable, Literal
+
+import torch
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BENCHMARKS: dict[str, Benchmark] = {}
+# Memory changes smaller than this are noise: pages of the RSS, samples missed by the sampler
+MEMORY_NOISE_MB = 1.0
+
+
+@dataclass
+class Benchmark:
+    name: str
+    kind: Literal["micro", "macro"]
+    setup: Callable[..., tuple[Callable[[], object], int]]
+    params: dict[str, tuple]
+    repeats: int | None = None
+
+    def cases(self, overrides: dict[str, tuple] | None = None) -> list[dict[str, object]]:
+        """All the combinations of parameters, with the grids given in overrides if any."""
+        grid = {name: (overrides or {}).get(name) or values for name, values in self.params.items()}
+        return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def benchmark(kind: Literal["micro", "macro"] = "micro", repeats: int | None = None, **params: tuple):
+    """Register a benchmark setup function, run over every combination of params."""
+
+    def _decorator(setup):
+        BENCHMARKS[setup.__name__] = Benchmark(setup.__name__, kind, setup, params, repeats)
+        return setup
+
+    return _decorator
+
+
+@dataclass
+class Result:
+    name: str
+    params: dict[str, object]
+    mean_ms: float
+    std_ms: float
+    repeats: int
+    items_per_s: float
+    # Peak of memory allocated during one call, measured as described by memory_method
+    peak_memory_mb: float
+    memory_method: str = "tracemalloc"
+
+    @property
+    def key(self) -> str:
+        return self.name + "".join(f"[{name}={value}]" for name, value in sorted(self.params.items()))
+
+
+def run_case(bench: Benchmark, params: dict[str, object], repeats: int = 20, min_time: float = 0.2) -> Result:
+    """Time a case at least `repeats` times and at least min_time seconds, after a warmup call."""
+    fn, items = bench.setup(**params)
+    repeats = bench.repeats or repeats
+
+    fn()  # warmup
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeats or (time.perf_counter() - start < min_time and bench.repeats is None):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+
+    peak, memory_method = measure_memory(bench, params, fn)
+
+    mean = statistics.mean(times)
+    return Result(
+        name=bench.name,
+        params=params,
+        mean_ms=mean * 1000,
+        std_ms=statistics.stdev(times) * 1000 if len(times) > 1 else 0.0,
+        repeats=len(times),
+        items_per_s=items / mean,
+        peak_memory_mb=peak / 2 ** 20,
+        memory_method=memory_method,
+    )
+
+
+def measure_memory(bench: Benchmark, params: dict[str, object], fn: Callable[[], object]) -> tuple[int, str]:
+    """
+    Peak memory of one call, in bytes, and the method used to measure it.
+
+    - tracemalloc+cuda: memory allocated by python and numpy, plus torch's cuda allocations.
+    - sampled_rss: growth of the resident memory during the first call in a fresh process,
+        sampled by a thread. It includes torch's cpu allocations, which tracemalloc does not
+        see, but can miss the peak of calls shorter than the sampling interval.
+    - tracemalloc: python and numpy only, where neither of the above is available.
+    """
+    if torch.cuda.is_available() or psutil is None:
+        # Measured on a separate call, tracing slows it down a lot
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if torch.cuda.is_available():
+            return peak + torch.cuda.max_memory_allocated(), "tracemalloc+cuda"
+        return peak, "tracemalloc"
+
+    # Memory freed by earlier calls is reused without growing the RSS, hence a new process
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        peak = pool.submit(_first_call_rss, bench.setup.__module__, bench.name, params).result()
+    return peak, "sampled_rss"
+
+
+def _first_call_rss(module: str, name: str, params: dict[str, object], interval: float = 1e-3) -> int:
+    importlib.import_module(module)  # registers the benchmark in this process
+    fn, _ = BENCHMARKS[name].setup(**params)
+    process = psutil.Process()
+    # The current RSS, not the high-water mark, which the setup has often already pushed above the call
+    before = process.memory_info().rss
+    peak = before
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not done.wait(interval):
+            peak = max(peak, process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        fn()
+        peak = max(peak, process.memory_info().rss)
+    finally:
+        done.set()
+        sampler.join()
+    return peak - before
+
+
+def machine_info() -> dict[str, object]:
+    return dict(
+        host=platform.node(),
+        platform=platform.platform(),
+        python=platform.python_version(),
+        torch=torch.__version__,
+        cpu_count=os.cpu_count(),
+        torch_threads=torch.get_num_threads(),
+    )
+
+
+def save_results(results: list[Result], path: Path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(dict(
+        machine=machine_info(),
+        time=time.strftime("%Y-%m-%d %H:%M:%S"),
+        results=[asdict(r) for r in results],
+    ), indent=2))
+
+
+def load_results(path: Path) -> list[Result]:
+    return [Result(**r) for r in json.loads(Path(path).read_text())["results"]]
+
+
+@dataclass
+class Comparison:
+    result: Result
+    baseline: Result
+    # Relative slowdown: 0.1 means 10% slower than the baseline
+    slowdown: float = field(init=False)
+    # Relative growth of the peak memory, None when the two were measured differently
+    memory_growth: float | None = field(init=False)
+
+    def __post_init__(self):
+        self.slowdown = self.result.mean_ms / self.baseline.mean_ms - 1
+        if self.result.memory_method != self.baseline.memory_method:
+            self.memory_growth = None
+        elif abs(self.result.peak_memory_mb - self.baseline.peak_memory_mb) < MEMORY_NOISE_MB:
+            self.memory_growth = 0.0
+        else:
+            self.memory_growth = (self.result.peak_memory_mb - self.baseline.peak_memory_mb) / max(
+                self.baseline.peak_memory_mb, MEMORY_NOISE_MB)
+
+    def regressed(self, threshold: float) -> bool:
+        """Whether the result is slower, or uses more memory, than the baseline by more than threshold."""
+        return self.slowdown > threshold or (self.memory_growth or 0.0) > threshold
+
+
+def compare(results: list[Result], baseline: list[Result]) -> list[Comparison]:
+    """Pair the results with the baseline results of the same benchmark and parameters."""
+    by_key = {r.key: r for r in baseline}
+    return [Comparison(r, by_key[r.key]) for r in results if r.key in by_key]
@@ -0,0 +1,169 @@
+"""
+Micro and macro benchmarks of the environments, wrappers, policy and PPO training.
+
+Run them with the bench command of train.py, for instance from src/:
+    python train.py bench --filter env_ --sizes 4,8
+    python train.py bench --kind micro --baseline ../benchmark_results/baseline.json --threshold 0.1
+
+Results are written as json, to benchmark_results/latest.json by default.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+import torch
+from stable_baselines3 import PPO
+from stable_baselines3.common.env_util import make_vec_env
+from torch import nn
+
+from architectures import CustomActorCriticPolicy, Rearrange, Split
+from batched_envs import HAS_NUMBA, BatchedGridEnv
+from benchmarks.harness import benchmark
+from environments import ThreeGoalsEnv, ThreeGoalsStates
+from utils import make_stats
+from wrappers import AddTrueGoalToObsFlat, ColorBlindWrapper, observe_states
+
+SIZES = (4, 8, 16, 32, 64)
+BATCH_SIZES = (1, 16, 256, 4096)
+N_STEPS = 1_000
+N_BATCHED_STEPS = 100
+BATCHED_BACKENDS = ("numpy", "numba") if HAS_NUMBA else ("numpy",)
+
+
+def make_env(size: int, wrapped: bool = True):
+    """ThreeGoalsEnv, with the wrappers of the BlindThreeGoals experiment."""
+    env = ThreeGoalsEnv(size, step_reward=0.0)
+    if wrapped:
+        env = ColorBlindWrapper(env, reduction='max', reward_indistinguishable_goals=True)
+        env = AddTrueGoalToObsFlat(env)
+    return env
+
+
+def make_arch(size: int) -> nn.Module:
+    """The architecture of the BlindThreeGoals experiment."""
+    return nn.Sequential(
+        Split(
+            -3,
+            left=nn.Sequential(
+                Rearrange("... (h w c) -> ... c h w", h=size, w=size),
+                nn.LazyConv2d(8, 3, padding=1),
+                nn.ReLU(),
+                nn.Conv2d(8, 8, 3, padding=1),
+                nn.ReLU(),
+                nn.Flatten(-3),
+            ),
+            right=nn.Identity(),
+        ),
+        nn.LazyLinear(32),
+        nn.ReLU(),
+        nn.Linear(32, 32),
+        nn.ReLU(),
+    )
+
+
+def make_policy(size: int) -> CustomActorCriticPolicy:
+    env = make_env(size)
+    return CustomActorCriticPolicy(env.observation_space, env.action_space, lambda _: 1e-3,
+                                   arch=make_arch(size))
+
+
+def make_obs(size: int, batch_size: int) -> torch.Tensor:
+    states = ThreeGoalsStates.sample(size, batch_size, seed=0)
+    return torch.as_tensor(observe_states(make_env(size), states)).float()
+
+
+def _run_steps(env, n_steps: int):
+    actions = np.random.default_rng(0).integers(4, size=n_steps)
+    env.reset(seed=0)
+
+    def run():
+        for action in actions:
+            _, _, terminated, truncated, _ = env.step(action)
+            if terminated or truncated:
+                env.reset()
+
+    return run, n_steps
+
+
+@benchmark(size=SIZES)
+def env_step(size: int):
+    """Steps of the raw ThreeGoalsEnv, with resets at the end of episodes."""
+    return _run_steps(make_env(size, wrapped=False), N_STEPS)
+
+
+@benchmark(size=SIZES)
+def wrapped_env_step(size: int):
+    """Steps of ThreeGoalsEnv seen through the wrappers of BlindThreeGoals."""
+    return _run_steps(make_env(size), N_STEPS)
+
+
+@benchmark(size=SIZES, batch_size=BATCH_SIZES, backend=BATCHED_BACKENDS)
+def batched_env_step(size: int, batch_size: int, backend: str):
+    """Steps of BatchedGridEnv with auto resets, counted per environment."""
+    env = BatchedGridEnv(make_env(size, wrapped=False), batch_size, seed=0, backend=backend)
+    env.reset()
+    actions = np.random.default_rng(0).integers(4, size=(N_BATCHED_STEPS, batch_size))
+
+    def run():
+        for action in actions:
+            env.step(action)
+
+    return run, N_BATCHED_STEPS * batch_size
+
+
+@benchmark(size=SIZES)
+def env_reset(size: int):
+    env = make_env(size)
+    return env.reset, 1
+
+
+@benchmark(size=SIZES)
+def render(size: int):
+    env = make_env(size)
+    env.reset(seed=0)
+    return env.render, 1
+
+
+@benchmark(size=SIZES, batch_size=BATCH_SIZES)
+def policy_forward(size: int, batch_size: int):
+    """Actions, values and log probs of a batch of observations, without gradients."""
+    policy = make_policy(size)
+    obs = make_obs(size, batch_size)
+
+    @torch.no_grad()
+    def run():
+        policy(obs)
+
+    return run, batch_size
+
+
+@benchmark(size=SIZES, batch_size=BATCH_SIZES)
+def policy_backward(size: int, batch_size: int):
+    """Forward and backward pass of a PPO-like loss on a batch of observations."""
+    policy = make_policy(size)
+    obs = make_obs(size, batch_size)
+    actions = torch.randint(4, (batch_size,))
+
+    def run():
+        policy.zero_grad()
+        values, log_prob, entropy = policy.evaluate_actions(obs, actions)
+        (values.mean() - log_prob.mean() - entropy.mean()).backward()
+
+    return run, batch_size
+
+
+@benchmark("macro", repeats=3, size=SIZES)
+def stats(size: int):
+    """make_stats over 100 episodes."""
+    policy = make_policy(size)
+    env = make_env(size)
+    return lambda: make_stats(policy, env, n_episodes=100, plot=False), 100
+
+
+@benchmark("macro", repeats=3, size=SIZES)
+def ppo_iteration(size: int):
+    """One PPO rollout of 2048 steps on 4 envs, and the update that follows."""
+    model = PPO(CustomActorCriticPolicy, make_vec_env(lambda: make_env(size), n_envs=4),
+                policy_kwargs=dict(arch=make_arch(size)), n_steps=512, seed=0, device='cpu')
+    rollout_size = model.n_steps * model.n_envs
+    return lambda: model.learn(rollout_size, reset_num_timesteps=False), rollout_size
@@ -0,0 +1,89 @@
+"""
+Benchmark the execution modes of SwitchedLayer, for n_switches from 2 to 64.
+
+Usage (from src/): python -m benchmarks.switched_layer
+"""
+
+from __future__ import annotations
+
+import time
+
+import click
+import rich
+import rich.table
+import torch
+from torch import nn
+
+from architectures import SwitchedLayer
+
+N_SWITCHES = (2, 4, 8, 16, 32, 64)
+
+
+def make_layers(kind: str, n_switches: int) -> tuple[dict[str, SwitchedLayer], tuple[int, ...]]:
+    """Return the same switched layer in every mode, and the shape of one input."""
+    if kind == "linear":
+        layer, input_shape = nn.Linear(256, 256), (256,)
+    elif kind == "conv":
+        layer, input_shape = nn.Conv2d(8, 8, 3, padding=1), (8, 16, 16)
+    else:
+        raise ValueError(f"Unknown layer kind {kind}")
+
+    dense = SwitchedLayer(layer, n_switches, mode="dense")
+    for copy_ in dense:
+        copy_.reset_parameters()
+    layers = {"dense": dense}
+    for mode in ("grouped", "batched"):
+        layers[mode] = SwitchedLayer(layer, n_switches, mode=mode)
+        layers[mode].load_state_dict(dense.state_dict())
+    return layers, input_shape
+
+
+def check_equivalence(layers: dict[str, SwitchedLayer], x: torch.Tensor, switch: torch.Tensor):
+    """Check that all modes give the same outputs and gradients as the dense mode."""
+    results = {}
+    for mode, layer in layers.items():
+        layer.zero_grad()
+        x_ = x.clone().requires_grad_()
+        out = layer(x_, switch)
+        out.square().sum().backward()
+        results[mode] = (out, x_.grad, [p.grad for p in layer.parameters()])
+
+    reference = results["dense"]
+    for mode, (out, x_grad, param_grads) in results.items():
+        assert torch.allclose(out, reference[0], atol=1e-5), f"{mode}: outputs differ"
+        assert torch.allclose(x_grad, reference[1], atol=1e-4), f"{mode}: input gradients differ"
+        for grad, ref in zip(param_grads, reference[2]):
+            assert torch.allclose(grad, ref, atol=1e-3), f"{mode}: parameter gradients differ"
+
+
+def time_forward_backward(layer: SwitchedLayer, x: torch.Tensor, switch: torch.Tensor,
+                          repeats: int) -> float:
+    """Return the mean time of a forward and backward pass, in milliseconds."""
+    x = x.clone().requires_grad_()
+    layer(x, switch).sum().backward()  # warmup
+    start = time.perf_counter()
+    for _ in range(repeats):
+        layer(x, switch).sum().backward()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+@click.command()
+@click.option("--kind", type=click.Choice(["linear", "conv"]), default="linear", show_default=True)
+@click.option("--batch-size", default=1024, show_default=True)
+@click.option("--repeats", default=10, show_default=True)
+def main(kind: str, batch_size: int, repeats: int):
+    """Benchmark the execution modes of SwitchedLayer."""
+    table = rich.table.Table("n_switches", "dense (ms)", "grouped (ms)", "batched (ms)",
+                             title=f"SwitchedLayer {kind}, batch size {batch_size}, forward + backward")
+    for n_switches in N_SWITCHES:
+        layers, input_shape = make_layers(kind, n_switches)
+        x = torch.randn(batch_size, *input_shape)
+        switch = torch.randint(n_switches, (batch_size,))
+        check_equivalence(layers, x, switch)
+        times = [time_forward_backward(layer, x, switch, repeats) for layer in layers.values()]
+        table.add_row(str(n_switches), *[f"{t:.2f}" for t in times])
+    rich.print(table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Distill a deterministic policy into a lookup table over all its observations.
+
+On small ThreeGoalsEnv grids, the blind wrappers only ever produce tens of thousands of
+different observations, so a greedy policy is a finite table. Once distilled, predicting
+is a binary search in a sorted array of packed observations, and never calls the network.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+
+import gymnasium as gym
+import numpy as np
+from jaxtyping import Int
+
+import environments
+import utils
+import wrappers
+
+__all__ = [
+    "TabularPolicy",
+    "distill_policy",
+]
+
+
+def _pack(obs: np.ndarray, n_rows: int) -> np.ndarray:
+    """View each observation as one opaque key, made of its float32 bytes."""
+    rows = np.ascontiguousarray(np.asarray(obs, dtype=np.float32).reshape(n_rows, -1))
+    return rows.view(np.dtype((np.void, rows.shape[1] * rows.itemsize))).ravel()
+
+
+@dataclass
+class TabularPolicy:
+    """
+    A greedy policy stored as a table from packed observations to actions.
+
+    keys are sorted, so that lookups are a vectorized binary search.
+    Observations missing from the table go to the fallback policy, or raise a KeyError.
+    """
+
+    keys: np.ndarray
+    actions: Int[np.ndarray, "key"]
+    obs_shape: tuple[int, ...]
+    fallback: object = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, obs: np.ndarray) -> np.ndarray:
+        """Return the actions for a batch of observations."""
+        obs = np.asarray(obs)
+        keys = _pack(obs, len(obs))
+        idx = np.searchsorted(self.keys, keys)
+        idx[idx == len(self.keys)] = 0
+        found = self.keys[idx] == keys
+        actions = self.actions[idx]
+        if not found.all():
+            if self.fallback is None:
+                raise KeyError(f"{(~found).sum()} observations are not in the table, "
+                               f"the first is {obs[~found][0]}")
+            actions[~found] = utils.predict_batch(self.fallback, obs[~found])
+        return actions
+
+    def predict(self, obs, state=None, episode_start=None, deterministic: bool = True):
+        """Same interface as SB3's predict. The policy is always deterministic."""
+        obs = np.asarray(obs)
+        if obs.shape == self.obs_shape:
+            return int(self.lookup(obs[None])[0]), state
+        return self.lookup(obs), state
+
+    def save(self, path: str | Path):
+        keys = self.keys.view(np.uint8).reshape(len(self.keys), -1)
+        np.savez_compressed(path, keys=keys, actions=self.actions, obs_shape=np.array(self.obs_shape))
+
+    @classmethod
+    def load(cls, path: str | Path, fallback=None) -> TabularPolicy:
+        with np.load(path) as data:
+            keys = np.ascontiguousarray(data["keys"])
+            return cls(keys.view(np.dtype((np.void, keys.shape[1]))).ravel(), data["actions"],
+                       tuple(data["obs_shape"].tolist()), fallback)
+
+
+def distill_policy(policy, env: gym.Env, batch_size: int = 8192, check: bool = True) -> TabularPolicy:
+    """
+    Build the table of the greedy actions of policy, for every state of the wrapped ThreeGoalsEnv.
+
+    Every placement of the agent and goals is enumerated for each true goal, rendered
+    through the wrappers of env, and the network is run once per batch on the distinct observations.
+    With check, the table is verified to give the same action as the policy on every state.
+    """
+    size = env.unwrapped.width
+    states = environments.ThreeGoalsStates.enumerate(size)
+    obs = wrappers.observe_states(env, states)
+
+    keys = _pack(obs, len(obs))
+    keys, first = np.unique(keys, return_index=True)
+    actions = utils.predict_batch(policy, obs[first], batch_size).astype(np.int8)
+    table = TabularPolicy(keys, actions, obs.shape[1:])
+
+    if check:
+        expected = utils.predict_batch(policy, obs, batch_size)
+        mismatch = np.flatnonzero(table.lookup(obs) != expected)
+        assert len(mismatch) == 0, \
+            f"The table differs from the policy on {len(mismatch)} states, e.g. {states[mismatch[:5]]}"
+
+    return table
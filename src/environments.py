@@ -1,12 +1,14 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import itertools
+from dataclasses import dataclass, field
 from enum import IntEnum
 from random import choice, sample
 from typing import SupportsFloat, Any, Literal
 
 import gymnasium as gym
 import numpy as np
+from jaxtyping import Int, Bool, Float
 import plotly.express as px
 import pygame
 import pygame.gfxdraw
@@ -20,6 +22,7 @@ __all__ = [
     "GridEnv",
     "ThreeGoalsEnv",
     "RandomGoalEnv",
+    "ThreeGoalsStates",
 ]
 
 
@@ -68,22 +71,36 @@ class GridEnv(gym.Env[gym.spaces.MultiDiscrete, gym.spaces.Discrete]):
             height: int,
             max_steps: int | None = None,
             step_reward: float = None,
+            obs_mode: Literal["grid", "tokens"] = "grid",
     ):
         self.width = width
         self.height = height
         self.agent_start = agent_start
+        self.obs_mode = obs_mode
         self.max_steps = max_steps if max_steps is not None else width * height
         self.step_reward = step_reward if step_reward is not None else -1 / self.max_steps
 
-        self.steps = 0
-        self.agent_pos: tuple[int, int] = (-1, -1)
         assert self.ALL_CELLS[0] is self.EMPTY_CELL, self.ALL_CELLS
         assert self.ALL_CELLS[1] is self.AGENT_CELL, self.ALL_CELLS
+        self._build_tables()
+
+        self.steps = 0
+        self.agent_pos = (-1, -1)
         self.grid = np.zeros((self.width, self.height), dtype="int8")
         self.make_grid()
 
         self.action_space = gym.spaces.Discrete(len(self.Actions))
-        self.observation_space = gym.spaces.MultiDiscrete([[len(self.ALL_CELLS)] * width] * height)
+        if obs_mode == "grid":
+            self.observation_space = gym.spaces.MultiDiscrete([[len(self.ALL_CELLS)] * width] * height)
+        elif obs_mode == "tokens":
+            # One token per object placed by make_grid
+            self.n_tokens = len(self.spawn_weights())
+            assert self.n_tokens == 1 + len(self.object_cells), \
+                f"{self.__class__.__name__}.spawn_weights() does not match the objects placed by make_grid"
+            self.observation_space = gym.spaces.MultiDiscrete(
+                [[len(self.ALL_CELLS), width, height]] * self.n_tokens)
+        else:
+            raise ValueError(f"Invalid obs_mode: {obs_mode}")
         self.reward_range = -1, 1
 
         self.last_reward = None  # Used for rendering
@@ -95,15 +112,73 @@ class GridEnv(gym.Env[gym.spaces.MultiDiscrete, gym.spaces.Discrete]):
 
     __str__ = __repr__
 
+    @property
+    def grid(self) -> Int[np.ndarray, "width height"]:
+        return self._grid
+
+    @grid.setter
+    def grid(self, grid: Int[np.ndarray, "width height"]):
+        self._grid = np.ascontiguousarray(grid)
+        # Flat view of the grid, indexed by x * height + y
+        self.flat_grid = self._grid.reshape(-1)
+
+    def __getstate__(self):
+        # Pickle and deepcopy would copy flat_grid as an array independent of the grid
+        state = self.__dict__.copy()
+        del state["flat_grid"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.grid = self._grid
+
+    def _build_tables(self):
+        """Precompute the moves between flat cell indices and the properties of each cell type."""
+        n_cells = self.width * self.height
+        self.positions: list[Pos] = [(x, y) for x in range(self.width) for y in range(self.height)]
+
+        # neighbors[cell, action] is the cell the agent moves to, or cell itself if it would leave the grid
+        pos = np.array(self.positions).reshape(n_cells, 1, 2)
+        moved = pos + np.array(self.DIR_TO_VEC)
+        in_bounds = np.all((moved >= 0) & (moved < (self.width, self.height)), axis=-1)
+        self.neighbors = np.where(in_bounds, moved[..., 0] * self.height + moved[..., 1],
+                                  np.arange(n_cells)[:, None])
+        self._neighbors = self.neighbors.tolist()
+
+        # Lists, as they are faster than arrays to index with single ints
+        self.cell_can_overlap = [cell.can_overlap for cell in self.ALL_CELLS]
+        self.cell_reward = [cell.reward for cell in self.ALL_CELLS]
+        self.cell_terminates = [cell.terminates for cell in self.ALL_CELLS]
+        self.cell_manual = [cell.manual for cell in self.ALL_CELLS]
+        self._cell_index = {id(cell): i for i, cell in enumerate(self.ALL_CELLS)}
+
+    @property
+    def agent_pos(self) -> tuple[int, int]:
+        return self.positions[self.agent_idx] if self.agent_idx >= 0 else (-1, -1)
+
+    @agent_pos.setter
+    def agent_pos(self, pos: tuple[int, int]):
+        x, y = pos
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.agent_idx = int(x) * self.height + int(y)
+        else:
+            self.agent_idx = -1
+
     def __getitem__(self, item: tuple[int, int]):
         obj = self.grid[item[0], item[1]]
         return self.ALL_CELLS[obj]
 
     def __setitem__(self, item: tuple[int, int], value: Cell):
-        self.grid[item[0], item[1]] = self.ALL_CELLS.index(value)
+        index = self._cell_index.get(id(value))
+        if index is None:
+            index = self.ALL_CELLS.index(value)
+        self.grid[item[0], item[1]] = index
 
     def make_grid(self):
         self.grid.fill(0)
+        # The objects other than the agent, kept up to date to build tokens without scanning the grid
+        self.object_types: list[int] = []
+        self.object_cells: list[int] = []
         self.place_agent(self.agent_start)
 
     def place_agent(self, pos_distribution: Distribution[Pos] | None = None):
@@ -130,8 +205,18 @@ class GridEnv(gym.Env[gym.spaces.MultiDiscrete, gym.spaces.Discrete]):
             pos = sample_distribution({p: w for p, w in pos_distribution.items() if self[p] is self.EMPTY_CELL})
 
         self[pos] = obj
+        if obj is not self.AGENT_CELL:
+            cell = pos[0] * self.height + pos[1]
+            self._remove_object(cell)
+            self.object_types.append(int(self.flat_grid[cell]))
+            self.object_cells.append(cell)
         return pos
 
+    def _remove_object(self, cell: int):
+        if cell in self.object_cells:
+            i = self.object_cells.index(cell)
+            del self.object_types[i], self.object_cells[i]
+
     def reset(
             self,
             *,
@@ -143,10 +228,11 @@ class GridEnv(gym.Env[gym.spaces.MultiDiscrete, gym.spaces.Discrete]):
         self.agent_pos = -1, -1
         self.make_grid()
         self.last_reward = None
-        return self.grid, {}
+        return self.observation(), {}
 
     def step(self, action: ActType) -> tuple[ObsType, SupportsFloat, bool, bool, dict[str, Any]]:
-        new_pos = tuple(self.agent_pos + self.DIR_TO_VEC[action])
+        idx = self.agent_idx
+        new_idx = self._neighbors[idx][action]
 
         reward = self.step_reward
         terminated = False
@@ -154,38 +240,84 @@ class GridEnv(gym.Env[gym.spaces.MultiDiscrete, gym.spaces.Discrete]):
         can_move = True
 
         # If out of bounds, don't move
-        if not (0 <= new_pos[0] < self.width and 0 <= new_pos[1] < self.height):
+        if new_idx == idx:
             can_move = False
 
-        # Handle empty cells
-        elif self.grid[new_pos] == 0:
-            pass
-
         # Handle objects
-        else:
-            obj = self[new_pos]
-            if obj.manual:
-                can_move, reward, terminated = self.handle_object(obj)
+        elif obj := int(self.flat_grid[new_idx]):
+            if self.cell_manual[obj]:
+                can_move, reward, terminated = self.handle_object(self.ALL_CELLS[obj])
             else:
-                can_move = obj.can_overlap
-                reward = obj.reward
-                terminated = obj.terminates
+                can_move = self.cell_can_overlap[obj]
+                reward = self.cell_reward[obj]
+                terminated = self.cell_terminates[obj]
 
         if can_move:
-            self[self.agent_pos] = self.EMPTY_CELL
-            self.agent_pos = new_pos
-            self[self.agent_pos] = self.AGENT_CELL
+            if obj:
+                # The agent hides the object it moves onto
+                self._remove_object(new_idx)
+            self.flat_grid[idx] = 0  # empty cell
+            self.flat_grid[new_idx] = 1  # agent
+            self.agent_idx = new_idx
 
         self.steps += 1
         if self.steps >= self.max_steps:
             truncated = True
 
         self.last_reward = reward
-        return self.grid, reward, terminated, truncated, {}
+        return self.observation(), reward, terminated, truncated, {}
 
     def handle_object(self, obj: Cell) -> tuple[bool, float, bool]:
         """Returns (can_move, reward, terminated)"""
 
+    def observation(self) -> np.ndarray:
+        """
+        The grid, or in tokens mode, the (cell type, x, y) of each object, sorted by type
+        then cell. Objects hidden by the agent are replaced by (0, 0, 0) tokens at the end.
+        """
+        if self.obs_mode == "grid":
+            return self.grid
+        # Built from the objects, so that its cost does not depend on the size of the grid
+        tokens = np.zeros((self.n_tokens, 3), dtype=np.int64)
+        objects = [(1, self.agent_idx), *sorted(zip(self.object_types, self.object_cells))]
+        for i, (cell_type, cell) in enumerate(objects):
+            tokens[i] = cell_type, cell // self.height, cell % self.height
+        return tokens
+
+    # Batched environments (see batched_envs.py)
+
+    def distribution_weights(self, distribution: Distribution[Pos] | None) -> Float[np.ndarray, "cells"]:
+        """Return the weight of each flat cell (x * height + y) in a position distribution."""
+        weights = np.zeros(self.width * self.height)
+        if distribution is None:
+            weights[:] = 1
+        elif isinstance(distribution, tuple):
+            weights[distribution[0] * self.height + distribution[1]] = 1
+        else:
+            for (x, y), weight in distribution.items():
+                weights[x * self.height + y] = weight
+        return weights
+
+    def spawn_weights(self) -> list[tuple[int, Float[np.ndarray, "cells"]]]:
+        """
+        Return the objects placed by make_grid, in order, as (cell type, weight of each flat cell).
+
+        Each object is placed on an empty cell, with probability proportional to its weight.
+        The agent is always the first object.
+        """
+        return [(1, self.distribution_weights(self.agent_start))]
+
+    def batch_rules(self, n: int, rng: np.random.Generator) -> tuple[
+        Float[np.ndarray, "n cell_type"], Bool[np.ndarray, "n cell_type"], dict[str, np.ndarray]]:
+        """
+        Return the reward and termination of moving onto each cell type, for n new episodes,
+        and any per-episode variable. Environments with manual cells must override it.
+        """
+        assert not any(self.cell_manual), f"{self.__class__.__name__} has manual cells but no batch_rules"
+        reward = np.tile(np.array(self.cell_reward, dtype=np.float32), (n, 1))
+        terminates = np.tile(np.array(self.cell_terminates), (n, 1))
+        return reward, terminates, {}
+
     def render(self, resolution: int = 32, plot: bool = False) -> RenderFrame:
         # Draw borders
         full_img = pygame.Surface(((self.width + 1) * resolution, (self.height + 1) * resolution))
@@ -268,7 +400,8 @@ class GridEnv(gym.Env[gym.spaces.MultiDiscrete, gym.spaces.Discrete]):
 class RandomGoalEnv(GridEnv):
     ALL_CELLS = GridEnv.ALL_CELLS + [GridEnv.GOAL_CELL]
 
-    def __init__(self, size: int = 5, br_freq: float | None = None):
+    def __init__(self, size: int = 5, br_freq: float | None = None,
+                 obs_mode: Literal["grid", "tokens"] = "grid"):
         self.br_freq = br_freq
 
         self.goal_distribution = uniform_distribution((size, size))
@@ -280,12 +413,18 @@ class RandomGoalEnv(GridEnv):
             agent_start=None,
             width=size,
             height=size,
+            obs_mode=obs_mode,
         )
 
     def make_grid(self):
         super().make_grid()
         self.goal_pos = self.place_obj(self.GOAL_CELL, self.goal_distribution)
 
+    def spawn_weights(self) -> list[tuple[int, Float[np.ndarray, "cells"]]]:
+        return super().spawn_weights() + [
+            (self.ALL_CELLS.index(self.GOAL_CELL), self.distribution_weights(self.goal_distribution))
+        ]
+
 
 class ThreeGoalsEnv(GridEnv):
     GOAL_RED = Cell("r", "#FF0000", manual=True)
@@ -308,6 +447,7 @@ class ThreeGoalsEnv(GridEnv):
                  green_pos: Distribution[Pos] | None = None,
                  blue_pos: Distribution[Pos] | None = None,
                  step_reward: float = None,
+                 obs_mode: Literal["grid", "tokens"] = "grid",
                  ):
         self.red_pos_dist = red_pos
         self.green_pos_dist = green_pos
@@ -319,7 +459,8 @@ class ThreeGoalsEnv(GridEnv):
 
         super().__init__(agent_pos, size, size,
                          max_steps=3 * size,
-                         step_reward=step_reward)
+                         step_reward=step_reward,
+                         obs_mode=obs_mode)
 
     @property
     def true_goal(self) -> Cell:
@@ -352,6 +493,28 @@ class ThreeGoalsEnv(GridEnv):
         else:
             return True, 0, True
 
+    def spawn_weights(self) -> list[tuple[int, Float[np.ndarray, "cells"]]]:
+        goal_distributions = [self.red_pos_dist, self.green_pos_dist, self.blue_pos_dist]
+        return super().spawn_weights() + [
+            (self.ALL_CELLS.index(goal), self.distribution_weights(dist))
+            for goal, dist in zip(self.GOAL_CELLS, goal_distributions)
+        ]
+
+    def batch_rules(self, n: int, rng: np.random.Generator) -> tuple[
+        Float[np.ndarray, "n cell_type"], Bool[np.ndarray, "n cell_type"], dict[str, np.ndarray]]:
+        if self.true_goal_init is None:
+            true_goal = rng.integers(len(self.GOAL_CELLS), size=n)
+        else:
+            true_goal = np.full(n, ["red", "green", "blue"].index(self.true_goal_init))
+
+        goal_types = np.array([self.ALL_CELLS.index(goal) for goal in self.GOAL_CELLS])
+        reward = np.zeros((n, len(self.ALL_CELLS)), dtype=np.float32)
+        reward[np.arange(n), goal_types[true_goal]] = 1
+        # Like handle_object: every goal ends the episode
+        terminates = np.zeros((n, len(self.ALL_CELLS)), dtype=bool)
+        terminates[:, goal_types] = True
+        return reward, terminates, dict(true_goal=true_goal)
+
     def render_extra(self, img: pygame.Surface, resolution: int):
         # Add a star on the true goal
         x, y = self.goal_positions[self.true_goal_idx]
@@ -398,3 +561,161 @@ class ThreeGoalsEnv(GridEnv):
             for wrapper in wrappers:
                 envs = [wrapper(env) for env in envs]
         return envs
+
+
+@dataclass
+class ThreeGoalsStates:
+    """
+    A batch of states of ThreeGoalsEnv, stored as arrays.
+
+    This is used to enumerate, render and step many environments at once,
+    without creating an env for each of them. Positions are (x, y).
+    """
+
+    size: int
+    agent_pos: Int[np.ndarray, "batch 2"]
+    goal_positions: Int[np.ndarray, "batch goal=3 2"]
+    true_goal: Int[np.ndarray, "batch"]
+    steps: Int[np.ndarray, "batch"] = None
+    done: Bool[np.ndarray, "batch"] = None
+    step_reward: float = 0.0
+    max_steps: int = field(init=False)
+
+    def __post_init__(self):
+        self.max_steps = 3 * self.size
+        if self.steps is None:
+            self.steps = np.zeros(len(self.agent_pos), dtype=np.int64)
+        if self.done is None:
+            self.done = np.zeros(len(self.agent_pos), dtype=bool)
+
+    def __len__(self):
+        return len(self.agent_pos)
+
+    def __getitem__(self, idx) -> ThreeGoalsStates:
+        return ThreeGoalsStates(self.size, self.agent_pos[idx], self.goal_positions[idx],
+                                self.true_goal[idx], self.steps[idx], self.done[idx], self.step_reward)
+
+    def copy(self) -> ThreeGoalsStates:
+        return self[np.arange(len(self))]
+
+    # All the ways to assign the three goal positions to the colours
+    PERMUTATIONS = np.array(list(itertools.permutations(range(3))))
+
+    def counterfactuals(self) -> ThreeGoalsStates:
+        """
+        Return each state under every true goal and every permutation of its goal positions.
+
+        The variant with true goal g and colours permuted by PERMUTATIONS[p] (the goal of colour c
+        is at the position of goal PERMUTATIONS[p, c]) is at index (i * 3 + g) * 6 + p.
+        """
+        n_goals, n_perms = self.goal_positions.shape[1], len(self.PERMUTATIONS)
+        idx = np.repeat(np.arange(len(self)), n_goals * n_perms)
+        variants = self[idx]
+        perms = np.tile(self.PERMUTATIONS, (len(self) * n_goals, 1))
+        variants.goal_positions = np.take_along_axis(variants.goal_positions, perms[..., None], axis=1)
+        variants.true_goal = np.tile(np.repeat(np.arange(n_goals), n_perms), len(self))
+        return variants
+
+    @classmethod
+    def from_cells(cls, size: int, cells: Int[np.ndarray, "batch 4"], true_goal: Int[np.ndarray, "batch"],
+                   step_reward: float = 0.0) -> ThreeGoalsStates:
+        """Create states from the flat index (x * size + y) of the agent, red, green and blue goals."""
+        positions = np.stack([cells // size, cells % size], axis=-1)
+        return cls(size, positions[:, 0], positions[:, 1:], np.asarray(true_goal), step_reward=step_reward)
+
+    @classmethod
+    def enumerate(cls, size: int = 4, step_reward: float = 0.0) -> ThreeGoalsStates:
+        """Return every initial state: all placements of the agent and goals, for each true goal."""
+        cells = np.array(list(itertools.permutations(range(size * size), 4)))
+        n_goals = len(ThreeGoalsEnv.GOAL_CELLS)
+        return cls.from_cells(size,
+                              np.repeat(cells, n_goals, axis=0),
+                              np.tile(np.arange(n_goals), len(cells)),
+                              step_reward)
+
+    @classmethod
+    def sample(cls, size: int, n: int, seed: int | None = None, step_reward: float = 0.0) -> ThreeGoalsStates:
+        """Sample n initial states uniformly, as ThreeGoalsEnv(size, step_reward=step_reward).reset() would."""
+        rng = np.random.default_rng(seed)
+        # The 4 cells with the smallest random keys are a uniform sample without replacement,
+        # and sorting them by key gives them a uniform order
+        keys = rng.random((n, size * size))
+        cells = np.argpartition(keys, 3, axis=1)[:, :4]
+        cells = np.take_along_axis(cells, np.argsort(np.take_along_axis(keys, cells, axis=1), axis=1), axis=1)
+        true_goal = rng.integers(len(ThreeGoalsEnv.GOAL_CELLS), size=n)
+        return cls.from_cells(size, cells, true_goal, step_reward)
+
+    @classmethod
+    def from_envs(cls, envs: list[gym.Env]) -> ThreeGoalsStates:
+        """Gather the current states of ThreeGoalsEnvs (possibly wrapped)."""
+        unwrapped: list[ThreeGoalsEnv] = [env.unwrapped for env in envs]
+        return cls(
+            unwrapped[0].width,
+            np.array([env.agent_pos for env in unwrapped]),
+            np.array([env.goal_positions for env in unwrapped]),
+            np.array([env.true_goal_idx for env in unwrapped]),
+            np.array([env.steps for env in unwrapped]),
+            step_reward=unwrapped[0].step_reward,
+        )
+
+    def to_env(self, idx: int) -> ThreeGoalsEnv:
+        """Return an environment that always resets to the given state."""
+        red, green, blue = map(tuple, self.goal_positions[idx].tolist())
+        # noinspection PyTypeChecker
+        return ThreeGoalsEnv(self.size,
+                             true_goal=["red", "green", "blue"][self.true_goal[idx]],
+                             agent_pos=tuple(self.agent_pos[idx].tolist()),
+                             red_pos=red, green_pos=green, blue_pos=blue,
+                             step_reward=self.step_reward)
+
+    def grids(self) -> Int[np.ndarray, "batch width height"]:
+        """Return the grids, as ThreeGoalsEnv.grid would be."""
+        batch = np.arange(len(self))
+        grids = np.zeros((len(self), self.size, self.size), dtype="int8")
+        for goal in range(self.goal_positions.shape[1]):
+            grids[batch, self.goal_positions[:, goal, 0], self.goal_positions[:, goal, 1]] = 2 + goal
+        # The agent is drawn last, it hides the goal it ended on.
+        grids[batch, self.agent_pos[:, 0], self.agent_pos[:, 1]] = 1
+        return grids
+
+    def tokens(self) -> Int[np.ndarray, "batch token=4 3"]:
+        """Return the observations of ThreeGoalsEnv in tokens mode, as ThreeGoalsEnv.observation() would."""
+        positions = np.concatenate([self.agent_pos[:, None], self.goal_positions], axis=1)
+        types = np.broadcast_to(np.arange(1, positions.shape[1] + 1), positions.shape[:2])
+        tokens = np.concatenate([types[..., None], positions], axis=-1).astype(np.int64)
+        # The agent hides the goal it is on, as in grids()
+        hidden = np.zeros(positions.shape[:2], dtype=bool)
+        hidden[:, 1:] = np.all(self.goal_positions == self.agent_pos[:, None], axis=-1)
+        tokens[hidden] = 0
+        # The types are already sorted, only the hidden goals move to the end
+        order = np.argsort(hidden, axis=1, kind="stable")
+        return np.take_along_axis(tokens, order[..., None], axis=1)
+
+    @property
+    def end_goal(self) -> Int[np.ndarray, "batch"]:
+        """Index of the goal the agent is on, or 3 if it is on no goal."""
+        on_goal = np.all(self.agent_pos[:, None] == self.goal_positions, axis=-1)
+        return np.where(on_goal.any(-1), on_goal.argmax(-1), 3)
+
+    def step(self, actions: Int[np.ndarray, "batch"]) -> tuple[
+        Float[np.ndarray, "batch"], Bool[np.ndarray, "batch"], Bool[np.ndarray, "batch"]]:
+        """Step all the states that are not done yet, in place.
+
+        Returns (reward, terminated, truncated), which are 0/False for states that were already done.
+        """
+        active = ~self.done
+        moves = np.array([vec for vec in GridEnv.DIR_TO_VEC])[actions]
+        new_pos = np.clip(self.agent_pos + moves, 0, self.size - 1)
+        self.agent_pos = np.where(active[:, None], new_pos, self.agent_pos)
+
+        on_goal = np.all(self.agent_pos[:, None] == self.goal_positions, axis=-1) & active[:, None]
+        terminated = on_goal.any(-1)
+        reward = np.where(terminated,
+                          on_goal[np.arange(len(self)), self.true_goal].astype(float),
+                          self.step_reward)
+        reward = np.where(active, reward, 0.0)
+
+        self.steps = self.steps + active
+        truncated = active & (self.steps >= self.max_steps)
+        self.done = self.done | terminated | truncated
+        return reward, terminated, truncated
@@ -0,0 +1,371 @@
+"""
+Append-only columnar logs of episodes, for offline analysis.
+
+A log is a directory with one raw binary file per column. Rows are buffered
+in memory and appended to the files by chunks, and the reader opens each
+column as a memory map, so that logs larger than RAM can be filtered and sliced.
+
+    log/
+        meta.json               # dtype and shape of each column
+        steps/obs.bin           # one row per step
+        steps/action.bin
+        ...
+        episodes/start.bin      # one row per episode
+        episodes/end_goal.bin
+        ...
+
+Each step row describes the state in which the action was taken.
+"""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any, SupportsFloat
+
+import gymnasium as gym
+import numpy as np
+from gymnasium.core import ActType, ObsType
+from tqdm.autonotebook import tqdm
+
+import environments
+
+__all__ = [
+    "EpisodeLogWriter",
+    "EpisodeLog",
+    "RecordEpisodes",
+    "record_episodes",
+]
+
+GOAL_NAMES = ["red", "green", "blue", "no goal"]
+
+
+def _episode_columns() -> dict[str, tuple[str, tuple[int, ...]]]:
+    return {
+        "start": ("int64", ()),
+        "length": ("int32", ()),
+        "reward": ("float32", ()),
+        "terminated": ("bool", ()),
+        "true_goal": ("int8", ()),
+        "end_goal": ("int8", ()),
+        "goal_positions": ("int16", (3, 2)),
+    }
+
+
+def _step_columns(env: environments.ThreeGoalsEnv, observation_space: gym.Space) -> dict[
+    str, tuple[str, tuple[int, ...]]]:
+    return {
+        "episode": ("int64", ()),
+        "step": ("int32", ()),
+        "obs": (np.dtype(observation_space.dtype).name, tuple(observation_space.shape)),
+        "state": ("int8", (env.width, env.height)),
+        "action": ("int64", ()),
+        "reward": ("float32", ()),
+        "terminated": ("bool", ()),
+        "truncated": ("bool", ()),
+        "true_goal": ("int8", ()),
+        "agent_pos": ("int16", (2,)),
+    }
+
+
+def _goal_index(goal: int | str) -> int:
+    if isinstance(goal, str):
+        return GOAL_NAMES.index(goal)
+    return goal
+
+
+class _ColumnGroup:
+    """A set of columns with the same number of rows, appended to by chunks."""
+
+    def __init__(self, directory: Path, columns: dict[str, tuple[str, tuple[int, ...]]], chunk_size: int,
+                 flush_first: _ColumnGroup | None = None):
+        self.directory = directory
+        self.flush_first = flush_first
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.buffers = {name: np.empty((chunk_size, *shape), dtype=dtype)
+                        for name, (dtype, shape) in columns.items()}
+        self.row_sizes = {name: buffer[0].nbytes for name, buffer in self.buffers.items()}
+        self.buffered = 0
+
+        directory.mkdir(parents=True, exist_ok=True)
+        self.files = {name: (directory / f"{name}.bin").open("ab") for name in columns}
+        # A chunk might have been partially written if a previous writer crashed.
+        self.written = min(self.files[name].tell() // size for name, size in self.row_sizes.items())
+        for name, file in self.files.items():
+            file.truncate(self.written * self.row_sizes[name])
+
+    def __len__(self):
+        return self.written + self.buffered
+
+    def append(self, row: dict[str, Any]):
+        for name, buffer in self.buffers.items():
+            buffer[self.buffered] = row[name]
+        self.buffered += 1
+        if self.buffered == self.chunk_size:
+            self.flush()
+
+    def truncate(self, n_rows: int):
+        """Drop all rows after the first n_rows."""
+        if n_rows >= self.written:
+            self.buffered = min(self.buffered, n_rows - self.written)
+        else:
+            self.buffered = 0
+            self.written = n_rows
+            for name, file in self.files.items():
+                file.truncate(n_rows * self.row_sizes[name])
+
+    def flush(self):
+        if self.flush_first is not None:
+            self.flush_first.flush()
+        for name, buffer in self.buffers.items():
+            self.files[name].write(buffer[:self.buffered].tobytes())
+            self.files[name].flush()
+        self.written += self.buffered
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        for file in self.files.values():
+            file.close()
+
+
+class EpisodeLogWriter:
+    """Write episodes to an append-only columnar log.
+
+    Steps are added with `add_step` and an episode is committed with `end_episode`.
+    Only committed episodes are visible to readers.
+    """
+
+    def __init__(self, path: str | Path, step_columns: dict[str, tuple[str, tuple[int, ...]]],
+                 chunk_size: int = 4096):
+        self.path = Path(path)
+        meta_file = self.path / "meta.json"
+        episode_columns = _episode_columns()
+        # JSON turns tuples into lists, so we compare through JSON
+        meta = json.loads(json.dumps(dict(steps=step_columns, episodes=episode_columns)))
+
+        if meta_file.exists():
+            if json.loads(meta_file.read_text()) != meta:
+                raise ValueError(f"Cannot append to {self.path}: the columns differ.")
+        else:
+            self.path.mkdir(parents=True, exist_ok=True)
+            meta_file.write_text(json.dumps(meta, indent=2))
+
+        self.steps = _ColumnGroup(self.path / "steps", step_columns, chunk_size)
+        # Steps are always flushed first, so that readers never see an episode whose steps are missing.
+        self.episodes = _ColumnGroup(self.path / "episodes", episode_columns, max(1, chunk_size // 16),
+                                     flush_first=self.steps)
+        # Drop the steps of episodes that were never committed.
+        self.steps.truncate(EpisodeLog(self.path).n_steps)
+
+        self.episode_start = len(self.steps)
+        self.episode_reward = 0.0
+
+    @property
+    def episode_id(self) -> int:
+        """Id of the episode currently being recorded."""
+        return len(self.episodes)
+
+    def add_step(self, **row):
+        row.setdefault("episode", self.episode_id)
+        row.setdefault("step", len(self.steps) - self.episode_start)
+        self.steps.append(row)
+        self.episode_reward += float(row["reward"])
+
+    def end_episode(self, terminated: bool, true_goal: int, end_goal: int, goal_positions):
+        self.episodes.append(dict(
+            start=self.episode_start,
+            length=len(self.steps) - self.episode_start,
+            reward=self.episode_reward,
+            terminated=terminated,
+            true_goal=true_goal,
+            end_goal=end_goal,
+            goal_positions=goal_positions,
+        ))
+        self.episode_start = len(self.steps)
+        self.episode_reward = 0.0
+
+    def discard_episode(self):
+        """Drop the steps of the episode being recorded."""
+        self.steps.truncate(self.episode_start)
+        self.episode_reward = 0.0
+
+    def flush(self):
+        self.episodes.flush()
+
+    def close(self):
+        self.episodes.close()
+        self.steps.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class EpisodeLog:
+    """Read-only view of an episode log.
+
+    Columns are memory mapped, so nothing is loaded until it is indexed.
+
+    Example:
+        >>> log = EpisodeLog("logs/eval")
+        >>> ids = log.select(true_goal="red", end_goal="green")
+        >>> actions = log.gather(ids, "action")
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        meta = json.loads((self.path / "meta.json").read_text())
+        self.episodes = self._open(self.path / "episodes", meta["episodes"])
+        n_episodes = min(len(col) for col in self.episodes.values())
+        self.episodes = {name: col[:n_episodes] for name, col in self.episodes.items()}
+
+        if n_episodes:
+            self.n_steps = int(self.episodes["start"][-1]) + int(self.episodes["length"][-1])
+        else:
+            self.n_steps = 0
+        self.steps = {name: col[:self.n_steps]
+                      for name, col in self._open(self.path / "steps", meta["steps"]).items()}
+
+    @staticmethod
+    def _open(directory: Path, columns: dict[str, list]) -> dict[str, np.ndarray]:
+        out = {}
+        for name, (dtype, shape) in columns.items():
+            file = directory / f"{name}.bin"
+            row_size = np.dtype(dtype).itemsize * int(np.prod(shape))
+            n_rows = file.stat().st_size // row_size if file.exists() else 0
+            if n_rows == 0:
+                out[name] = np.empty((0, *shape), dtype=dtype)
+            else:
+                out[name] = np.memmap(file, dtype=dtype, mode="r", shape=(n_rows, *shape))
+        return out
+
+    def __len__(self):
+        return len(self.episodes["start"])
+
+    def __repr__(self):
+        return f"<EpisodeLog {self.path}: {len(self)} episodes, {self.n_steps} steps>"
+
+    def episode(self, idx: int) -> dict[str, np.ndarray]:
+        """Return all the steps of one episode, as views into the log."""
+        start = int(self.episodes["start"][idx])
+        end = start + int(self.episodes["length"][idx])
+        return {name: col[start:end] for name, col in self.steps.items()}
+
+    def select(self, *,
+               true_goal: int | str | None = None,
+               end_goal: int | str | None = None,
+               terminated: bool | None = None,
+               min_length: int | None = None,
+               max_length: int | None = None) -> np.ndarray:
+        """Return the ids of the episodes matching all the given conditions.
+
+        Goals can be given by index or by name ("red", "green", "blue", "no goal").
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if true_goal is not None:
+            mask &= self.episodes["true_goal"] == _goal_index(true_goal)
+        if end_goal is not None:
+            mask &= self.episodes["end_goal"] == _goal_index(end_goal)
+        if terminated is not None:
+            mask &= self.episodes["terminated"] == terminated
+        if min_length is not None:
+            mask &= self.episodes["length"] >= min_length
+        if max_length is not None:
+            mask &= self.episodes["length"] <= max_length
+        return np.flatnonzero(mask)
+
+    def step_indices(self, episode_ids: np.ndarray) -> np.ndarray:
+        """Return the indices of all steps of the given episodes, in order."""
+        episode_ids = np.asarray(episode_ids)
+        starts = self.episodes["start"][episode_ids].astype(np.int64)
+        lengths = self.episodes["length"][episode_ids].astype(np.int64)
+        # For each step, its offset from the start of its episode
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return np.repeat(starts, lengths) + offsets
+
+    def gather(self, episode_ids: np.ndarray, column: str) -> np.ndarray:
+        """Return the concatenated values of a step column for the given episodes."""
+        return self.steps[column][self.step_indices(episode_ids)]
+
+    def stats(self) -> np.ndarray:
+        """Return the proportion of episodes ending at each goal, given the true goal, as in `make_stats`."""
+        stats = np.zeros((3, 4))
+        np.add.at(stats, (self.episodes["true_goal"], self.episodes["end_goal"]), 1)
+        return stats / stats.sum(-1, keepdims=True)
+
+
+class RecordEpisodes(gym.Wrapper):
+    """
+    Record every step of a ThreeGoalsEnv to an episode log.
+
+    The wrapper can be placed anywhere in the wrapper stack: the observations
+    recorded are the ones it receives, and the state is read from the unwrapped env.
+    Only complete episodes are committed to the log.
+    """
+
+    unwrapped: environments.ThreeGoalsEnv
+
+    def __init__(self, env: gym.Env, path: str | Path, chunk_size: int = 4096):
+        super().__init__(env)
+        assert isinstance(env.unwrapped, environments.ThreeGoalsEnv)
+        self.writer = EpisodeLogWriter(path, _step_columns(env.unwrapped, env.observation_space),
+                                       chunk_size)
+        self.last_obs = None
+
+    def reset(self, **kwargs) -> tuple[ObsType, dict[str, Any]]:
+        # Steps of an unfinished episode are dropped.
+        self.writer.discard_episode()
+        obs, info = self.env.reset(**kwargs)
+        self.last_obs = obs
+        return obs, info
+
+    def step(self, action: ActType) -> tuple[ObsType, SupportsFloat, bool, bool, dict[str, Any]]:
+        unwrapped = self.unwrapped
+        state = unwrapped.grid.copy()
+        agent_pos = unwrapped.agent_pos
+
+        obs, reward, terminated, truncated, info = self.env.step(action)
+        self.writer.add_step(
+            obs=self.last_obs,
+            state=state,
+            action=action,
+            reward=reward,
+            terminated=terminated,
+            truncated=truncated,
+            true_goal=unwrapped.true_goal_idx,
+            agent_pos=agent_pos,
+        )
+        self.last_obs = obs
+
+        if terminated or truncated:
+            try:
+                end_goal = unwrapped.goal_positions.index(unwrapped.agent_pos)
+            except ValueError:
+                end_goal = 3
+            self.writer.end_episode(terminated, unwrapped.true_goal_idx, end_goal,
+                                    unwrapped.goal_positions)
+
+        return obs, reward, terminated, truncated, info
+
+    def close(self):
+        self.writer.close()
+        super().close()
+
+
+def record_episodes(policy, env: gym.Env, path: str | Path, n_episodes: int = 1000,
+                    deterministic: bool = True) -> EpisodeLog:
+    """Run the policy for n_episodes, append them to the log at path and return the log."""
+    recorder = RecordEpisodes(env, path)
+    for _ in tqdm(range(n_episodes)):
+        obs, _ = recorder.reset()
+        done = False
+        while not done:
+            action, _ = policy.predict(obs, deterministic=deterministic)
+            obs, _, terminated, truncated, _ = recorder.step(action)
+            done = terminated or truncated
+    recorder.writer.close()
+    return EpisodeLog(path)
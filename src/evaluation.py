@@ -0,0 +1,154 @@
+"""
+Batched evaluation of many policies at once.
+
+The checkpoints of a run share their architecture, so their weights can be stacked with
+torch.func and run with one vmapped forward. They are evaluated on the same episode layouts,
+which makes the comparison between checkpoints much less noisy than separate make_stats calls.
+"""
+
+from __future__ import annotations
+
+import copy
+
+import gymnasium as gym
+import numpy as np
+import torch
+from jaxtyping import Float, Int
+from torch import Tensor, nn
+from torch.func import functional_call, stack_module_state
+
+import environments
+import utils
+import wrappers
+
+__all__ = [
+    "StackedPolicies",
+    "evaluate_checkpoints",
+    "evaluate_counterfactuals",
+    "policy_map",
+]
+
+
+class StackedPolicies:
+    """The actors of K policies with the same architecture, run together with torch.func.vmap."""
+
+    def __init__(self, policies: list):
+        policies = [getattr(policy, "policy", policy) for policy in policies]  # Accept PPO models
+        actors = [nn.Sequential(policy.mlp_extractor.policy_net, policy.action_net) for policy in policies]
+        for actor in actors:
+            actor.eval()
+        self.params, self.buffers = stack_module_state(actors)
+        # The weights are given at each call, so the base module does not need any.
+        self.base = copy.deepcopy(actors[0]).to("meta")
+
+    def __len__(self):
+        return len(next(iter(self.params.values())))
+
+    def _call(self, params, buffers, obs: Tensor) -> Tensor:
+        return functional_call(self.base, (params, buffers), (obs,))
+
+    @torch.no_grad()
+    def logits(self, obs: Float[Tensor, "policy batch *obs"]) -> Float[Tensor, "policy batch action"]:
+        """Return the action logits of each policy on its own batch of observations."""
+        return torch.vmap(self._call)(self.params, self.buffers, obs)
+
+
+def evaluate_checkpoints(
+        policies: list | StackedPolicies,
+        env: gym.Env,
+        n_episodes: int = 1000,
+        deterministic: bool = False,
+        seed: int = 0,
+        batch_size: int = 4096,
+) -> Float[Tensor, "checkpoint true_goal=3 end_goal=4"]:
+    """
+    Return where the policies end, given the true goal, as make_stats does for each of them.
+
+    All policies play the same n_episodes initial layouts of the wrapped ThreeGoalsEnv env,
+    in lockstep. When sampling actions, the same random numbers are used for every policy.
+    """
+    stacked = policies if isinstance(policies, StackedPolicies) else StackedPolicies(policies)
+    n_policies = len(stacked)
+    rng = torch.Generator().manual_seed(seed)
+
+    layouts = environments.ThreeGoalsStates.sample(env.unwrapped.width, n_episodes, seed)
+    # Policy major: state i of policy k is at k * n_episodes + i
+    states = layouts[np.tile(np.arange(n_episodes), n_policies)]
+    actions = np.zeros((n_policies, n_episodes), dtype=np.int64)
+
+    while not states.done.all():
+        # Layouts where at least one policy is still playing
+        active = np.flatnonzero(~states.done.reshape(n_policies, n_episodes).all(0))
+        for start in range(0, len(active), batch_size):
+            layout_idx = active[start:start + batch_size]
+            rows = (np.arange(n_policies)[:, None] * n_episodes + layout_idx).ravel()
+            obs = wrappers.observe_states(env, states[rows])
+            obs = torch.as_tensor(obs, dtype=torch.float32)
+            obs = obs.view(n_policies, len(layout_idx), *obs.shape[1:])
+            logits = stacked.logits(obs)
+            if not deterministic:
+                # Gumbel-max sampling, with noise shared across policies
+                uniform = torch.rand(logits.shape[1:], generator=rng)
+                logits = logits - torch.log(-torch.log(uniform))
+            actions[:, layout_idx] = logits.argmax(-1).numpy()
+        states.step(actions.ravel())
+
+    end_goal = states.end_goal.reshape(n_policies, n_episodes)
+    stats = np.zeros((n_policies, 3, 4))
+    np.add.at(stats, (np.arange(n_policies)[:, None], layouts.true_goal[None], end_goal), 1)
+    stats = stats / stats.sum(-1, keepdims=True)
+    return torch.from_numpy(stats)
+
+
+def evaluate_counterfactuals(
+        policy,
+        env: gym.Env,
+        layouts: environments.ThreeGoalsStates,
+        batch_size: int = 8192,
+) -> tuple[Int[Tensor, "layout true_goal=3 permutation=6"], Int[Tensor, "layout true_goal=3 permutation=6"]]:
+    """
+    Play each layout under every true goal and permutation of the goal colours, greedily and in lockstep.
+
+    The true goals of layouts are ignored. Permutations are ThreeGoalsStates.PERMUTATIONS.
+    Returns the colour of the goal each variant ended on (3 for no goal), and the episode lengths.
+    An agent that ignores colours ends on the same position for all permutations:
+    PERMUTATIONS[p, end_goal] does not depend on p.
+    """
+    variants = layouts.counterfactuals()
+    end_goal, length = utils.rollout_batch(policy, env, variants, batch_size)
+    shape = (len(layouts), variants.goal_positions.shape[1], len(variants.PERMUTATIONS))
+    return torch.from_numpy(end_goal).view(shape), torch.from_numpy(length).view(shape)
+
+
+def policy_map(
+        policy,
+        env: gym.Env,
+        layouts: environments.ThreeGoalsStates | None = None,
+        batch_size: int = 8192,
+) -> tuple[Float[Tensor, "layout true_goal=3 x y action"], Float[Tensor, "layout true_goal=3 x y"]]:
+    """
+    Return the action probabilities and values of the policy, for the agent on every cell of each layout.
+
+    The observations of every (layout, true goal, agent cell) are built in one batch through the
+    wrappers of env, and go through the actor and critic in one batched forward.
+    Cells occupied by a goal are NaN. If layouts is None, the current layout of env is used.
+    """
+    if layouts is None:
+        layouts = environments.ThreeGoalsStates.from_envs([env])
+    size = layouts.size
+    n_goals = layouts.goal_positions.shape[1]
+    cells = np.stack(np.meshgrid(np.arange(size), np.arange(size), indexing="ij"), axis=-1).reshape(-1, 2)
+
+    # Variant (layout, true goal, cell) is at index (layout * n_goals + true_goal) * size**2 + cell
+    states = layouts[np.repeat(np.arange(len(layouts)), n_goals * len(cells))]
+    states.true_goal = np.tile(np.repeat(np.arange(n_goals), len(cells)), len(layouts))
+    states.agent_pos = np.tile(cells, (len(layouts) * n_goals, 1))
+
+    obs = wrappers.observe_states(env, states)
+    probs, values = utils.policy_forward(policy, obs, batch_size)
+
+    on_goal = (states.agent_pos[:, None] == states.goal_positions).all(-1).any(-1)
+    probs[on_goal] = float("nan")
+    values[on_goal] = float("nan")
+    shape = (len(layouts), n_goals, size, size)
+    return probs.view(*shape, -1), values.view(shape)
@@ -0,0 +1,238 @@
+"""
+Export trained policies to a small graph, that runs with NumPy only.
+
+Evaluation workers only need greedy actions, so they can load the exported actor with
+NumpyPolicy, without importing torch or stable-baselines3, and run it on batches of observations.
+
+The exported file is a .npz archive, with the graph as JSON under "graph"
+and the parameters as arrays "p0", "p1", ...
+"""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any
+
+import einops
+import numpy as np
+
+__all__ = [
+    "export_policy",
+    "NumpyPolicy",
+]
+
+
+def export_policy(policy, path: str | Path) -> Path:
+    """
+    Export the actor and action head of a CustomActorCriticPolicy (or a PPO model using it).
+
+    Supported modules are Sequential, Split, Rearrange, IndexSelect, TokenEncoder, Conv2d, Linear,
+    ReLU, Tanh, Flatten, Identity, Mask, SwitchNetwork and the WeightDecay wrappers, which are dropped.
+    """
+    # Imported here so that the runtime below does not need torch.
+    import gymnasium as gym
+    from torch import nn
+
+    import architectures
+
+    policy = getattr(policy, "policy", policy)
+    assert policy.action_net is not None and isinstance(policy.action_net, nn.Linear), \
+        "Only discrete action spaces are supported"
+    params: list[np.ndarray] = []
+
+    def add(tensor) -> int | None:
+        if tensor is None:
+            return None
+        params.append(tensor.detach().cpu().numpy())
+        return len(params) - 1
+
+    def convert(module: nn.Module) -> dict[str, Any]:
+        if isinstance(module, architectures.WeightDecay):
+            return convert(module.module)
+        elif isinstance(module, architectures.SwitchNetwork):
+            return dict(op="switch_network", layers=[convert(layer) for layer in module])
+        elif isinstance(module, architectures.SwitchedLayer):
+            return dict(op="switched", branches=[convert(layer) for layer in module])
+        elif isinstance(module, nn.Sequential):
+            return dict(op="sequential", layers=[convert(layer) for layer in module])
+        elif isinstance(module, architectures.Split):
+            return dict(op="split", left_size=module.left_size,
+                        left=convert(module.left), right=convert(module.right))
+        elif isinstance(module, architectures.Rearrange):
+            return dict(op="rearrange", pattern=module.pattern, axes_lengths=module.axes_lengths)
+        elif isinstance(module, architectures.IndexSelect):
+            return dict(op="index_select", dim=module.dim, index=add(module.index))
+        elif isinstance(module, architectures.TokenEncoder):
+            return dict(op="token_encoder", n_tokens=module.n_tokens, type_embed=add(module.type_embed.weight),
+                        x_embed=add(module.x_embed.weight), y_embed=add(module.y_embed.weight))
+        elif isinstance(module, nn.Conv2d):
+            assert module.groups == 1 and module.dilation == (1, 1) and module.padding_mode == "zeros", \
+                f"Only simple convolutions can be exported, got {module}"
+            assert not isinstance(module.padding, str), f"Use explicit padding instead of {module.padding}"
+            return dict(op="conv2d", weight=add(module.weight), bias=add(module.bias),
+                        stride=list(module.stride), padding=list(module.padding))
+        elif isinstance(module, nn.Linear):
+            return dict(op="linear", weight=add(module.weight), bias=add(module.bias))
+        elif isinstance(module, architectures.Mask):
+            return dict(op="mask", mask=add(module.mask), flipped=module.flipped)
+        elif isinstance(module, nn.ReLU):
+            return dict(op="relu")
+        elif isinstance(module, nn.Tanh):
+            return dict(op="tanh")
+        elif isinstance(module, nn.Identity):
+            return dict(op="identity")
+        elif isinstance(module, nn.Flatten):
+            return dict(op="flatten", start_dim=module.start_dim, end_dim=module.end_dim)
+        else:
+            raise NotImplementedError(f"Cannot export {module.__class__.__name__}")
+
+    space = policy.observation_space
+    if isinstance(space, gym.spaces.Dict):
+        assert set(space.spaces) == {"obs", "switch"}, f"Unsupported observation space {space}"
+        obs_shape = list(space["obs"].shape)
+    else:
+        assert isinstance(space, (gym.spaces.Box, gym.spaces.MultiBinary)), \
+            f"Unsupported observation space {space}"
+        obs_shape = list(space.shape)
+
+    graph = dict(
+        obs_shape=obs_shape,
+        actor=convert(policy.mlp_extractor.policy_net),
+        action_net=convert(policy.action_net),
+    )
+
+    path = Path(path)
+    np.savez(path, graph=np.array(json.dumps(graph)), **{f"p{i}": p for i, p in enumerate(params)})
+    # np.savez adds .npz if it is missing
+    return path if path.suffix == ".npz" else path.with_name(path.name + ".npz")
+
+
+def _conv2d(x: np.ndarray, weight: np.ndarray, bias: np.ndarray | None,
+            stride: list[int], padding: list[int]) -> np.ndarray:
+    kh, kw = weight.shape[2:]
+    x = np.pad(x, [(0, 0)] * (x.ndim - 2) + [(padding[0], padding[0]), (padding[1], padding[1])])
+    windows = np.lib.stride_tricks.sliding_window_view(x, (kh, kw), axis=(-2, -1))
+    windows = windows[..., ::stride[0], ::stride[1], :, :]  # (..., in, h, w, kh, kw)
+    out = np.einsum("...chwij,ocij->...ohw", windows, weight, optimize=True)
+    if bias is not None:
+        out += bias[:, None, None]
+    return out
+
+
+class NumpyPolicy:
+    """
+    Runs a policy exported with export_policy, with NumPy only.
+
+    predict has the same interface as SB3's, and accepts one observation or a batch.
+    """
+
+    def __init__(self, graph: dict[str, Any], params: list[np.ndarray], seed: int | None = None):
+        self.graph = graph
+        self.params = params
+        self.obs_shape = tuple(graph["obs_shape"])
+        self.rng = np.random.default_rng(seed)
+
+    @classmethod
+    def load(cls, path: str | Path, seed: int | None = None) -> NumpyPolicy:
+        with np.load(path) as archive:
+            graph = json.loads(str(archive["graph"]))
+            params = [archive[f"p{i}"] for i in range(len(archive.files) - 1)]
+        return cls(graph, params, seed)
+
+    def run(self, node: dict[str, Any], x, switch: np.ndarray | None = None) -> np.ndarray:
+        op = node["op"]
+        if op == "sequential":
+            for layer in node["layers"]:
+                x = self.run(layer, x, switch)
+            return x
+        elif op == "switch_network":
+            if isinstance(x, dict):
+                x, switch = x["obs"], x["switch"]
+            switch = np.asarray(switch)
+            if switch.ndim == 2:  # One-hot, as SB3 preprocesses Discrete spaces
+                switch = switch.argmax(-1)
+            for layer in node["layers"]:
+                x = self.run(layer, x, switch)
+            return x
+        elif op == "switched":
+            out = None
+            for s in np.unique(switch):
+                idx = np.flatnonzero(switch == s)
+                y = self.run(node["branches"][int(s)], x[idx])
+                if out is None:
+                    out = np.zeros((len(x), *y.shape[1:]), dtype=y.dtype)
+                out[idx] = y
+            return out
+        elif op == "split":
+            left = self.run(node["left"], x[..., :node["left_size"]], switch)
+            right = self.run(node["right"], x[..., node["left_size"]:], switch)
+            return np.concatenate([left, right], axis=-1)
+        elif op == "rearrange":
+            return einops.rearrange(x, node["pattern"], **node["axes_lengths"])
+        elif op == "index_select":
+            return np.take(x, self.params[node["index"]], axis=node["dim"])
+        elif op == "token_encoder":
+            tokens = x.reshape(*x.shape[:-1], node["n_tokens"], 3).astype(np.int64)
+            types = tokens[..., 0]
+            embed = (self.params[node["type_embed"]][types] + self.params[node["x_embed"]][tokens[..., 1]]
+                     + self.params[node["y_embed"]][tokens[..., 2]])
+            embed = embed * (types != 0)[..., None]
+            return embed.reshape(*embed.shape[:-2], -1)
+        elif op == "conv2d":
+            bias = None if node["bias"] is None else self.params[node["bias"]]
+            return _conv2d(x, self.params[node["weight"]], bias, node["stride"], node["padding"])
+        elif op == "linear":
+            x = x @ self.params[node["weight"]].T
+            if node["bias"] is not None:
+                x = x + self.params[node["bias"]]
+            return x
+        elif op == "mask":
+            mask = self.params[node["mask"]]
+            return x * (1 - mask) if node["flipped"] else x * mask
+        elif op == "relu":
+            return np.maximum(x, 0)
+        elif op == "tanh":
+            return np.tanh(x)
+        elif op == "identity":
+            return x
+        elif op == "flatten":
+            start = node["start_dim"] % x.ndim
+            end = node["end_dim"] % x.ndim
+            return x.reshape(*x.shape[:start], -1, *x.shape[end + 1:])
+        else:
+            raise ValueError(f"Unknown op {op}")
+
+    def logits(self, obs) -> np.ndarray:
+        """Return the action logits for a batch of observations."""
+        if isinstance(obs, dict):
+            obs = {"obs": np.asarray(obs["obs"], dtype=np.float32), "switch": obs["switch"]}
+        else:
+            obs = np.asarray(obs, dtype=np.float32)
+        latent = self.run(self.graph["actor"], obs)
+        return self.run(self.graph["action_net"], latent)
+
+    def action_probs(self, obs) -> np.ndarray:
+        logits = self.logits(obs)
+        logits = logits - logits.max(-1, keepdims=True)
+        probs = np.exp(logits)
+        return probs / probs.sum(-1, keepdims=True)
+
+    def predict(self, obs, state=None, episode_start=None, deterministic: bool = False):
+        """Return the actions for one observation or a batch of observations, as SB3's predict."""
+        obs_array = obs["obs"] if isinstance(obs, dict) else obs
+        single = np.ndim(obs_array) == len(self.obs_shape)
+        if single:
+            obs = {key: np.asarray(value)[None] for key, value in obs.items()} if isinstance(obs, dict) \
+                else np.asarray(obs)[None]
+
+        logits = self.logits(obs)
+        if deterministic:
+            actions = logits.argmax(-1)
+        else:
+            # Gumbel-max sampling
+            actions = (logits - np.log(-np.log(self.rng.random(logits.shape)))).argmax(-1)
+
+        if single:
+            return int(actions[0]), state
+        return actions, state
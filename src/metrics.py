@@ -0,0 +1,238 @@
+"""
+Buffered, asynchronous logging of scalar metrics.
+
+Metrics are appended to a bounded ring buffer on the training thread, and a background
+thread flushes them by batches to one or more sinks: tensorboard, wandb, or a local
+JSONL or SQLite file when wandb is not used.
+
+    metrics = Metrics([JsonlSink("run/metrics.jsonl")])
+    metrics.log({"train/loss": loss, "train/norms": norms}, step=1000)  # tensors are fine
+    ...
+    metrics.close()  # flush everything and stop the thread
+
+Tensor values are not converted on the training thread: all the tensors of one log call
+are flattened into a single tensor, copied to the host at once by the flushing thread.
+"""
+
+from __future__ import annotations
+
+import itertools
+import json
+import sqlite3
+import threading
+import warnings
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+import wandb
+from torch import Tensor
+
+__all__ = [
+    "Metrics",
+    "Sink",
+    "JsonlSink",
+    "SqliteSink",
+    "TensorboardSink",
+    "WandbSink",
+]
+
+
+@dataclass
+class _Record:
+    step: int
+    values: dict[str, float]
+    # Tensor values, flattened and concatenated in one tensor, and the name of each element
+    tensor_names: list[str]
+    tensor: Tensor | None
+
+    def resolve(self) -> tuple[int, dict[str, float]]:
+        """Return the step and all the values, as python floats."""
+        if self.tensor is None:
+            return self.step, self.values
+        # The single device-to-host copy of this record
+        tensor_values = self.tensor.cpu().tolist()
+        return self.step, {**self.values, **dict(zip(self.tensor_names, tensor_values))}
+
+
+class Sink:
+    """Destination of the metrics. Sinks are only used from the flushing thread."""
+
+    def write(self, records: list[tuple[int, dict[str, float]]]):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class JsonlSink(Sink):
+    """Append one json line {"step": ..., **values} per record."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = self.path.open("a")
+
+    def write(self, records):
+        self.file.writelines(json.dumps(dict(step=step, **values)) + "\n" for step, values in records)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class SqliteSink(Sink):
+    """Store the metrics in a (step, name, value) table of an SQLite database."""
+
+    def __init__(self, path: str | Path, table: str = "metrics"):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.table = table
+        self.connection = None
+
+    def write(self, records):
+        if self.connection is None:
+            # Connections can only be used from the thread that created them
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} (step INTEGER, name TEXT, value REAL)")
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT INTO {self.table} VALUES (?, ?, ?)",
+                [(step, name, value) for step, values in records for name, value in values.items()],
+            )
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class TensorboardSink(Sink):
+    """Write the metrics as tensorboard scalars."""
+
+    def __init__(self, log_dir: str | Path):
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(str(log_dir))
+
+    def write(self, records):
+        for step, values in records:
+            for name, value in values.items():
+                self.writer.add_scalar(name, value, step)
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+class WandbSink(Sink):
+    """Log the metrics to the current wandb run, at the step of each record."""
+
+    def write(self, records):
+        # One wandb.log per run of records with the same step, in order
+        for step, group in itertools.groupby(records, key=lambda record: record[0]):
+            merged = {}
+            for _step, values in group:
+                merged.update(values)
+            if merged:
+                wandb.log(merged, step=step)
+
+
+class Metrics:
+    """
+    Ring buffer of metrics, flushed to the sinks by a background thread.
+
+    Args:
+        sinks: Where to write the metrics.
+        capacity: Maximum number of records waiting to be flushed. When the buffer is full,
+            the oldest records are dropped, and counted in `dropped`.
+        flush_interval: Seconds between two flushes.
+    """
+
+    def __init__(self, sinks: list[Sink], capacity: int = 10_000, flush_interval: float = 1.0):
+        self.sinks = sinks
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._buffer: deque[_Record] = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._flushed = threading.Condition(self._lock)
+        self._pending = 0
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-flush", daemon=True)
+        self._thread.start()
+
+    def log(self, values: dict[str, float | Tensor], step: int):
+        """
+        Record metrics at the given step. This does not block on any I/O or device sync.
+
+        Tensors can have any shape: an element at index (i, j) of a tensor "name" is
+        recorded as "name/i/j", and a scalar tensor as "name".
+        """
+        floats = {}
+        tensor_names = []
+        tensors = []
+        for name, value in values.items():
+            if isinstance(value, Tensor):
+                value = value.detach()
+                tensors.append(value.flatten())
+                if value.ndim == 0:
+                    tensor_names.append(name)
+                else:
+                    tensor_names.extend("/".join([name, *map(str, idx)])
+                                        for idx in itertools.product(*map(range, value.shape)))
+            else:
+                floats[name] = float(value)
+
+        tensor = None
+        if tensors:
+            # cat copies, so later in-place updates of the weights are not seen.
+            # Cast to float, so that integer tensors logged first do not truncate the others.
+            tensor = torch.cat([t.float() for t in tensors])
+
+        record = _Record(step, floats, tensor_names, tensor)
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            else:
+                self._pending += 1
+            self._buffer.append(record)
+
+    def flush(self):
+        """Block until every record logged so far is written to the sinks."""
+        with self._flushed:
+            self._flushed.wait_for(lambda: self._pending == 0 or not self._thread.is_alive())
+
+    def close(self):
+        """Flush the remaining records, stop the background thread and close the sinks."""
+        if self._closing.is_set():
+            return
+        self._closing.set()
+        self._thread.join()
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self) -> Metrics:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self):
+        with self._lock:
+            records = list(self._buffer)
+            self._buffer.clear()
+        if records:
+            resolved = [record.resolve() for record in records]
+            for sink in self.sinks:
+                try:
+                    sink.write(resolved)
+                except Exception as e:
+                    warnings.warn(f"Could not write metrics to {sink.__class__.__name__}: {e!r}")
+        with self._flushed:
+            self._pending = max(0, self._pending - len(records))
+            self._flushed.notify_all()
+
+    def _run(self):
+        while not self._closing.wait(self.flush_interval):
+            self._write()
+        self._write()
@@ -0,0 +1,447 @@
+"""
+Datasets of activations paired with ground truth variables of ThreeGoalsEnv, for probing.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Sequence
+
+import gymnasium as gym
+import numpy as np
+import plotly.express as px
+import torch
+from jaxtyping import Float
+from torch import Tensor
+
+import environments
+import utils
+import wrappers
+
+__all__ = [
+    "CACHE_DIR",
+    "ActivationDataset",
+    "ProbeResults",
+    "probe",
+    "probe_checkpoints",
+]
+
+CACHE_DIR = Path(__file__).parent.parent / "cache" / "activations"
+CLASSIFICATION_LABELS = ("true_goal", "action", "end_goal")
+
+
+def _hash_policy(policy) -> str:
+    hasher = hashlib.sha1()
+    for name, tensor in policy.state_dict().items():
+        hasher.update(name.encode())
+        hasher.update(tensor.detach().cpu().numpy().tobytes())
+    return hasher.hexdigest()
+
+
+def _describe_value(value):
+    if isinstance(value, np.ndarray):
+        return hashlib.sha1(value.tobytes()).hexdigest()
+    return value
+
+
+def describe_env(env: gym.Env) -> list[dict]:
+    """Return a json serializable description of what defines the observations of env."""
+    description = []
+    while isinstance(env, gym.Wrapper):
+        if hasattr(env, "observation_batch"):
+            description.append({
+                "class": env.__class__.__name__,
+                **{name: _describe_value(value) for name, value in vars(env).items()
+                   if not name.startswith("_")
+                   and isinstance(value, (int, float, str, bool, list, tuple, np.ndarray, type(None)))},
+            })
+        env = env.env
+    description.append(dict(
+        {"class": env.__class__.__name__},
+        width=env.unwrapped.width,
+        height=env.unwrapped.height,
+    ))
+    return description
+
+
+@dataclass
+class ActivationDataset:
+    """
+    Activations of some layers of a policy, together with the state they were computed on.
+
+    Features are indexed like a Cache, by (unique part of) the module name,
+    and have shape (n_states, *activation_shape).
+    Labels are 1D tensors of length n_states:
+        - agent_x, agent_y, red_x, red_y, green_x, green_y, blue_x, blue_y
+        - true_goal: index of the true goal
+        - action: greedy action of the policy
+        - value: value predicted by the critic
+        - end_goal, episode_length: goal reached by the greedy policy from this state,
+            (3 if none) and the number of steps it took.
+    """
+
+    features: utils.Cache
+    labels: dict[str, Tensor]
+    path: Path | None = None
+
+    def __len__(self):
+        return len(next(iter(self.labels.values())))
+
+    def __str__(self):
+        return (f"ActivationDataset of {len(self)} states\n{self.features}\n"
+                f"Labels: {', '.join(self.labels)}")
+
+    def flat_features(self, layer: str) -> Tensor:
+        """Return the activations of a layer, flattened to (n_states, dim)."""
+        features = self.features[layer]
+        return features.reshape(len(features), -1)
+
+    @staticmethod
+    def _load_array(file: Path) -> Tensor:
+        # Copy on write, so that tensors are writable but the file is never modified.
+        return torch.from_numpy(np.load(file, mmap_mode="c"))
+
+    @classmethod
+    def load(cls, path: str | Path) -> ActivationDataset:
+        """Load a dataset saved by build or save. Arrays are memory mapped."""
+        path = Path(path)
+        meta = json.loads((path / "meta.json").read_text())
+        features = utils.Cache({name: cls._load_array(path / "features" / file)
+                                for name, file in meta["features"].items()})
+        labels = {name: cls._load_array(path / "labels" / f"{name}.npy") for name in meta["labels"]}
+        return cls(features, labels, path)
+
+    def save(self, path: str | Path, extra_meta: dict | None = None):
+        path = Path(path)
+        (path / "features").mkdir(parents=True, exist_ok=True)
+        (path / "labels").mkdir(parents=True, exist_ok=True)
+        files = {}
+        for name, features in self.features.items():
+            files[name] = name.replace(" ", "_") + ".npy"
+            file = path / "features" / files[name]
+            if not file.exists():
+                np.save(file, features.numpy())
+        for name, label in self.labels.items():
+            np.save(path / "labels" / f"{name}.npy", label.numpy())
+        meta = dict(features=files, labels=list(self.labels), **(extra_meta or {}))
+        (path / "meta.json").write_text(json.dumps(meta, indent=2))
+        self.path = path
+
+    @classmethod
+    def build(cls,
+              policy,
+              env: gym.Env,
+              layers: str | Iterable[str],
+              states: environments.ThreeGoalsStates | None = None,
+              n_states: int | None = None,
+              seed: int = 0,
+              batch_size: int = 8192,
+              cache_dir: str | Path | None = CACHE_DIR,
+              end_goal: bool = True) -> ActivationDataset:
+        """
+        Record the activations of a policy on many states of a ThreeGoalsEnv.
+
+        Observations are rendered in batch from the states, the network is run once
+        per batch and the activations are written directly to disk.
+        Datasets are cached in cache_dir per (model weights, layers, env config, states).
+
+        Args:
+            policy: A PPO model or ActorCriticPolicy.
+            env: The wrapped environment, used to render observations. Its state is not used.
+            layers: fnmatch patterns of the modules to record, as in utils.stream_activations,
+                matched against the module names in the ActorCriticPolicy.
+            states: The states to use. If None, all initial states are used if n_states is None,
+                otherwise n_states random initial states.
+            seed: Seed used to sample the states.
+            end_goal: Whether to also compute where the greedy policy ends from each state.
+                It requires running the policy for a whole episode.
+            cache_dir: Where the datasets are cached. If None, the dataset is kept in memory.
+        """
+        policy_module = getattr(policy, "policy", policy)
+        if isinstance(layers, str):
+            layers = [layers]
+        layers = list(layers)
+
+        size = env.unwrapped.width
+        if states is not None:
+            states_key = hashlib.sha1(b"".join(
+                a.tobytes() for a in (states.agent_pos, states.goal_positions, states.true_goal))).hexdigest()
+        elif n_states is None:
+            states = environments.ThreeGoalsStates.enumerate(size)
+            states_key = "all"
+        else:
+            states = environments.ThreeGoalsStates.sample(size, n_states, seed)
+            states_key = f"sample_{n_states}_{seed}"
+
+        meta = dict(
+            model=_hash_policy(policy_module),
+            layers=layers,
+            env=describe_env(env),
+            states=states_key,
+            end_goal=end_goal,
+        )
+        key = hashlib.sha1(json.dumps(meta, sort_keys=True).encode()).hexdigest()[:16]
+
+        if cache_dir is not None:
+            path = Path(cache_dir) / key
+            if (path / "meta.json").exists():
+                return cls.load(path)
+            tmp_path = Path(cache_dir) / f"{key}.tmp"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            spill_dir = tmp_path / "features"
+        else:
+            path = tmp_path = spill_dir = None
+
+        with utils.stream_activations(policy_module, layers, capacity=len(states),
+                                      spill_dir=spill_dir, spill_threshold=0) as features:
+            probs = []
+            values = []
+            for start in range(0, len(states), batch_size):
+                obs = wrappers.observe_states(env, states[start:start + batch_size])
+                batch_probs, batch_values = utils.policy_forward(policy_module, obs, batch_size)
+                probs.append(batch_probs)
+                values.append(batch_values)
+        probs = torch.cat(probs)
+
+        labels = {
+            "agent_x": states.agent_pos[:, 0],
+            "agent_y": states.agent_pos[:, 1],
+        }
+        for goal, name in enumerate(["red", "green", "blue"]):
+            labels[f"{name}_x"] = states.goal_positions[:, goal, 0]
+            labels[f"{name}_y"] = states.goal_positions[:, goal, 1]
+        labels["true_goal"] = states.true_goal
+        labels["action"] = probs.argmax(-1).numpy()
+        if end_goal:
+            labels["end_goal"], labels["episode_length"] = utils.rollout_batch(
+                policy, env, states, batch_size)
+        labels = {name: torch.from_numpy(np.asarray(label)) for name, label in labels.items()}
+        labels["value"] = torch.cat(values)
+
+        dataset = cls(features, labels)
+        if path is not None:
+            dataset.save(tmp_path, meta)
+            del dataset, features  # Close the memory maps before moving the files
+            tmp_path.rename(path)
+            return cls.load(path)
+        return dataset
+
+
+@dataclass
+class ProbeResults:
+    """Scores of linear probes, for each (layer, target) pair.
+
+    Regression targets are scored with R2, and classification targets with accuracy.
+    """
+
+    layers: list[str]
+    targets: list[str]
+    classification: list[bool]
+    train_scores: Float[Tensor, "layer target"]
+    test_scores: Float[Tensor, "layer target"]
+
+    def __str__(self):
+        width = max(len(layer) for layer in self.layers)
+        lines = [" " * width + " | " + " | ".join(f"{target:>10}" for target in self.targets)]
+        for layer, scores in zip(self.layers, self.test_scores):
+            lines.append(f"{layer:>{width}} | " + " | ".join(f"{score:>10.3f}" for score in scores))
+        return "\n".join(lines)
+
+    def show(self, title: str = "Test scores of linear probes", **plotly_kwargs):
+        plotly_kwargs.setdefault("width", 100 * len(self.targets) + 400)
+        plotly_kwargs.setdefault("height", 50 * len(self.layers) + 200)
+        px.imshow(self.test_scores.numpy(), x=self.targets, y=self.layers, title=title,
+                  zmin=0, zmax=1, color_continuous_scale="Blues", text_auto=".2f",
+                  **plotly_kwargs).show()
+
+
+def _fit_probes(
+        xs: Sequence[Float[Tensor, "sample dim"]],
+        y_reg: Float[Tensor, "sample reg_target"],
+        y_cls: Sequence[Tensor],
+        test_size: float,
+        alpha: float,
+        steps: int,
+        lr: float,
+        seed: int,
+) -> tuple[Float[Tensor, "layer target"], Float[Tensor, "layer target"]]:
+    """Fit all probes at once. Returns the train and test scores, regression targets first."""
+
+    n = len(y_reg)
+    generator = torch.Generator().manual_seed(seed)
+    perm = torch.randperm(n, generator=generator)
+    n_test = int(n * test_size)
+    test_idx, train_idx = perm[:n_test], perm[n_test:]
+
+    # Standardize features with the train statistics, and pad them to the same dimension,
+    # so that every layer is solved in the same batched operation.
+    # Padded features are zero, and get zero weights.
+    d_max = max(x.shape[1] for x in xs)
+    x = torch.zeros(len(xs), n, d_max)
+    for i, features in enumerate(xs):
+        features = features.float()
+        train = features[train_idx]
+        x[i, :, :features.shape[1]] = (features - train.mean(0)) / (train.std(0) + 1e-6)
+    x_train, x_test = x[:, train_idx], x[:, test_idx]
+
+    train_scores = []
+    test_scores = []
+
+    # Ridge regression, in closed form: W = (X^T X + alpha n I)^-1 X^T (Y - mean(Y))
+    if y_reg.shape[1]:
+        y_reg = y_reg.float()
+        y_train, y_test = y_reg[train_idx], y_reg[test_idx]
+        y_mean = y_train.mean(0)
+        gram = x_train.transpose(1, 2) @ x_train
+        gram += alpha * len(train_idx) * torch.eye(d_max)
+        w = torch.linalg.solve(gram, x_train.transpose(1, 2) @ (y_train - y_mean))
+
+        def r2(x_, y_):
+            residuals = ((x_ @ w + y_mean - y_) ** 2).sum(1)
+            total = ((y_ - y_.mean(0)) ** 2).sum(0)
+            return 1 - residuals / total.clamp_min(1e-12)
+
+        train_scores.append(r2(x_train, y_train))
+        test_scores.append(r2(x_test, y_test))
+
+    # Logistic regression, with full batch gradient descent on all the probes at once.
+    # The logits of all targets are concatenated, and each target has its own slice.
+    if y_cls:
+        n_classes = [int(y.max()) + 1 for y in y_cls]
+        slices = np.cumsum([0] + n_classes)
+        w = torch.zeros(len(xs), d_max, slices[-1], requires_grad=True)
+        b = torch.zeros(len(xs), 1, slices[-1], requires_grad=True)
+        optimizer = torch.optim.Adam([w, b], lr=lr)
+
+        def logits(x_, target: int):
+            return (x_ @ w + b)[..., slices[target]:slices[target + 1]]
+
+        for _ in range(steps):
+            optimizer.zero_grad()
+            out = x_train @ w + b
+            loss = alpha * (w ** 2).sum()
+            for t, y in enumerate(y_cls):
+                target_logits = out[..., slices[t]:slices[t + 1]]
+                # Sum over layers, they are independent problems.
+                loss = loss + torch.nn.functional.cross_entropy(
+                    target_logits.flatten(0, 1), y[train_idx].repeat(len(xs)), reduction="sum"
+                ) / len(train_idx)
+            loss.backward()
+            optimizer.step()
+
+        with torch.no_grad():
+            train_scores.append(torch.stack([
+                (logits(x_train, t).argmax(-1) == y[train_idx]).float().mean(1) for t, y in enumerate(y_cls)
+            ], dim=1))
+            test_scores.append(torch.stack([
+                (logits(x_test, t).argmax(-1) == y[test_idx]).float().mean(1) for t, y in enumerate(y_cls)
+            ], dim=1))
+
+    return torch.cat(train_scores, dim=1), torch.cat(test_scores, dim=1)
+
+
+def probe(
+        features: dict[str, Tensor] | ActivationDataset,
+        labels: dict[str, Tensor] | None = None,
+        targets: Iterable[str] | None = None,
+        classification: Iterable[str] = CLASSIFICATION_LABELS,
+        test_size: float = 0.2,
+        alpha: float = 1e-4,
+        steps: int = 300,
+        lr: float = 0.05,
+        seed: int = 42,
+) -> ProbeResults:
+    """
+    Fit linear probes from every layer to every target at once.
+
+    Regression targets use ridge regression, solved in closed form for all layers and targets
+    in one batched solve. Classification targets use multinomial logistic regression, trained
+    with full batch gradient descent on all layers and targets at the same time.
+
+    Args:
+        features: Activations for each layer, of shape (n_samples, *dims), or an ActivationDataset.
+        labels: Targets, of shape (n_samples,). Not needed if features is an ActivationDataset.
+        targets: Names of the labels to probe. Defaults to all labels.
+        classification: Names of the labels that are classes. Other labels are regressed.
+        test_size: Proportion of the samples kept for the test set. The split is the same for all probes.
+        alpha: Strength of the L2 regularisation.
+        steps: Number of gradient descent steps for classification probes.
+    """
+    if isinstance(features, ActivationDataset):
+        labels = features.labels if labels is None else labels
+        features = features.features
+    if targets is None:
+        targets = list(labels)
+    targets = list(targets)
+    classification = set(classification)
+
+    reg_targets = [t for t in targets if t not in classification]
+    cls_targets = [t for t in targets if t in classification]
+
+    layers = list(features)
+    xs = [features[layer].reshape(len(features[layer]), -1) for layer in layers]
+    y_reg = torch.stack([torch.as_tensor(labels[t]) for t in reg_targets], dim=1) if reg_targets \
+        else torch.zeros(len(xs[0]), 0)
+    # Map classes to 0..n_classes-1
+    y_cls = [torch.unique(torch.as_tensor(labels[t]), return_inverse=True)[1] for t in cls_targets]
+
+    train_scores, test_scores = _fit_probes(xs, y_reg, y_cls, test_size, alpha, steps, lr, seed)
+    return ProbeResults(
+        layers,
+        reg_targets + cls_targets,
+        [False] * len(reg_targets) + [True] * len(cls_targets),
+        train_scores,
+        test_scores,
+    )
+
+
+def probe_checkpoints(
+        policies: Sequence,
+        env: gym.Env,
+        layers: str | Iterable[str],
+        targets: Iterable[str] | None = None,
+        dataset_kwargs: dict | None = None,
+        **probe_kwargs,
+) -> tuple[list[ProbeResults], Float[Tensor, "checkpoint layer target"]]:
+    """
+    Probe the same layers of several checkpoints of a run.
+
+    Datasets are built (or loaded from the cache) with ActivationDataset.build,
+    then the probes of all checkpoints and layers are fitted in a single batched call.
+
+    Returns the results for each checkpoint and the stacked test scores.
+    """
+    datasets = [ActivationDataset.build(policy, env, layers, **(dataset_kwargs or {}))
+                for policy in policies]
+
+    labels = datasets[0].labels
+    names = list(datasets[0].features)
+    features = {f"{i}/{name}": dataset.features[name]
+                for i, dataset in enumerate(datasets)
+                for name in names}
+    # Labels that depend on the policy differ between checkpoints, so they cannot be shared.
+    policy_dependent = {"action", "value", "end_goal", "episode_length"}
+    if targets is None:
+        targets = [t for t in labels if t not in policy_dependent]
+    targets = list(targets)
+    if policy_dependent.intersection(targets):
+        raise ValueError(f"Cannot probe policy dependent labels across checkpoints: "
+                         f"{policy_dependent.intersection(targets)}")
+
+    results = probe(features, labels, targets, **probe_kwargs)
+    n_layers = len(names)
+    per_checkpoint = [
+        ProbeResults(
+            names,
+            results.targets,
+            results.classification,
+            results.train_scores[i * n_layers:(i + 1) * n_layers],
+            results.test_scores[i * n_layers:(i + 1) * n_layers],
+        )
+        for i in range(len(datasets))
+    ]
+    return per_checkpoint, results.test_scores.reshape(len(datasets), n_layers, -1)
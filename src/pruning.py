@@ -0,0 +1,346 @@
+"""
+Structured pruning of trained policies.
+
+L1 regularisation drives whole input channels, conv filters and linear units towards zero,
+but the network still computes with them. prune_policy removes them, so that the network
+becomes smaller and faster while computing the same actions.
+"""
+
+from __future__ import annotations
+
+import copy
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import rich
+import rich.table
+import torch
+from torch import Tensor, nn
+
+import architectures
+import utils
+
+__all__ = [
+    "PruningReport",
+    "prune_policy",
+    "count_flops",
+]
+
+
+@dataclass
+class _Segment:
+    """
+    A contiguous group of units in the features flowing through the network.
+
+    producer is the Conv2d/Linear that outputs those units, or None for inputs of the network.
+    Each unit spans `repeat` consecutive features once its spatial dimensions are flattened.
+    size is None when it is not known yet, and is then everything that the other segments don't cover.
+    """
+    size: int | None
+    producer: nn.Module | None = None
+    prunable: bool = True
+    spatial: bool = False
+    repeat: int = 1
+
+    def freeze(self) -> _Segment:
+        return _Segment(self.size and self.size * self.repeat, prunable=False)
+
+
+@dataclass
+class PruningReport:
+    """What was removed by prune_policy, and how much it saved."""
+
+    removed: dict[str, int]
+    flops_before: int
+    flops_after: int
+    latency_before: float
+    latency_after: float
+    max_prob_diff: float
+    max_value_diff: float
+    action_agreement: float
+
+    def __str__(self):
+        lines = [f"{name}: {n} removed" for name, n in self.removed.items()]
+        lines += [
+            f"FLOPs: {self.flops_before:,} -> {self.flops_after:,} ({self.flops_after / self.flops_before:.1%})",
+            f"Latency: {self.latency_before * 1000:.2f}ms -> {self.latency_after * 1000:.2f}ms",
+            f"Max difference of action probabilities: {self.max_prob_diff:.2e}",
+            f"Max difference of values: {self.max_value_diff:.2e}",
+            f"Greedy action agreement: {self.action_agreement:.2%}",
+        ]
+        return "\n".join(lines)
+
+    def show(self):
+        table = rich.table.Table("Layer", "Removed", title="Pruned units")
+        for name, n in self.removed.items():
+            table.add_row(name, str(n))
+        rich.print(table)
+
+        table = rich.table.Table("", "Before", "After", "Ratio", title="Pruning gains")
+        table.add_row("FLOPs", f"{self.flops_before:,}", f"{self.flops_after:,}",
+                      f"{self.flops_after / self.flops_before:.1%}")
+        table.add_row("Latency", f"{self.latency_before * 1000:.2f}ms", f"{self.latency_after * 1000:.2f}ms",
+                      f"{self.latency_after / self.latency_before:.1%}")
+        rich.print(table)
+        rich.print(f"Max prob diff: {self.max_prob_diff:.2e}, max value diff: {self.max_value_diff:.2e}, "
+                   f"action agreement: {self.action_agreement:.2%}")
+
+    def to_dict(self) -> dict[str, object]:
+        return dict(self.__dict__)
+
+
+class _Pruner:
+    """Walks the network in data-flow order, removing the units that are dead."""
+
+    def __init__(self, policy: nn.Module, threshold: float, flatten_shapes: dict[nn.Module, tuple[int, ...]]):
+        self.threshold = threshold
+        self.flatten_shapes = flatten_shapes
+        self.names = {module: name for name, module in policy.named_modules()}
+        self.removed: dict[str, int] = {}
+
+    def walk(self, module: nn.Module, segments: list[_Segment]) -> list[_Segment]:
+        """Prune the module, and return the segments of its output."""
+        if isinstance(module, architectures.WeightDecay):
+            return self.walk(module.module, segments)
+        elif isinstance(module, nn.Sequential):
+            i = 0
+            while i < len(module):
+                layer = module[i]
+                if isinstance(layer, (nn.Linear, nn.Conv2d)):
+                    i += self.consume([layer], segments, parent=module, position=i)
+                    segments = self.produced_by(layer)
+                else:
+                    segments = self.walk(layer, segments)
+                i += 1
+            return segments
+        elif isinstance(module, (nn.Linear, nn.Conv2d)):
+            self.consume([module], segments)
+            return self.produced_by(module)
+        elif isinstance(module, (nn.ReLU, nn.Tanh, nn.Identity)):
+            # Dead units stay (close to) zero after those.
+            return segments
+        elif isinstance(module, nn.Flatten) and all(s.spatial for s in segments):
+            shape = self.flatten_shapes[module]
+            start = module.start_dim % len(shape)
+            end = module.end_dim % len(shape)
+            if start != len(shape) - 3 or end != len(shape) - 1:
+                return [s.freeze() for s in segments]
+            repeat = shape[-1] * shape[-2]
+            return [_Segment(s.size, s.producer, s.prunable, repeat=s.repeat * repeat) for s in segments]
+        elif isinstance(module, (architectures.Rearrange, architectures.Split)):
+            # The structure of the inputs is lost, but they can still be selected
+            # in the first layer that consumes them.
+            is_input = all(s.producer is None and s.prunable for s in segments)
+            if isinstance(module, architectures.Rearrange):
+                return [_Segment(None, prunable=is_input)]
+            left = self.walk(module.left, [_Segment(None, prunable=is_input)])
+            right = self.walk(module.right, [_Segment(None, prunable=is_input)])
+            return left + right
+        else:
+            # Unknown module: nothing before or after it can be pruned.
+            return [_Segment(None, prunable=False)]
+
+    @staticmethod
+    def produced_by(layer: nn.Linear | nn.Conv2d) -> list[_Segment]:
+        if isinstance(layer, nn.Linear):
+            return [_Segment(layer.out_features, layer)]
+        return [_Segment(layer.out_channels, layer, spatial=True)]
+
+    def consume(self, consumers: list[nn.Linear | nn.Conv2d], segments: list[_Segment],
+                parent: nn.Sequential | None = None, position: int = 0) -> int:
+        """
+        Remove the dead units of the segments, which are inputs of the consumers.
+
+        Inputs of the network can only be removed if an IndexSelect can be inserted in the parent,
+        before the consumers. Returns the number of inserted modules.
+        """
+        conv = isinstance(consumers[0], nn.Conv2d)
+        n_in = consumers[0].in_channels if conv else consumers[0].in_features
+        if any(s.spatial != conv and s.producer is not None for s in segments):
+            return 0
+
+        # Find the size of the segment of unknown size
+        unknown = [s for s in segments if s.size is None]
+        known = sum(s.size * s.repeat for s in segments if s.size is not None)
+        if len(unknown) > 1:
+            return 0
+        elif unknown:
+            unknown[0].size = n_in - known
+        assert sum(s.size * s.repeat for s in segments) == n_in, f"Features do not match {consumers[0]}"
+
+        # Concatenate all consumer weights on the output dimension
+        weights = torch.cat([c.weight.detach().flatten(2) if conv else c.weight.detach()
+                             for c in consumers])  # (out, in, ...)
+
+        offset = 0
+        keep_columns = []
+        select = []  # Which of the inputs remaining after removing dead producers units are kept.
+        n_remaining = 0
+        for segment in segments:
+            columns = torch.arange(offset, offset + segment.size * segment.repeat).view(segment.size, -1)
+            offset += segment.size * segment.repeat
+            outgoing = weights[:, columns].transpose(0, 1).flatten(1).norm(dim=1)
+            dead = outgoing < self.threshold
+            if segment.producer is not None:
+                dead |= self.incoming_norms(segment.producer) < self.threshold
+            elif parent is None:
+                dead[:] = False
+            if not segment.prunable:
+                dead[:] = False
+            if dead.all():
+                dead[outgoing.argmax()] = False
+
+            kept = columns[~dead].flatten()
+            keep_columns.append(kept)
+            if segment.producer is not None:
+                self.slice_outputs(segment.producer, ~dead)
+                select.append(torch.arange(n_remaining, n_remaining + len(kept)))
+                n_remaining += len(kept)
+            else:
+                select.append(n_remaining + kept - columns[0, 0])
+                n_remaining += segment.size * segment.repeat
+                if dead.any():
+                    name = self.names.get(consumers[0], "input")
+                    self.removed[f"{name} (inputs)"] = self.removed.get(f"{name} (inputs)", 0) + int(dead.sum())
+
+        keep_columns = torch.cat(keep_columns)
+        select = torch.cat(select)
+        if len(keep_columns) == n_in:
+            return 0
+        for consumer in consumers:
+            self.slice_inputs(consumer, keep_columns)
+
+        if len(select) == n_remaining:
+            return 0
+        parent.insert(position, architectures.IndexSelect(-3 if conv else -1, select))
+        return 1
+
+    @staticmethod
+    def incoming_norms(layer: nn.Linear | nn.Conv2d) -> Tensor:
+        norms = layer.weight.detach().flatten(1).norm(dim=1)
+        if layer.bias is not None:
+            norms = (norms ** 2 + layer.bias.detach() ** 2).sqrt()
+        return norms
+
+    def slice_outputs(self, layer: nn.Linear | nn.Conv2d, keep: Tensor):
+        if keep.all():
+            return
+        self.removed[self.names[layer]] = self.removed.get(self.names[layer], 0) + int((~keep).sum())
+        layer.weight = nn.Parameter(layer.weight.detach()[keep].clone())
+        if layer.bias is not None:
+            layer.bias = nn.Parameter(layer.bias.detach()[keep].clone())
+        if isinstance(layer, nn.Linear):
+            layer.out_features = len(layer.weight)
+        else:
+            layer.out_channels = len(layer.weight)
+
+    @staticmethod
+    def slice_inputs(layer: nn.Linear | nn.Conv2d, columns: Tensor):
+        layer.weight = nn.Parameter(layer.weight.detach()[:, columns].clone())
+        if isinstance(layer, nn.Linear):
+            layer.in_features = len(columns)
+        else:
+            layer.in_channels = len(columns)
+
+
+def count_flops(policy, obs) -> int:
+    """Count the multiply-adds (times 2) of the Linear and Conv2d layers, for one observation."""
+    policy = getattr(policy, "policy", policy)
+    flops = 0
+
+    def hook(module, _input, output):
+        nonlocal flops
+        if isinstance(module, nn.Linear):
+            flops += 2 * module.in_features * output.numel()
+        else:
+            flops += 2 * module.weight[0].numel() * output.numel()
+
+    handles = [m.register_forward_hook(hook) for m in policy.modules() if isinstance(m, (nn.Linear, nn.Conv2d))]
+    try:
+        utils.policy_forward(policy, obs[:1])
+    finally:
+        for handle in handles:
+            handle.remove()
+    return flops
+
+
+def _latency(policy, obs, repeats: int = 5) -> float:
+    """Median time to compute the actions and values of the whole batch."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        utils.policy_forward(policy, obs)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def prune_policy(model, validation_obs, threshold: float = 1e-2, atol: float = 1e-3) -> PruningReport:
+    """
+    Remove the input channels, conv filters and linear units whose weights are all below threshold.
+
+    A unit is removed when the norm of its incoming weights (and bias) or of its outgoing
+    weights is below threshold. Split, Rearrange and Linear shapes are updated, and inputs of the
+    network are dropped with an IndexSelect inserted before the layer that reads them.
+
+    The model (PPO or CustomActorCriticPolicy) is modified in place, and its policy_kwargs are updated
+    so that it can be saved and loaded with its new shapes. If the action probabilities on the
+    validation observations (a batch array) change by more than atol, the model is restored
+    and a ValueError is raised.
+    """
+    policy = getattr(model, "policy", model)
+    validation_obs = np.asarray(validation_obs)
+
+    probs_before, values_before = utils.policy_forward(policy, validation_obs)
+    flops_before = count_flops(policy, validation_obs)
+    latency_before = _latency(policy, validation_obs)
+    backup = copy.deepcopy(policy)
+
+    # Flatten layers need their input shape, to know how many features each channel becomes.
+    flatten_shapes = {}
+
+    def record_shape(module, inputs, _output):
+        flatten_shapes[module] = inputs[0].shape
+
+    handles = [m.register_forward_hook(record_shape) for m in policy.modules() if isinstance(m, nn.Flatten)]
+    utils.policy_forward(policy, validation_obs[:1])
+    for handle in handles:
+        handle.remove()
+
+    pruner = _Pruner(policy, threshold, flatten_shapes)
+    extractor = policy.mlp_extractor
+    if extractor.value_net is None:
+        segments = pruner.walk(extractor.policy_net, [_Segment(None)])
+        pruner.consume([policy.action_net, policy.value_net], segments)
+    else:
+        pruner.consume([policy.action_net], pruner.walk(extractor.policy_net, [_Segment(None)]))
+        pruner.consume([policy.value_net], pruner.walk(extractor.value_net, [_Segment(None)]))
+    extractor.latent_dim_pi = policy.action_net.in_features
+    extractor.latent_dim_vf = policy.value_net.in_features
+
+    probs_after, values_after = utils.policy_forward(policy, validation_obs)
+    max_prob_diff = (probs_after - probs_before).abs().max().item()
+    if max_prob_diff > atol:
+        policy.mlp_extractor = backup.mlp_extractor
+        policy.action_net = backup.action_net
+        policy.value_net = backup.value_net
+        policy.arch = backup.arch
+        raise ValueError(f"Pruning with threshold={threshold} changed action probabilities by "
+                         f"{max_prob_diff:.2e} > {atol}. Use a lower threshold.")
+
+    # The optimizer still references the old parameters.
+    policy.optimizer = policy.optimizer_class(policy.parameters(), lr=policy.optimizer.param_groups[0]["lr"],
+                                              **policy.optimizer_kwargs)
+    if model is not policy:
+        model.policy_kwargs["arch"] = policy.arch
+
+    return PruningReport(
+        removed=pruner.removed,
+        flops_before=flops_before,
+        flops_after=count_flops(policy, validation_obs),
+        latency_before=latency_before,
+        latency_after=_latency(policy, validation_obs),
+        max_prob_diff=max_prob_diff,
+        max_value_diff=(values_after - values_before).abs().max().item(),
+        action_agreement=(probs_after.argmax(-1) == probs_before.argmax(-1)).float().mean().item(),
+    )
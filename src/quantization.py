@@ -0,0 +1,100 @@
+"""
+Int8 dynamic quantization of policies, for faster evaluation on CPU.
+"""
+
+from __future__ import annotations
+
+import copy
+import time
+import warnings
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+from torch import nn
+from torch.ao.quantization import quantize_dynamic
+
+import architectures
+import utils
+
+__all__ = [
+    "QuantizationReport",
+    "quantize_policy",
+]
+
+
+@dataclass
+class QuantizationReport:
+    """Result of quantize_policy."""
+
+    n_quantized: int
+    agreement: float
+    used_quantized: bool
+    # None when the throughput is not measured
+    float_throughput: float | None
+    quantized_throughput: float | None
+
+    def __str__(self):
+        status = "used" if self.used_quantized else "rejected, falling back to float32"
+        out = (f"Int8 policy {status}: {self.n_quantized} layers quantized, "
+               f"{self.agreement:.2%} greedy action agreement")
+        if self.float_throughput is not None:
+            out += f", {self.float_throughput:,.0f} -> {self.quantized_throughput:,.0f} obs/s"
+        return out
+
+
+def _throughput(policy, obs, repeats: int = 5) -> float:
+    """Observations per second of the actor, in batches, best of repeats."""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        utils.predict_batch(policy, obs)
+        best = min(best, time.perf_counter() - start)
+    return len(obs) / best
+
+
+def quantize_policy(model, validation_obs: np.ndarray, min_agreement: float = 0.98,
+                    measure_throughput: bool = True) -> tuple[nn.Module, QuantizationReport]:
+    """
+    Return a copy of the policy whose actor uses int8 weights, with dynamic quantization.
+
+    Only Linear layers of the actor and action head are quantized: PyTorch has no dynamic
+    quantization for convolutions, so they stay in float32. If the greedy actions of the quantized
+    policy agree with the float policy on less than min_agreement of validation_obs,
+    the float policy is returned instead.
+    """
+    policy = getattr(model, "policy", model)
+    quantized = copy.deepcopy(policy)
+    quantized.set_training_mode(False)
+
+    # Batched switched layers read the weights of their copies directly, so they cannot be swapped.
+    skip = {
+        layer
+        for module in quantized.modules()
+        if isinstance(module, architectures.SwitchedLayer) and getattr(module, "mode", "dense") == "batched"
+        for layer in module
+    }
+    to_quantize = {
+        f"mlp_extractor.policy_net.{name}".rstrip(".")
+        for name, module in quantized.mlp_extractor.policy_net.named_modules()
+        if isinstance(module, nn.Linear) and module not in skip
+    }
+    to_quantize.add("action_net")
+    quantize_dynamic(quantized, to_quantize, dtype=torch.qint8, inplace=True)
+
+    float_actions = utils.predict_batch(policy, validation_obs)
+    quantized_actions = utils.predict_batch(quantized, validation_obs)
+    agreement = float((float_actions == quantized_actions).mean())
+
+    report = QuantizationReport(
+        n_quantized=len(to_quantize),
+        agreement=agreement,
+        used_quantized=agreement >= min_agreement,
+        float_throughput=_throughput(policy, validation_obs) if measure_throughput else None,
+        quantized_throughput=_throughput(quantized, validation_obs) if measure_throughput else None,
+    )
+    if not report.used_quantized:
+        warnings.warn(f"Int8 policy agrees on only {agreement:.2%} of greedy actions "
+                      f"(< {min_agreement:.2%}). Using the float32 policy.")
+        return policy, report
+    return quantized, report
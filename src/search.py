@@ -0,0 +1,380 @@
+"""
+Local multi-fidelity hyperparameter search, without wandb sweeps.
+
+Trials are trained by segments, in worker processes. After each segment, the trial is
+scored and checkpointed, and an asynchronous successive halving scheduler (ASHA) decides
+which paused trial to promote to the next rung, or whether to start a new one. With more
+than one bracket, new trials are spread over brackets that start at increasing budgets,
+as in (asynchronous) Hyperband.
+
+The whole state of a study is kept in one json file, so an interrupted study resumes
+where it stopped: trials that were running are paused at their last rung.
+
+    study = Study.open("studies/lr.json", space=dict(initial_lr=Float(1e-4, 1e-1, log=True)),
+                       max_resource=400_000)
+    study.optimize(objective, n_trials=50, jobs=4)
+    study.best()
+
+The objective is called as objective(params, trial_dir, start, stop) -> score, where params
+also contain the seed of the trial. It should train from the checkpoint saved in trial_dir at
+start timesteps up to stop, and save it again. Scores are maximized.
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import json
+import math
+import warnings
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Literal
+
+import numpy as np
+
+__all__ = [
+    "Float",
+    "Int",
+    "Categorical",
+    "parse_param",
+    "RandomSampler",
+    "TPESampler",
+    "Trial",
+    "Study",
+]
+
+
+@dataclass
+class Float:
+    """A float in [low, high], sampled uniformly, or log-uniformly."""
+    low: float
+    high: float
+    log: bool = False
+
+    def to_unit(self, value) -> float:
+        """Map a value to [0, 1], in the space where it is sampled uniformly."""
+        if self.log:
+            return (math.log(value) - math.log(self.low)) / (math.log(self.high) - math.log(self.low))
+        return (value - self.low) / (self.high - self.low)
+
+    def from_unit(self, u: float):
+        u = min(max(u, 0.0), 1.0)
+        if self.log:
+            return math.exp(math.log(self.low) + u * (math.log(self.high) - math.log(self.low)))
+        return self.low + u * (self.high - self.low)
+
+
+@dataclass
+class Int(Float):
+    """An integer in [low, high], both included."""
+
+    def from_unit(self, u: float):
+        return int(round(super().from_unit(u)))
+
+
+@dataclass
+class Categorical:
+    """One of a list of values."""
+    choices: list
+
+
+Param = Float | Int | Categorical
+
+
+def parse_param(spec: str) -> tuple[str, Param]:
+    """
+    Parse a parameter from the command line.
+
+    Formats: "name=low:high" (float), "name=low:high:log", "name=low:high:int",
+    "name=low:high:int:log" and "name=a,b,c" (categorical).
+    """
+    name, _, definition = spec.partition("=")
+    if not definition:
+        raise ValueError(f"Invalid parameter {spec!r}, expected name=definition")
+
+    if ":" not in definition:
+        return name, Categorical([_parse_value(v) for v in definition.split(",")])
+
+    low, high, *flags = definition.split(":")
+    unknown = set(flags) - {"log", "int"}
+    if unknown:
+        raise ValueError(f"Unknown flags {unknown} in parameter {spec!r}")
+    cls = Int if "int" in flags else Float
+    return name, cls(_parse_value(low), _parse_value(high), log="log" in flags)
+
+
+def _parse_value(value: str):
+    for type_ in (int, float):
+        try:
+            return type_(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _param_to_json(param: Param) -> dict:
+    return dict(type=param.__class__.__name__, **dataclasses.asdict(param))
+
+
+def _param_from_json(data: dict) -> Param:
+    data = dict(data)
+    cls = {c.__name__: c for c in (Float, Int, Categorical)}[data.pop("type")]
+    return cls(**data)
+
+
+class RandomSampler:
+    """Sample each parameter independently from its prior."""
+
+    def __init__(self, seed: int | None = None):
+        self.rng = np.random.default_rng(seed)
+
+    def sample_prior(self, space: dict[str, Param]) -> dict[str, object]:
+        params = {}
+        for name, param in space.items():
+            if isinstance(param, Categorical):
+                params[name] = param.choices[self.rng.integers(len(param.choices))]
+            else:
+                params[name] = param.from_unit(self.rng.random())
+        return params
+
+    def suggest(self, space: dict[str, Param], history: list[tuple[dict, float]]) -> dict[str, object]:
+        return self.sample_prior(space)
+
+
+class TPESampler(RandomSampler):
+    """
+    Tree-structured Parzen estimator, with independent parameters.
+
+    Past trials are split in the best `gamma` fraction and the rest, a Parzen density is fit
+    on each set for each parameter, and the candidate with the best ratio between the two
+    densities is suggested. The first `n_startup` trials are sampled from the prior.
+    """
+
+    def __init__(self, seed: int | None = None, gamma: float = 0.25, n_startup: int = 8,
+                 n_candidates: int = 24):
+        super().__init__(seed)
+        self.gamma = gamma
+        self.n_startup = n_startup
+        self.n_candidates = n_candidates
+
+    def suggest(self, space: dict[str, Param], history: list[tuple[dict, float]]) -> dict[str, object]:
+        if len(history) < self.n_startup:
+            return self.sample_prior(space)
+
+        history = sorted(history, key=lambda h: h[1], reverse=True)
+        n_good = max(1, int(math.ceil(self.gamma * len(history))))
+        good = [params for params, _ in history[:n_good]]
+        bad = [params for params, _ in history[n_good:]]
+
+        return {
+            name: self._suggest_categorical(param, [p[name] for p in good], [p[name] for p in bad])
+            if isinstance(param, Categorical) else
+            self._suggest_numeric(param, [p[name] for p in good], [p[name] for p in bad])
+            for name, param in space.items()
+        }
+
+    def _suggest_numeric(self, param: Float, good: list, bad: list):
+        good = np.array([param.to_unit(v) for v in good])
+        bad = np.array([param.to_unit(v) for v in bad])
+        # Scott's rule, but never narrower than 5% of the range
+        bandwidth = max(1.06 * len(good) ** -0.2 * (good.std() if len(good) > 1 else 0.5), 0.05)
+        centers = self.rng.choice(good, self.n_candidates)
+        candidates = np.clip(centers + bandwidth * self.rng.standard_normal(self.n_candidates), 0, 1)
+        score = self._parzen(candidates, good, bandwidth) / self._parzen(candidates, bad, bandwidth)
+        return param.from_unit(float(candidates[np.argmax(score)]))
+
+    @staticmethod
+    def _parzen(x: np.ndarray, points: np.ndarray, bandwidth: float) -> np.ndarray:
+        """Density of a mixture of gaussians at points and of the uniform prior, at x."""
+        kernels = np.exp(-0.5 * ((x[:, None] - points[None]) / bandwidth) ** 2)
+        kernels /= bandwidth * math.sqrt(2 * math.pi)
+        return (kernels.sum(1) + 1) / (len(points) + 1)
+
+    def _suggest_categorical(self, param: Categorical, good: list, bad: list):
+        def smoothed(values):
+            counts = np.array([values.count(c) for c in param.choices]) + 1.0
+            return counts / counts.sum()
+
+        ratio = smoothed(good) / smoothed(bad)
+        weights = ratio / ratio.sum()
+        return param.choices[self.rng.choice(len(param.choices), p=weights)]
+
+
+@dataclass
+class Trial:
+    id: int
+    params: dict[str, object]
+    bracket: int
+    seed: int
+    status: Literal["running", "paused", "completed", "failed"] = "paused"
+    # Score after each segment, keyed by timesteps
+    scores: dict[int, float] = field(default_factory=dict)
+
+    @property
+    def timesteps(self) -> int:
+        """Number of timesteps the trial was trained for."""
+        return max(self.scores, default=0)
+
+    @property
+    def score(self) -> float | None:
+        """Score at the last rung reached."""
+        return self.scores[self.timesteps] if self.scores else None
+
+
+@dataclass
+class Study:
+    """
+    A hyperparameter search over `space`, stored in a json file.
+
+    Args:
+        path: The json file of the study. Trial directories are created next to it.
+        space: The parameters to search, by name.
+        max_resource: Timesteps to train a trial that is promoted to the last rung.
+        min_resource: Timesteps of the first rung of the first bracket.
+        eta: Only the top 1/eta trials of each rung are promoted, and rungs are eta times longer.
+        brackets: Number of Hyperband brackets. 1 is plain ASHA.
+        sampler: "random" or "tpe".
+        seed: Seed of the sampler and of the trials.
+    """
+
+    path: Path
+    space: dict[str, Param]
+    max_resource: int
+    min_resource: int = 25_000
+    eta: int = 3
+    brackets: int = 1
+    sampler: Literal["random", "tpe"] = "tpe"
+    seed: int = 0
+    trials: list[Trial] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.path = Path(self.path)
+        self._sampler = {"random": RandomSampler, "tpe": TPESampler}[self.sampler](self.seed + len(self.trials))
+
+    @classmethod
+    def open(cls, path: str | Path, **kwargs) -> Study:
+        """Load the study at path, or create it with the given arguments if it does not exist."""
+        path = Path(path)
+        if not path.exists():
+            study = cls(path, **kwargs)
+            study.save()
+            return study
+
+        data = json.loads(path.read_text())
+        data["space"] = {name: _param_from_json(p) for name, p in data["space"].items()}
+        data["trials"] = [Trial(**{**t, "scores": {int(k): v for k, v in t["scores"].items()}})
+                          for t in data["trials"]]
+        for name, value in kwargs.items():
+            if name in data and data[name] != value:
+                warnings.warn(f"Study {path} has {name}={data[name]}, ignoring {value}")
+        study = cls(path, **data)
+        # Trials that were running when the study was interrupted resume from their last rung
+        for trial in study.trials:
+            if trial.status == "running":
+                trial.status = "paused"
+        return study
+
+    def save(self):
+        data = dataclasses.asdict(self)
+        data.pop("path")
+        data["space"] = {name: _param_to_json(p) for name, p in self.space.items()}
+        tmp = self.path.with_suffix(".tmp")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_text(json.dumps(data, indent=2))
+        tmp.replace(self.path)
+
+    def trial_dir(self, trial: Trial) -> Path:
+        return self.path.with_suffix("") / str(trial.id)
+
+    def rungs(self, bracket: int) -> list[int]:
+        """Timesteps at which the trials of a bracket are evaluated."""
+        rungs = []
+        resource = self.min_resource * self.eta ** bracket
+        while resource < self.max_resource:
+            rungs.append(int(resource))
+            resource *= self.eta
+        return rungs + [self.max_resource]
+
+    def best(self) -> Trial | None:
+        """The trial with the best score on the highest rung reached by any trial."""
+        scored = [t for t in self.trials if t.scores]
+        if not scored:
+            return None
+        top = max(t.timesteps for t in scored)
+        return max((t for t in scored if t.timesteps == top), key=lambda t: t.score)
+
+    def _promotable(self) -> tuple[Trial, int] | None:
+        """A paused trial in the top 1/eta of its rung, and the next rung, best first."""
+        for bracket in range(self.brackets):
+            rungs = self.rungs(bracket)
+            for k in reversed(range(len(rungs) - 1)):
+                reached = [t for t in self.trials if t.bracket == bracket and rungs[k] in t.scores]
+                n_promoted = len(reached) // self.eta
+                top = sorted(reached, key=lambda t: t.scores[rungs[k]], reverse=True)[:n_promoted]
+                for trial in top:
+                    if trial.status == "paused" and trial.timesteps == rungs[k]:
+                        return trial, rungs[k + 1]
+        return None
+
+    def _history(self) -> list[tuple[dict, float]]:
+        """Scores for the sampler: on the highest rung with enough trials, else on the first rung."""
+        by_rung: dict[int, list[tuple[dict, float]]] = {}
+        for trial in self.trials:
+            for timesteps, score in trial.scores.items():
+                by_rung.setdefault(timesteps, []).append((trial.params, score))
+        enough = [r for r, h in by_rung.items() if len(h) >= getattr(self._sampler, "n_startup", 1)]
+        if enough:
+            return by_rung[max(enough)]
+        return by_rung[min(by_rung)] if by_rung else []
+
+    def next_job(self, n_trials: int) -> tuple[Trial, int] | None:
+        """The next trial to train and up to how many timesteps, or None if there is none now."""
+        promotion = self._promotable()
+        if promotion is not None:
+            return promotion
+        if len(self.trials) < n_trials:
+            trial = Trial(
+                id=len(self.trials),
+                params=self._sampler.suggest(self.space, self._history()),
+                bracket=len(self.trials) % self.brackets,
+                seed=(self.seed * 1_000_003 + len(self.trials)) % 2 ** 32,
+            )
+            self.trials.append(trial)
+            return trial, self.rungs(trial.bracket)[0]
+        return None
+
+    def optimize(self, objective: Callable[[dict, Path, int, int], float], n_trials: int, jobs: int = 1):
+        """
+        Run trials until n_trials were started and no trial can be promoted anymore.
+
+        The objective is run in `jobs` worker processes and the study is saved after each segment.
+        """
+        running: dict[Future, tuple[Trial, int]] = {}
+        with ProcessPoolExecutor(jobs) as executor:
+            while True:
+                while len(running) < jobs and (job := self.next_job(n_trials)) is not None:
+                    trial, stop = job
+                    trial.status = "running"
+                    directory = self.trial_dir(trial)
+                    directory.mkdir(parents=True, exist_ok=True)
+                    future = executor.submit(objective, trial.params | dict(seed=trial.seed),
+                                             directory, trial.timesteps, stop)
+                    running[future] = trial, stop
+                    self.save()
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    trial, stop = running.pop(future)
+                    try:
+                        trial.scores[stop] = float(future.result())
+                        trial.status = "completed" if stop >= self.max_resource else "paused"
+                    except Exception as e:
+                        warnings.warn(f"Trial {trial.id} failed: {e!r}")
+                        trial.status = "failed"
+                    print(f"Trial {trial.id} {trial.status} at {stop} timesteps, "
+                          f"score={trial.score}, params={trial.params}")
+                self.save()
@@ -5,9 +5,12 @@ Train agents on different environments and setups.
 """
 
 import dataclasses
+import functools
 import json
+import os
 import random
 import re
+import tempfile
 import warnings
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
@@ -16,16 +19,21 @@ from pprint import pprint
 from typing import Callable, Generator, Optional
 
 import click
+from click.core import ParameterSource
 import gymnasium as gym
+import numpy as np
 import rich
 import rich.table
 import rich.console
+import torch
 import torchinfo
 import wandb
 from joblib import Parallel, delayed
 from stable_baselines3 import PPO
 from stable_baselines3.common.callbacks import BaseCallback, CheckpointCallback, EvalCallback, EveryNTimesteps
 from stable_baselines3.common.env_util import make_vec_env
+from stable_baselines3.common.evaluation import evaluate_policy
+from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv
 from torch import nn
 from tqdm.autonotebook import tqdm
 
@@ -33,10 +41,12 @@ try:
     import src
 except ModuleNotFoundError:
     import __init__ as src
+from benchmarks import harness, suite  # noqa: F401, registers the benchmarks
 
 HERE = Path(__file__).parent
 ROOT = HERE.parent
 MODELS_DIR = ROOT / "models"
+BENCHMARKS_DIR = ROOT / "benchmark_results"
 
 # Remove UserWarning in LazyModules about it being an experimental feature
 warnings.filterwarnings("ignore", module="torch.nn.modules.lazy")
@@ -105,10 +115,76 @@ class Experiment(ABC):
         default=None,
         metadata=dict(help="Seed to use"),
     )
+    quantize_eval: bool = field(
+        default=False,
+        metadata=dict(help="Evaluate an int8 quantized copy of the policy, if it agrees with the float one"),
+    )
+    metrics_every: int = field(
+        default=2_048,
+        metadata=dict(help="Log the per-step metrics every this many steps"),
+    )
+    early_stopping_patience: int = field(
+        default=0,
+        metadata=dict(help="Stop training after this many checks without improvement. 0 to disable"),
+    )
+    early_stopping_min_delta: float = field(
+        default=0.01,
+        metadata=dict(help="Minimum increase of the score to count as an improvement"),
+    )
+    early_stopping_eval_every: int = field(
+        default=0,
+        metadata=dict(help="Score with a cheap evaluation every this many timesteps. "
+                           "0 to use the mean reward of the last rollouts"),
+    )
+    batch_size: int = field(
+        default=64,
+        metadata=dict(help="Minibatch size of the PPO updates"),
+    )
+    vec_env: str = field(
+        default="dummy",
+        metadata=dict(help="Vectorized env backend: dummy (same process) or subproc (one process per env)"),
+    )
+    torch_threads: int = field(
+        default=0,
+        metadata=dict(help="Number of threads used by torch. 0 for torch's default"),
+    )
+    use_autotune: bool = field(
+        default=True,
+        metadata=dict(help="Use the autotuned throughput settings of this host for the options not given"),
+    )
+    save_dir: str = field(
+        default=None,
+        metadata=dict(help="Where to save the models. Defaults to a new folder in models/"),
+    )
 
     def __post_init__(self):
-        self.save_dir = find_filename(MODELS_DIR / self.name(), ext="")
-        self.save_dir.mkdir(parents=True, exist_ok=False)
+        # Set by run(), callbacks log nothing without it
+        self.metrics = None
+        # Computed once, by the first quantized evaluation
+        self._validation_obs = None
+
+        if self.save_dir is None:
+            self.save_dir = find_filename(MODELS_DIR / self.name(), ext="")
+            self.save_dir.mkdir(parents=True, exist_ok=False)
+        else:
+            self.save_dir = Path(self.save_dir)
+            self.save_dir.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def autotune_file(cls) -> Path:
+        """Where the autotuned settings of each host are stored"""
+        return MODELS_DIR / cls.name() / "autotune.json"
+
+    @classmethod
+    def apply_autotune(cls, kwargs: dict[str, object], given: set[str],
+                       tuned: dict[str, object]) -> dict[str, object]:
+        """Replace the arguments not given by the user by the tuned settings, and say which ones"""
+        field_names = {f.name for f in dataclasses.fields(cls)}
+        overrides = {name: value for name, value in tuned.items()
+                     if name in field_names and name not in given and kwargs.get(name) != value}
+        if overrides:
+            click.secho(f"Using the autotuned settings of this host: {overrides}", fg="yellow")
+        return kwargs | overrides
 
     @classmethod
     def name(cls) -> str:
@@ -129,17 +205,16 @@ class Experiment(ABC):
         else:
             seed = self.seed
 
-        # Define the policy network
-        policy = PPO(
-            src.CustomActorCriticPolicy,
-            make_vec_env(self.get_train_env, n_envs=self.n_envs),
-            policy_kwargs=dict(arch=self.get_arch(), **self.policy_kwargs()),
-            n_steps=2_048 // self.n_envs,
-            tensorboard_log=str(ROOT / "run_logs"),
-            learning_rate=lambda f: f * self.initial_lr,
-            seed=seed,
-            device='cpu',
-        )
+        if self.torch_threads:
+            torch.set_num_threads(self.torch_threads)
+
+        policy = self.make_policy(seed)
+
+        # Metrics go to tensorboard next to sb3's logs, and to wandb or to a local file when it is disabled.
+        # The writer is created before wandb.init, so sync_tensorboard does not upload the metrics twice.
+        sinks = [src.TensorboardSink(ROOT / "run_logs" / f"metrics_{self.save_dir.name}")]
+        sinks.append(src.WandbSink() if self.use_wandb else src.JsonlSink(self.save_dir / "metrics.jsonl"))
+        self.metrics = src.Metrics(sinks)
 
         # Start wandb and define callbacks
         callbacks = [src.ProgressBarCallback(), *self.get_callbacks()]
@@ -152,15 +227,24 @@ class Experiment(ABC):
                     self.experiment = experiment
 
                 def _on_event(self):
-                    checkpoint_evaluation = self.experiment.evaluate(self.model)
-                    if self.experiment.use_wandb:
-                        wandb.log(checkpoint_evaluation, commit=False)
+                    checkpoint_evaluation = self.experiment.evaluate(
+                        self.experiment.eval_policy(self.model, checkpoint=True))
+                    self.experiment.metrics.log(checkpoint_evaluation, step=self.num_timesteps)
                     self.experiment.save(policy,
                                          dict(timesteps=self.num_timesteps, eval=checkpoint_evaluation),
                                          self.num_timesteps)
 
             callbacks.append(CheckpointEvalCallback(steps_per_checkpoint, self))
 
+        early_stopping = None
+        if self.early_stopping_patience:
+            score = None
+            if self.early_stopping_eval_every:
+                score = lambda model: self.objective(model, n_episodes=100)
+            early_stopping = src.EarlyStoppingCallback(self.early_stopping_patience, self.early_stopping_min_delta,
+                                                       score=score, every=self.early_stopping_eval_every)
+            callbacks.append(early_stopping)
+
         if self.use_wandb:
             wandb.init(
                 sync_tensorboard=True,  # auto-upload sb3's tensorboard metrics
@@ -170,25 +254,50 @@ class Experiment(ABC):
             )
             callbacks.append(src.WandbWithBehaviorCallback(self.get_eval_env()))
 
-        # Train the agent
-        policy.learn(
-            total_timesteps=self.total_timesteps,
-            callback=callbacks,
-        )
+        try:
+            # Train the agent
+            policy.learn(
+                total_timesteps=self.total_timesteps,
+                callback=callbacks,
+            )
 
-        evaluation = self.evaluate(policy)
+            evaluation = self.evaluate(self.eval_policy(policy))
 
-        self.save(policy, dict(
-            eval=evaluation,
-            args=args,
-            id=wandb.run.id if self.use_wandb else None,
-        ))
+            self.save(policy, dict(
+                eval=evaluation,
+                args=args,
+                id=wandb.run.id if self.use_wandb else None,
+                stopped_at=early_stopping.stopped_at if early_stopping else None,
+            ))
 
-        # Log the evaluation stats, and exit
+            # Log the evaluation stats, and exit
+            self.metrics.log(evaluation, step=policy.num_timesteps)
+        finally:
+            self.metrics.close()
         if self.use_wandb:
-            wandb.log(evaluation, commit=False)
             wandb.finish()
 
+    def make_policy(self, seed: int) -> PPO:
+        """Return the untrained PPO agent"""
+        vec_env_cls = dict(dummy=DummyVecEnv, subproc=SubprocVecEnv)[self.vec_env]
+        return PPO(
+            src.CustomActorCriticPolicy,
+            make_vec_env(self.get_train_env, n_envs=self.n_envs, vec_env_cls=vec_env_cls),
+            policy_kwargs=dict(arch=self.get_arch(), **self.policy_kwargs()),
+            n_steps=2_048 // self.n_envs,
+            batch_size=self.batch_size,
+            tensorboard_log=str(ROOT / "run_logs"),
+            learning_rate=self.lr_schedule(),
+            seed=seed,
+            device='cpu',
+        )
+
+    def lr_schedule(self) -> Callable[[float], float]:
+        """Return the learning rate as a function of the remaining progress"""
+        # Do not capture self: the schedule is pickled with the model
+        initial_lr = self.initial_lr
+        return lambda f: f * initial_lr
+
     def policy_kwargs(self) -> dict[str, object]:
         """Return the keyword arguments to pass to the policy"""
         return {}
@@ -213,10 +322,45 @@ class Experiment(ABC):
         """Evaluate the agent. Return a json serializable dictionary of evaluation stats."""
         raise NotImplementedError()
 
+    def objective(self, policy, n_episodes: int) -> float:
+        """Cheap score of the agent, maximized by hyperparameter searches: its mean training reward."""
+        mean_reward, _std = evaluate_policy(policy, self.get_train_env(), n_eval_episodes=n_episodes)
+        return float(mean_reward)
+
+    def validation_obs(self, n_states: int = 10_000) -> np.ndarray:
+        """Observations of random states, seen through both the train and eval wrappers."""
+        states = src.ThreeGoalsStates.sample(self.env_size, n_states, seed=0)
+        return np.concatenate([
+            src.observe_states(env, states)
+            for env in (self.get_train_env(), self.get_eval_env())
+        ])
+
+    def eval_policy(self, policy, checkpoint: bool = False):
+        """Return the policy to evaluate: the trained one, or its int8 version if quantize_eval is set.
+
+        Checkpoint evaluations skip the throughput measurement. The report goes to the metrics, or is printed
+        when there are none.
+        """
+        if not self.quantize_eval:
+            return policy
+        if self._validation_obs is None:
+            self._validation_obs = self.validation_obs()
+        quantized, report = src.quantize_policy(policy, self._validation_obs, measure_throughput=not checkpoint)
+        if self.metrics is None:
+            print(report)
+        else:
+            values = {"quantization/agreement": report.agreement,
+                      "quantization/used_quantized": float(report.used_quantized)}
+            if report.float_throughput is not None:
+                values["quantization/float_throughput"] = report.float_throughput
+                values["quantization/quantized_throughput"] = report.quantized_throughput
+            self.metrics.log(values, step=policy.num_timesteps)
+        return quantized
+
     def get_callbacks(self) -> list[BaseCallback]:
         """Return a list of SB3 callbacks to use during training."""
         return [
-            src.LogChannelNormsCallback(),
+            src.LogChannelNormsCallback(self.metrics, self.metrics_every),
             src.WeightDecayCallback(lambda f: (1 - f) * self.final_wd),
         ]
 
@@ -316,6 +460,27 @@ class Experiment(ABC):
             policy = PPO.load(filename)
         return policy, metadata
 
+    @classmethod
+    def prune(cls, idx: int, threshold: float, checkpoint: Optional[int] = None,
+              n_states: int = 10_000) -> "Experiment":
+        """Prune the dead units of a trained model, and save it as a new run of the experiment."""
+        policy, metadata = cls.load(idx, checkpoint)
+        # Rebuild the experiment the model was trained with, so that it is evaluated on the same env
+        field_names = {f.name for f in dataclasses.fields(cls) if f.init}
+        args = {k: v for k, v in metadata.get("args", {}).items() if k in field_names}
+        experiment = cls(**args | dict(use_wandb=False, use_autotune=False, save_dir=None))
+
+        report = src.prune_policy(policy, experiment.validation_obs(n_states), threshold)
+        report.show()
+
+        experiment.save(policy, dict(
+            eval=experiment.evaluate(policy),
+            args=metadata.get("args"),
+            pruned_from=dict(idx=idx, checkpoint=checkpoint, threshold=threshold),
+            pruning=report.to_dict(),
+        ))
+        return experiment
+
     @classmethod
     def all_experiments(cls) -> Generator["Experiment", None, None]:
         """Return all experiments classes"""
@@ -343,9 +508,16 @@ class Experiment(ABC):
         )
         # Meta options
         @click.option("--n-agents", default=1, help="Number of agents to train")
-        @click.option("--jobs", default=1, help="Number of jobs to run in parallel")
+        @click.option("--jobs", type=int, default=None,
+                      help="Number of jobs to run in parallel. Defaults to the autotuned number, or 1")
         @click.option("--dry-run", is_flag=True, help="Don't actually run the experiment")
         def _cmd(jobs, n_agents, dry_run, **kwargs):
+            tuned = {}
+            if kwargs["use_autotune"]:
+                ctx = click.get_current_context()
+                given = {name for name in kwargs if ctx.get_parameter_source(name) != ParameterSource.DEFAULT}
+                tuned = src.load_tuned(cls.autotune_file()) or {}
+                kwargs = cls.apply_autotune(kwargs, given, tuned)
 
             experiment = cls(**kwargs)
 
@@ -361,6 +533,9 @@ class Experiment(ABC):
                 torchinfo.summary(experiment.get_arch(), input_size=obs.shape, depth=99)
                 return
 
+            if jobs is None:
+                jobs = tuned.get("jobs", 1)
+
             if n_agents != 1:
                 Parallel(n_jobs=jobs)(delayed(experiment.run)() for _ in range(n_agents))
             else:
@@ -494,6 +669,45 @@ class BlindThreeGoalsOneHot(Experiment):
             lambda env: src.AddTrueGoalToObsFlat(env),
         )
 
+
+@dataclass
+class BlindThreeGoalsTokens(BlindThreeGoals):
+    """
+    Blind version of ThreeGoalsEnv, observed as a list of objects
+
+    The agent sees the (type, x, y) of each object instead of the grid, so the size of
+    the observation does not grow with the size of the grid. Red and green goals have the
+    same type.
+    """
+
+    def get_arch(self) -> nn.Module:
+        env = src.ThreeGoalsEnv(self.env_size, obs_mode="tokens")
+        return nn.Sequential(
+            src.Split(
+                env.n_tokens * 3,
+                left=src.TokenEncoder(len(env.ALL_CELLS), env.width, env.height, env.n_tokens),
+                right=nn.Identity(),
+            ),
+            nn.LazyLinear(32),
+            nn.ReLU(),
+            nn.Linear(32, 32),
+            nn.ReLU(),
+        )
+
+    def get_env(self, full_color: bool) -> Callable[[], gym.Env]:
+        return src.wrap(
+            lambda: src.ThreeGoalsEnv(self.env_size, step_reward=0.0, obs_mode="tokens"),
+            lambda env: src.TokenColorBlindWrapper(env, reward_indistinguishable_goals=True, disabled=full_color),
+            lambda env: src.AddTrueGoalToObsFlat(env),
+        )
+
+    def get_callbacks(self) -> list[BaseCallback]:
+        # There is no convolution to log the channel norms of
+        return [
+            src.WeightDecayCallback(lambda f: (1 - f) * self.final_wd),
+        ]
+
+
 @dataclass
 class BlindThreeGoalsRgbChannelReg(BlindThreeGoals):
     """
@@ -549,7 +763,7 @@ class BlindThreeGoalWeightedChannel(BlindThreeGoalsOneHot):
         # We don't want to use the L1WeightDecay callback
         # But still log the norm of Conv1
         return [
-            src.LogChannelNormsCallback(),
+            src.LogChannelNormsCallback(self.metrics, self.metrics_every),
         ]
 
     def get_env(self, full_color: bool, weighted: bool = True) -> Callable[[], gym.Env]:
@@ -576,6 +790,208 @@ def cli():
     """Train agents on different environments and setups."""
 
 
+@cli.command()
+@click.argument("experiment", type=click.Choice([e.name() for e in Experiment.all_experiments()]))
+@click.argument("idx", type=int)
+@click.option("--threshold", default=1e-2, show_default=True,
+              help="Units whose incoming or outgoing weights have a smaller norm are removed")
+@click.option("--checkpoint", type=int, default=None, help="Prune this checkpoint instead of the final model")
+def prune(experiment: str, idx: int, threshold: float, checkpoint: Optional[int]):
+    """Prune the dead units of a trained model, and save it as a new run."""
+    experiment_cls = next(e for e in Experiment.all_experiments() if e.name() == experiment)
+    pruned = experiment_cls.prune(idx, threshold, checkpoint)
+    print(f"Pruned model saved in {pruned.save_dir}")
+
+
+class StopAtTimesteps(BaseCallback):
+    """
+    Stop training once the given number of timesteps is reached.
+
+    The rollout that reaches it is completed and trained on, and training stops at the
+    first step of the next one, as with EarlyStoppingCallback.
+    """
+
+    def __init__(self, timesteps: int):
+        super().__init__()
+        self.timesteps = timesteps
+        self.reached = False
+
+    def _on_rollout_end(self) -> None:
+        self.reached = self.num_timesteps >= self.timesteps
+
+    def _on_step(self) -> bool:
+        return not self.reached
+
+
+def train_trial(experiment_cls: type[Experiment], total_timesteps: int, eval_episodes: int,
+                params: dict, trial_dir: Path, start: int, stop: int) -> float:
+    """Train a trial of a search from start to stop timesteps, checkpoint it and return its objective."""
+    experiment = experiment_cls(use_wandb=False, total_timesteps=total_timesteps, save_dir=str(trial_dir),
+                                **params)
+    checkpoint = experiment.save_dir / "model.zip"
+
+    if start:
+        policy = PPO.load(checkpoint, env=make_vec_env(experiment.get_train_env, n_envs=experiment.n_envs),
+                          device='cpu', custom_objects=dict(learning_rate=experiment.lr_schedule()))
+    else:
+        policy = experiment.make_policy(experiment.seed)
+
+    experiment.metrics = src.Metrics([src.JsonlSink(experiment.save_dir / "metrics.jsonl")])
+    try:
+        # Train up to total_timesteps, so that the schedules are those of an uninterrupted run
+        policy.learn(
+            total_timesteps=experiment.total_timesteps - policy.num_timesteps,
+            callback=[*experiment.get_callbacks(), StopAtTimesteps(stop)],
+            reset_num_timesteps=False,
+        )
+    finally:
+        experiment.metrics.close()
+
+    policy.save(checkpoint)
+    return experiment.objective(policy, eval_episodes)
+
+
+@cli.command()
+@click.argument("experiment", type=click.Choice([e.name() for e in Experiment.all_experiments()]))
+@click.option("--study", "study_name", default="default", show_default=True,
+              help="Name of the study. Running the command again resumes it")
+@click.option("--param", "params", multiple=True,
+              help="Parameter to search, as name=low:high[:int][:log] or name=a,b,c. "
+                   "Defaults to initial_lr and final_wd")
+@click.option("--n-trials", default=32, show_default=True, help="Number of trials to start")
+@click.option("--jobs", default=1, show_default=True, help="Number of trials to train in parallel")
+@click.option("--sampler", type=click.Choice(["random", "tpe"]), default="tpe", show_default=True)
+@click.option("--total-timesteps", default=400_000, show_default=True,
+              help="Timesteps of the trials that reach the last rung")
+@click.option("--min-timesteps", default=25_000, show_default=True, help="Timesteps of the first rung")
+@click.option("--eta", default=3, show_default=True, help="Keep the top 1/eta trials at each rung")
+@click.option("--brackets", default=1, show_default=True, help="Number of Hyperband brackets. 1 is ASHA")
+@click.option("--eval-episodes", default=200, show_default=True, help="Episodes to score a trial")
+@click.option("--seed", default=0, show_default=True)
+def search(experiment: str, study_name: str, params: tuple[str, ...], n_trials: int, jobs: int,
+           sampler: str, total_timesteps: int, min_timesteps: int, eta: int, brackets: int,
+           eval_episodes: int, seed: int):
+    """Search hyperparameters of an experiment locally, with early stopping of bad trials (ASHA)."""
+    experiment_cls = next(e for e in Experiment.all_experiments() if e.name() == experiment)
+
+    space = dict(map(src.parse_param, params)) or dict(
+        initial_lr=src.Float(1e-4, 1e-1, log=True),
+        final_wd=src.Float(1e-5, 1e-1, log=True),
+    )
+    fields = {f.name for f in dataclasses.fields(experiment_cls)}
+    assert set(space) <= fields, f"Unknown parameters {set(space) - fields} for {experiment}"
+
+    study = src.Study.open(
+        MODELS_DIR / experiment / "studies" / f"{study_name}.json",
+        space=space,
+        max_resource=total_timesteps,
+        min_resource=min_timesteps,
+        eta=eta,
+        brackets=brackets,
+        sampler=sampler,
+        seed=seed,
+    )
+    objective = functools.partial(train_trial, experiment_cls, total_timesteps, eval_episodes)
+    study.optimize(objective, n_trials, jobs)
+
+    best = study.best()
+    print(f"Best trial: {best.id} with score {best.score} after {best.timesteps} timesteps")
+    pprint(best.params)
+
+
+def _make_probe_model(experiment: Experiment, config: dict) -> PPO:
+    policy = dataclasses.replace(experiment, **config).make_policy(seed=0)
+    # Probes are not worth a tensorboard run
+    policy.tensorboard_log = None
+    return policy
+
+
+@cli.command()
+@click.argument("experiment", type=click.Choice([e.name() for e in Experiment.all_experiments()]))
+@click.option("--n-envs", "n_envs", default="1,2,4,8,16", show_default=True, help="Numbers of envs to try")
+@click.option("--vec-env", "vec_env", default="dummy,subproc", show_default=True, help="Backends to try")
+@click.option("--batch-size", "batch_size", default="64,128,256,512", show_default=True,
+              help="Batch sizes to try")
+@click.option("--torch-threads", "torch_threads", default=None,
+              help="Numbers of torch threads to try. Defaults to powers of two up to the number of cores")
+@click.option("--rollouts", default=3, show_default=True, help="Number of timed rollouts of each probe")
+@click.option("--max-jobs", type=int, default=None, help="Maximum number of concurrent jobs to try")
+def autotune(experiment: str, n_envs: str, vec_env: str, batch_size: str, torch_threads: Optional[str],
+             rollouts: int, max_jobs: Optional[int]):
+    """Measure the training throughput of candidate settings, and store the best for this host."""
+    experiment_cls = next(e for e in Experiment.all_experiments() if e.name() == experiment)
+    if torch_threads is None:
+        torch_threads = ",".join(str(2 ** i) for i in range(os.cpu_count().bit_length()))
+
+    candidates = dict(
+        n_envs=[int(n) for n in n_envs.split(",")],
+        vec_env=vec_env.split(","),
+        batch_size=[int(b) for b in batch_size.split(",")],
+        torch_threads=[int(t) for t in torch_threads.split(",")],
+    )
+
+    with tempfile.TemporaryDirectory() as save_dir:
+        base = experiment_cls(use_wandb=False, use_autotune=False, save_dir=save_dir)
+        config, probes = src.autotune(functools.partial(_make_probe_model, base), candidates, rollouts, max_jobs)
+
+    src.save_tuned(experiment_cls.autotune_file(), config, probes)
+    print(f"Best settings, saved in {experiment_cls.autotune_file()}:")
+    pprint(config)
+
+
+@cli.command()
+@click.option("--filter", "filter_", default="", help="Only run the benchmarks whose name contains this")
+@click.option("--kind", type=click.Choice(["micro", "macro", "all"]), default="all", show_default=True)
+@click.option("--sizes", default=None, help="Env sizes to use, comma separated. Defaults to 4 to 64")
+@click.option("--batch-sizes", default=None, help="Batch sizes to use, comma separated. Defaults to 1 to 4096")
+@click.option("--repeats", default=20, show_default=True, help="Minimum number of timed calls of micro benchmarks")
+@click.option("--output", type=click.Path(path_type=Path), default=BENCHMARKS_DIR / "latest.json",
+              show_default=True, help="Where to write the results")
+@click.option("--baseline", type=click.Path(exists=True, path_type=Path), default=None,
+              help="Results to compare against. Exits with an error if any benchmark regressed")
+@click.option("--threshold", default=0.1, show_default=True,
+              help="Relative slowdown, or growth of the peak memory, counted as a regression")
+def bench(filter_: str, kind: str, sizes: Optional[str], batch_sizes: Optional[str], repeats: int,
+          output: Path, baseline: Optional[Path], threshold: float):
+    """Run the benchmarks of the environments, policy and training, and compare them to a baseline."""
+    overrides = dict(
+        size=sizes and tuple(int(s) for s in sizes.split(",")),
+        batch_size=batch_sizes and tuple(int(b) for b in batch_sizes.split(",")),
+    )
+    to_run = [b for name, b in harness.BENCHMARKS.items()
+              if filter_ in name and kind in (b.kind, "all")]
+
+    results = []
+    for benchmark in to_run:
+        for params in benchmark.cases(overrides):
+            result = harness.run_case(benchmark, params, repeats)
+            print(f"{result.key:<50} {result.mean_ms:10.3f} ms ± {result.std_ms:8.3f}  "
+                  f"{result.items_per_s:12,.0f} items/s  {result.peak_memory_mb:8.2f} MB ({result.memory_method})")
+            results.append(result)
+    harness.save_results(results, output)
+    print(f"Saved {len(results)} results to {output}")
+
+    if baseline is None:
+        return
+
+    table = rich.table.Table("Benchmark", "Baseline (ms)", "Now (ms)", "Change",
+                             "Baseline (MB)", "Now (MB)", "Memory change", title=f"Compared to {baseline}")
+    regressions = 0
+    for comparison in harness.compare(results, harness.load_results(baseline)):
+        regressed = comparison.regressed(threshold)
+        regressions += regressed
+        style = "red" if regressed else "green" if comparison.slowdown < -threshold else None
+        memory_change = "n/a" if comparison.memory_growth is None else f"{comparison.memory_growth:+.1%}"
+        table.add_row(comparison.result.key, f"{comparison.baseline.mean_ms:.3f}",
+                      f"{comparison.result.mean_ms:.3f}", f"{comparison.slowdown:+.1%}",
+                      f"{comparison.baseline.peak_memory_mb:.2f}", f"{comparison.result.peak_memory_mb:.2f}",
+                      memory_change, style=style)
+    rich.print(table)
+    if regressions:
+        raise click.ClickException(f"{regressions} benchmarks are more than {threshold:.0%} slower, "
+                                   f"or use more than {threshold:.0%} more memory, than the baseline")
+
+
 for e in Experiment.all_experiments():
     cli.add_command(e.make_command())
 
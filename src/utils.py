@@ -1,12 +1,17 @@
 from __future__ import annotations
 
+import copy
+import fnmatch
 import itertools
+import queue
+import threading
 import warnings
 from collections import defaultdict
 from contextlib import contextmanager
 from dataclasses import dataclass
 from itertools import groupby
-from typing import TypeVar, Callable, Literal, Union, TYPE_CHECKING
+from pathlib import Path
+from typing import TypeVar, Callable, Literal, Union, TYPE_CHECKING, Iterable
 
 import einops
 import gymnasium as gym
@@ -27,6 +32,8 @@ from wandb.integration.sb3 import WandbCallback
 
 import architectures
 import environments
+import wrappers
+from metrics import Metrics
 
 if TYPE_CHECKING:
     from environments import ThreeGoalsEnv
@@ -260,6 +267,94 @@ def record_activations(module: nn.Module) -> Cache:
             print("-", name)
 
 
+@contextmanager
+def stream_activations(module: nn.Module,
+                       patterns: str | Iterable[str],
+                       capacity: int,
+                       spill_dir: str | Path | None = None,
+                       spill_threshold: int = 2 ** 30) -> Cache:
+    """Context manager to record activations of some submodules into preallocated buffers.
+
+    Unlike record_activations, only the modules whose name matches one of the patterns
+    are hooked, and each output is copied straight into a buffer of `capacity` rows,
+    so memory does not grow with the number of forward passes.
+    Outputs of successive calls are concatenated along their first (batch) dimension.
+
+    Args:
+        module: Module to record activations from.
+        patterns: fnmatch patterns, matched against the same names as in record_activations,
+            that is "{path} {ClassName}", for instance "*left.1 *" or "*Conv2d".
+        capacity: Maximum number of rows recorded for each module.
+        spill_dir: If given, buffers larger than spill_threshold bytes are memory-mapped
+            .npy files in this directory instead of living in RAM.
+        spill_threshold: Size in bytes above which buffers are spilled to disk.
+
+    Yields:
+        Cache: Populated with the recorded rows once the context manager is exited.
+    """
+
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    patterns = list(patterns)
+
+    cache = Cache()
+    buffers: dict[str, Tensor] = {}
+    filled: dict[str, int] = {}
+    hooks = []
+    skipped = set()
+
+    module_to_name = {m: f"{n} {m.__class__.__name__}" for n, m in module.named_modules()}
+    to_record = [m for m, name in module_to_name.items()
+                 if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+    if not to_record:
+        warnings.warn(f"No module matches {patterns}", UserWarning)
+
+    def allocate(name: str, output: Tensor) -> Tensor:
+        shape = (capacity, *output.shape[1:])
+        n_bytes = output[:1].numel() * output.element_size() * capacity
+        if spill_dir is not None and n_bytes > spill_threshold:
+            Path(spill_dir).mkdir(parents=True, exist_ok=True)
+            filename = Path(spill_dir) / (name.replace(" ", "_") + ".npy")
+            dtype = torch.empty((), dtype=output.dtype).numpy().dtype
+            array = np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+            return torch.from_numpy(array)
+        return torch.empty(shape, dtype=output.dtype)
+
+    def hook(m: nn.Module, input: Tensor, output: Tensor):
+        name = module_to_name[m]
+        if not isinstance(output, Tensor):
+            skipped.add(name)
+            return
+
+        if name not in buffers:
+            buffers[name] = allocate(name, output)
+            filled[name] = 0
+
+        start = filled[name]
+        end = start + len(output)
+        if end > capacity:
+            raise RuntimeError(f"Activation buffer of {name} is full (capacity={capacity}).")
+        buffers[name][start:end] = output.detach()
+        filled[name] = end
+
+    for m in to_record:
+        hooks.append(m.register_forward_hook(hook))
+
+    try:
+        yield cache
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    for name, buffer in buffers.items():
+        cache[name] = buffer[:filled[name]]
+
+    if skipped:
+        print("Skipped:")
+        for name in skipped:
+            print("-", name)
+
+
 # noinspection PyDefaultArgument
 def unique(x, *, __previous=set()):
     """Return the argument, if it was never seen before, otherwise raise ValueError"""
@@ -270,18 +365,60 @@ def unique(x, *, __previous=set()):
 
 
 class WandbWithBehaviorCallback(WandbCallback):
+    """
+    WandbCallback that also logs a video-strip of the behavior of the agent every show_every rollouts.
+
+    The behavior is rendered and logged by a background thread, on a copy of the policy,
+    so that the training thread only copies the weights. If the thread is still busy with a
+    previous snapshot, the older pending snapshot is dropped.
+    """
+
     def __init__(self, env: gym.Env, show_every=10, **kwargs):
         self.env = env
         self.show_every = show_every
         self.time = 0
+        self.dropped = 0
+        self._requests: queue.Queue[dict[str, Tensor] | None] = queue.Queue(maxsize=1)
+        self._worker: threading.Thread | None = None
+        self._policy = None
         super().__init__(**kwargs)
 
+    def _init_callback(self) -> None:
+        super()._init_callback()
+        self._policy = copy.deepcopy(self.model.policy)
+        self._worker = threading.Thread(target=self._show_behaviors, name="show-behavior", daemon=True)
+        self._worker.start()
+
     def _on_rollout_start(self) -> None:
         super()._on_rollout_start()
         # Show every 10 rollouts
         self.time += 1
         if self.time % self.show_every == 0:
-            show_behavior(self.model, self.env, max_len=20, add_to_wandb=True, plot=False)
+            snapshot = {name: tensor.detach().clone() for name, tensor in self.model.policy.state_dict().items()}
+            try:
+                self._requests.put_nowait(snapshot)
+            except queue.Full:
+                # Replace the stale snapshot, the worker did not start it yet
+                try:
+                    self._requests.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+                self._requests.put_nowait(snapshot)
+
+    def _on_training_end(self) -> None:
+        super()._on_training_end()
+        # Let the last behavior be logged before wandb is closed
+        self._requests.put(None)
+        self._worker.join()
+
+    def _show_behaviors(self):
+        while (snapshot := self._requests.get()) is not None:
+            self._policy.load_state_dict(snapshot)
+            try:
+                show_behavior(self._policy, self.env, max_len=20, add_to_wandb=True, plot=False)
+            except Exception as e:
+                warnings.warn(f"Could not show the behavior of the agent: {e!r}")
 
 
 class ProgressBarCallback(BaseCallback):
@@ -342,12 +479,81 @@ class WeightDecayCallback(BaseCallback):
         return True
 
 
+class EarlyStoppingCallback(BaseCallback):
+    """
+    Stop training when the score did not improve by more than min_delta for `patience` checks.
+
+    By default, the score is the mean reward of the last 100 training episodes, checked at
+    the end of each rollout. If a score function is given, it is called on the model every
+    `every` timesteps instead, for instance to run a cheap evaluation.
+    """
+
+    def __init__(self, patience: int, min_delta: float = 0.0,
+                 score: Callable[[PPO], float] | None = None, every: int = 0):
+        super().__init__()
+        self.patience = patience
+        self.min_delta = min_delta
+        self.score = score
+        self.every = every
+        self.best = -float("inf")
+        self.checks_without_improvement = 0
+        self.last_check = 0
+        self.stopped_at: int | None = None
+
+    def _on_rollout_end(self) -> None:
+        if self.score is None:
+            if not self.model.ep_info_buffer:
+                return
+            self._check(float(np.mean([episode["r"] for episode in self.model.ep_info_buffer])))
+        elif self.num_timesteps - self.last_check >= self.every:
+            self.last_check = self.num_timesteps
+            self._check(self.score(self.model))
+
+    def _check(self, score: float):
+        if score > self.best + self.min_delta:
+            self.best = score
+            self.checks_without_improvement = 0
+        else:
+            self.checks_without_improvement += 1
+
+        self.logger.record("train/early_stopping_best", self.best)
+        if self.checks_without_improvement >= self.patience:
+            self.stopped_at = self.num_timesteps
+            print(f"Early stopping at {self.num_timesteps} timesteps, best score: {self.best}")
+
+    def _on_step(self) -> bool:
+        return self.stopped_at is None
+
+
 class LogChannelNormsCallback(BaseCallback):
+    """
+    Log the norm of each input channel of the first convolution, every `every` timesteps.
+
+    With a Metrics instance, the norms are logged to it, without any device sync.
+    Otherwise, they are recorded in the SB3 logger.
+    """
+
+    def __init__(self, metrics: Metrics | None = None, every: int = 1):
+        super().__init__()
+        self.metrics = metrics
+        self.every = every
+        self.last_logged = -every
+        self.conv1: nn.Conv2d | None = None
+
+    def _init_callback(self) -> None:
+        self.conv1 = next(m for m in self.model.policy.modules() if isinstance(m, nn.Conv2d))
+
     def _on_step(self) -> bool:
-        conv1 = next(m for m in self.model.policy.modules() if isinstance(m, nn.Conv2d))
-        by_in_channel = conv1.weight.norm(2, dim=(0, 2, 3))
-        for i, norm in enumerate(by_in_channel):
-            self.logger.record(f"train/channel_norm/{i}", norm.item())
+        if self.num_timesteps - self.last_logged < self.every:
+            return True
+        self.last_logged = self.num_timesteps
+        with torch.no_grad():
+            by_in_channel = self.conv1.weight.norm(2, dim=(0, 2, 3))
+        if self.metrics is not None:
+            self.metrics.log({"train/channel_norm": by_in_channel}, step=self.num_timesteps)
+        else:
+            for i, norm in enumerate(by_in_channel.tolist()):
+                self.logger.record(f"train/channel_norm/{i}", norm)
         return True
 
 
@@ -551,6 +757,61 @@ def make_stats(policy, env: gym.Env, n_episodes=100, subtitle: str = "",
     return stats
 
 
+@torch.no_grad()
+def policy_forward(policy, obs: np.ndarray, batch_size: int = 8192) -> tuple[
+    Float[Tensor, "batch action"],
+    Float[Tensor, "batch"],
+]:
+    """
+    Return the action probabilities and the values of a policy for a batch of observations.
+
+    The actor and critic are run once per chunk of batch_size observations.
+    """
+    policy = getattr(policy, "policy", policy)  # Accept both PPO and ActorCriticPolicy
+    probs = []
+    values = []
+    for start in range(0, len(obs), batch_size):
+        obs_tensor, _ = policy.obs_to_tensor(obs[start:start + batch_size])
+        features = policy.extract_features(obs_tensor)
+        latent_pi, latent_vf = policy.mlp_extractor(features)
+        probs.append(torch.softmax(policy.action_net(latent_pi), dim=-1).cpu())
+        values.append(policy.value_net(latent_vf).squeeze(-1).cpu())
+    return torch.cat(probs), torch.cat(values)
+
+
+def predict_batch(policy, obs: np.ndarray, batch_size: int = 8192) -> np.ndarray:
+    """Return the greedy actions of the policy for a batch of observations, calling predict by chunks."""
+    return np.concatenate([
+        np.asarray(policy.predict(obs[start:start + batch_size], deterministic=True)[0]).reshape(-1)
+        for start in range(0, len(obs), batch_size)
+    ])
+
+
+def rollout_batch(policy, env: gym.Env, states: environments.ThreeGoalsStates,
+                  batch_size: int = 8192) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Run the greedy policy from each of the states, in lockstep, until all episodes end.
+
+    Args:
+        policy: Anything with a batched predict method.
+        env: The wrapped environment, used only to compute the observations.
+        states: The states to start from. They are not modified.
+
+    Returns:
+        - the goal each episode ended on (3 if it ended on no goal)
+        - the number of steps of each episode
+    """
+    states = states.copy()
+    start_steps = states.steps.copy()
+    actions = np.zeros(len(states), dtype=np.int64)
+    while not states.done.all():
+        active = np.flatnonzero(~states.done)
+        obs = wrappers.observe_states(env, states[active])
+        actions[active] = predict_batch(policy, obs, batch_size)
+        states.step(actions)
+    return states.end_goal, states.steps - start_steps
+
+
 def add_line(fig, equation: str):
     minx, maxx = fig.data[0].x.min(), fig.data[0].x.max()
 
@@ -18,9 +18,12 @@ import environments as envs
 
 __all__ = [
     "wrap",
+    "observe_batch",
+    "observe_states",
     "AddSwitch",
     "ColorBlindWrapper",
     "OneHotColorBlindWrapper",
+    "TokenColorBlindWrapper",
     "WeightedChannelWrapper",
     "AddTrueGoalToObsFlat",
     "FunctionRewardWrapper",
@@ -46,6 +49,38 @@ def wrap(env: Callable[[], T], *wrappers: Callable[[gym.Env], gym.Env]) -> Calla
     return _wrapper
 
 
+def observe_batch(env: gym.Env, grids: np.ndarray, true_goal_idx: np.ndarray) -> np.ndarray:
+    """Return the observations that env would give, for a batch of states of its unwrapped env.
+
+    Each observation wrapper of the stack must define `observation_batch(obs, true_goal_idx)`,
+    which transforms a batch of observations at once. Other wrappers are ignored.
+
+    Args:
+        env: The wrapped environment. Its own state is not used.
+        grids: A batch of observations of the unwrapped env: grids as in ThreeGoalsEnv.grid,
+            or tokens if it is in tokens mode.
+        true_goal_idx: The index of the true goal for each grid.
+    """
+    stack = []
+    while isinstance(env, gym.Wrapper):
+        stack.append(env)
+        env = env.env
+
+    obs = grids
+    for wrapper in reversed(stack):
+        if hasattr(wrapper, "observation_batch"):
+            obs = wrapper.observation_batch(obs, true_goal_idx)
+        elif isinstance(wrapper, ObservationWrapper):
+            raise NotImplementedError(f"{wrapper.__class__.__name__} cannot compute batched observations.")
+    return obs
+
+
+def observe_states(env: gym.Env, states: envs.ThreeGoalsStates) -> np.ndarray:
+    """Return the observations that env would give for the states, as observe_batch does."""
+    obs = states.tokens() if env.unwrapped.obs_mode == "tokens" else states.grids()
+    return observe_batch(env, obs, states.true_goal)
+
+
 class AddSwitch(ObservationWrapper):
     """
     A wrapper that adds a switch to the observation.
@@ -87,6 +122,8 @@ class AddSwitch(ObservationWrapper):
 
 
 class BaseBlindWrapper(ObservationWrapper):
+    # The obs_mode of the GridEnv this wrapper expects
+    obs_mode = "grid"
 
     def __init__(self, env: gym.Env,
                  merged_channels: tuple[int, ...] = (0, 1),
@@ -99,6 +136,8 @@ class BaseBlindWrapper(ObservationWrapper):
         in_space = env.observation_space
         assert isinstance(in_space, MultiDiscrete), f"{self.__class__.__name__} expected MultiDiscrete, got {in_space}"
         assert len(in_space.shape) == 2, in_space
+        assert env.unwrapped.obs_mode == self.obs_mode, \
+            f"{self.__class__.__name__} expected obs_mode={self.obs_mode}, got {env.unwrapped.obs_mode}"
 
         super().__init__(env)
 
@@ -182,6 +221,9 @@ class ColorBlindWrapper(BaseBlindWrapper):
     def observation(self, obs: np.ndarray):
         return self.color_map[obs]
 
+    def observation_batch(self, obs: np.ndarray, true_goal_idx: np.ndarray) -> np.ndarray:
+        return self.color_map[obs]
+
 
 class OneHotColorBlindWrapper(BaseBlindWrapper):
     """
@@ -232,6 +274,71 @@ class OneHotColorBlindWrapper(BaseBlindWrapper):
 
         return one_hot
 
+    def observation_batch(self, obs: np.ndarray, true_goal_idx: np.ndarray) -> np.ndarray:
+        one_hot = obs[..., None] == np.arange(self.n_cells)
+        if not self.disabled:
+            one_hot[..., self.merge_channels] = one_hot[..., self.merge_channels].any(axis=-1, keepdims=True)
+        return one_hot
+
+
+class TokenColorBlindWrapper(BaseBlindWrapper):
+    """
+    A wrapper that takes the tokens of a gridworld in tokens mode and makes them color-blind.
+
+    The types in merged_channels are all replaced by the first of them, and the tokens are
+    sorted again, so that their order does not tell the merged types apart.
+
+    Input: MultiDiscrete((n_tokens, 3)), (cell type, x, y) for each object
+    Output: Box((n_tokens, 3))
+    """
+
+    unwrapped: envs.ThreeGoalsEnv
+    obs_mode = "tokens"
+
+    def __init__(self, env: gym.Env,
+                 merged_channels: tuple[int, ...] = (2, 3),
+                 reward_indistinguishable_goals: bool = False,
+                 disabled: bool = False):
+        assert isinstance(env.unwrapped, envs.ThreeGoalsEnv)
+        super().__init__(env, merged_channels, reward_indistinguishable_goals, disabled)
+
+        in_space = env.observation_space
+        self.observation_space = gym.spaces.Box(low=0, high=in_space.nvec - 1, shape=in_space.shape)
+        self.type_map_full = np.arange(len(self.unwrapped.ALL_CELLS))
+        self.type_map_blind = self.type_map_full.copy()
+        self.type_map_blind[self.merge_channels] = self.merge_channels[0]
+
+    @property
+    def type_map(self):
+        if self.disabled:
+            return self.type_map_full
+        else:
+            return self.type_map_blind
+
+    def is_indistinguishable_from_true_goal(self, goal: envs.Cell) -> bool:
+        unwrapped = self.unwrapped
+        goal_type = unwrapped.ALL_CELLS.index(goal)
+        true_type = unwrapped.ALL_CELLS.index(unwrapped.true_goal)
+        return self.type_map[goal_type] == self.type_map[true_type]
+
+    def observation(self, obs: np.ndarray) -> np.ndarray:
+        return self._blind(obs[None])[0]
+
+    def observation_batch(self, obs: np.ndarray, true_goal_idx: np.ndarray) -> np.ndarray:
+        return self._blind(obs)
+
+    def _blind(self, tokens: np.ndarray) -> np.ndarray:
+        types = self.type_map[tokens[..., 0]]
+        # Sort again by merged type then cell, padding last
+        unwrapped = self.unwrapped
+        n_cells = unwrapped.width * unwrapped.height
+        cells = tokens[..., 1] * unwrapped.height + tokens[..., 2]
+        keys = np.where(types > 0, types * n_cells + cells, len(self.type_map) * n_cells)
+        order = np.argsort(keys, axis=-1)
+        blind = np.concatenate([types[..., None], tokens[..., 1:]], axis=-1)
+        return np.take_along_axis(blind, order[..., None], axis=-2).astype(self.observation_space.dtype)
+
+
 class WeightedChannelWrapper(ObservationWrapper):
     """
     This wrapper takes a gridworld image and weights each channel differently.
@@ -256,6 +363,9 @@ class WeightedChannelWrapper(ObservationWrapper):
         else:
             return obs * self.weights
 
+    def observation_batch(self, obs: np.ndarray, true_goal_idx: np.ndarray) -> np.ndarray:
+        return self.observation(obs)
+
 
 class AddTrueGoalToObsFlat(ObservationWrapper):
     """
@@ -309,6 +419,17 @@ class AddTrueGoalToObsFlat(ObservationWrapper):
 
         return np.concatenate([flat, to_add])
 
+    def observation_batch(self, obs: np.ndarray, true_goal_idx: np.ndarray) -> np.ndarray:
+        flat = obs.reshape(len(obs), -1)
+
+        if self.goal_is_one_hot:
+            to_add = np.zeros((len(obs), self.n_goals), dtype=obs.dtype)
+            to_add[np.arange(len(obs)), true_goal_idx] = 1
+        else:
+            to_add = np.asarray(true_goal_idx, dtype=obs.dtype)[:, None]
+
+        return np.concatenate([flat, to_add], axis=1)
+
 
 class FunctionRewardWrapper(gym.RewardWrapper):
     """
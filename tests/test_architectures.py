@@ -0,0 +1,25 @@
+import copy
+
+import gymnasium as gym
+import torch
+from torch import nn
+
+from architectures import CustomActorCriticPolicy
+
+
+def test_deepcopy_of_compiled_policy_uses_its_own_weights():
+    observation_space = gym.spaces.Box(-1, 1, (4,))
+    policy = CustomActorCriticPolicy(observation_space, gym.spaces.Discrete(4), lambda _: 1e-3,
+                                     arch=nn.Sequential(nn.Linear(4, 8), nn.ReLU(), nn.Linear(8, 8)),
+                                     compile=True)
+    features = torch.randn(16, 4)
+
+    policy_copy = copy.deepcopy(policy)
+    with torch.no_grad():
+        for param in policy_copy.parameters():
+            param.zero_()
+
+    assert torch.all(policy_copy.mlp_extractor.forward_actor(features) == 0)
+    assert torch.all(policy_copy.mlp_extractor.forward_critic(features) == 0)
+    assert torch.any(policy.mlp_extractor.forward_actor(features) != 0)
+    assert policy_copy.state_dict().keys() == policy.state_dict().keys()
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from batched_envs import HAS_NUMBA, BatchedGridEnv
+from environments import ThreeGoalsEnv
+
+BACKENDS = [
+    "numpy",
+    pytest.param("numba", marks=pytest.mark.skipif(not HAS_NUMBA, reason="numba is not installed")),
+]
+
+
+def make_env():
+    # A non-uniform goal distribution, to check the weighted sampling too
+    return ThreeGoalsEnv(4, red_pos={(0, 0): 1, (1, 1): 3, (2, 3): 1}, step_reward=-0.1)
+
+
+def test_numba_step_matches_numpy():
+    pytest.importorskip("numba")
+    n_envs = 512
+    reference = BatchedGridEnv(make_env(), n_envs, seed=0, backend="numpy", auto_reset=False)
+    jitted = BatchedGridEnv(make_env(), n_envs, seed=0, backend="numba", auto_reset=False)
+    reference.reset()
+    for name in ("grids", "agent", "steps", "done", "reward_table", "terminates_table"):
+        getattr(jitted, name)[:] = getattr(reference, name)
+
+    rng = np.random.default_rng(0)
+    for _ in range(reference.max_steps + 1):
+        actions = rng.integers(4, size=n_envs)
+        expected = [a.copy() for a in reference.step(actions)]
+        for got, want in zip(jitted.step(actions), expected):
+            np.testing.assert_array_equal(got, want)
+        np.testing.assert_array_equal(jitted.agent, reference.agent)
+        np.testing.assert_array_equal(jitted.done, reference.done)
+    assert reference.done.all()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_reset_distribution_matches_env(backend):
+    n = 20_000
+    env = make_env()
+    n_types = len(env.ALL_CELLS)
+
+    # Frequency of each cell type on each cell, and of each true goal
+    expected_cells = np.zeros((n_types, env.width * env.height))
+    expected_goals = np.zeros(3)
+    env.reset(seed=0)
+    for _ in range(n):
+        env.reset()
+        expected_cells[env.flat_grid, np.arange(env.flat_grid.size)] += 1
+        expected_goals[env.true_goal_idx] += 1
+
+    batched = BatchedGridEnv(make_env(), n, seed=0, backend=backend)
+    batched.reset()
+    grids = batched.grids.astype(np.int64)
+    cells = (grids[..., None] == np.arange(n_types)).sum(0).T
+    goals = np.bincount(batched.info["true_goal"], minlength=3)
+
+    np.testing.assert_allclose(cells / n, expected_cells / n, atol=0.02)
+    np.testing.assert_allclose(goals / n, expected_goals / n, atol=0.02)
+    # Every object is on its own cell
+    assert (np.count_nonzero(grids, axis=1) == len(env.spawn_weights())).all()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_reset_raises_without_free_cell(backend):
+    env = ThreeGoalsEnv(4, agent_pos=(0, 0))
+    # The red goal can only go on the agent's cell
+    env.red_pos_dist = {(0, 0): 1}
+    batched = BatchedGridEnv(env, 8, seed=0, backend=backend)
+    with pytest.raises(ValueError):
+        batched.reset()
@@ -0,0 +1,41 @@
+import numpy as np
+
+from episode_log import EpisodeLog, EpisodeLogWriter
+
+STEP_COLUMNS = {
+    "episode": ("int64", ()),
+    "step": ("int32", ()),
+    "action": ("int64", ()),
+    "reward": ("float32", ()),
+}
+
+
+def write_episodes(writer: EpisodeLogWriter, n_episodes: int, length: int = 3):
+    for _ in range(n_episodes):
+        for _ in range(length):
+            # The action encodes the episode, so that misaligned columns are visible
+            writer.add_step(action=writer.episode_id, reward=1.0)
+        writer.end_episode(terminated=True, true_goal=0, end_goal=0, goal_positions=np.zeros((3, 2)))
+
+
+def test_reopen_after_crash_keeps_columns_aligned(tmp_path):
+    with EpisodeLogWriter(tmp_path, STEP_COLUMNS, chunk_size=2) as writer:
+        write_episodes(writer, 2)
+
+    # A crashed writer left a row and a half in one step column, and a row in one episode column
+    with (tmp_path / "steps" / "action.bin").open("ab") as f:
+        f.write(np.array([99, 99], dtype=np.int64).tobytes()[:12])
+    with (tmp_path / "episodes" / "reward.bin").open("ab") as f:
+        f.write(np.array([99], dtype=np.float32).tobytes())
+
+    with EpisodeLogWriter(tmp_path, STEP_COLUMNS, chunk_size=2) as writer:
+        write_episodes(writer, 2)
+
+    log = EpisodeLog(tmp_path)
+    assert len(log) == 4
+    assert log.n_steps == 12
+    assert all(len(col) == len(log) for col in log.episodes.values())
+    assert all(len(col) == log.n_steps for col in log.steps.values())
+    np.testing.assert_array_equal(log.steps["action"], log.steps["episode"])
+    np.testing.assert_array_equal(log.episodes["start"], [0, 3, 6, 9])
+    np.testing.assert_array_equal(log.episodes["reward"], [3, 3, 3, 3])
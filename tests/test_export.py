@@ -0,0 +1,26 @@
+import gymnasium as gym
+import numpy as np
+import torch
+from torch import nn
+
+from architectures import CustomActorCriticPolicy, TokenEncoder
+from export import NumpyPolicy, export_policy
+
+
+def test_token_encoder_policy_matches_torch(tmp_path):
+    n_tokens = 6
+    observation_space = gym.spaces.Box(0, 4, (n_tokens * 3,))
+    arch = nn.Sequential(TokenEncoder(n_types=5, width=4, height=4, n_tokens=n_tokens, embed_dim=8),
+                         nn.Linear(n_tokens * 8, 8), nn.ReLU())
+    policy = CustomActorCriticPolicy(observation_space, gym.spaces.Discrete(4), lambda _: 1e-3, arch=arch)
+
+    rng = np.random.default_rng(0)
+    obs = rng.integers(0, 4, (32, n_tokens, 3))
+    # The last tokens are padding
+    obs[:, 4:] = 0
+    obs = obs.reshape(32, -1).astype(np.float32)
+
+    exported = NumpyPolicy.load(export_policy(policy, tmp_path / "policy"))
+    with torch.no_grad():
+        expected = policy.action_net(policy.mlp_extractor.forward_actor(torch.from_numpy(obs))).numpy()
+    np.testing.assert_allclose(exported.logits(obs), expected, rtol=1e-5, atol=1e-5)